@@ -1,2847 +1,3600 @@
-#!/usr/bin/env python3
-import json
-import paho.mqtt.client as mqtt
-import argparse
-import time
-import os
-import subprocess
-import socket
-import re
-import sys
-import logging
-import xml.etree.ElementTree as ET
-import base64
-from pathlib import Path
-import threading
-import atexit
-# Try to import watchdog, but don't crash if it's not available
-try:
-    from watchdog.observers import Observer
-    from watchdog.events import FileSystemEventHandler
-    from watchdog.events import PatternMatchingEventHandler
-    watchdog_available = True
-except ImportError:
-    watchdog_available = False
-    # Don't log here, since logger isn't initialized yet
-    # We'll log this later
-
-# Detect system type
-SYSTEM_TYPE = "unknown"
-if os.path.exists("/opt/retropie"):
-    SYSTEM_TYPE = "retropie"
-    CONFIG_DIR = os.path.expanduser('~/.config/retropie-ha')
-    ROMS_DIR = os.path.expanduser('~/RetroPie/roms')
-    SYSTEM_NAME = "retropie"
-elif os.path.exists("/userdata/system"):
-    SYSTEM_TYPE = "batocera"
-    CONFIG_DIR = "/userdata/system/retropie-ha"  # Fixed path to match installation script
-    ROMS_DIR = "/userdata/roms"
-    SYSTEM_NAME = "batocera"
-else:
-    # Fallback to RetroPie defaults
-    CONFIG_DIR = os.path.expanduser('~/.config/retropie-ha')
-    ROMS_DIR = os.path.expanduser('~/RetroPie/roms')
-    SYSTEM_NAME = "retropie"
-
-# Set up logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler(os.path.join(CONFIG_DIR, 'retropie-ha.log'))
-        # Removed StreamHandler to prevent console output
-    ]
-)
-logger = logging.getLogger(f'{SYSTEM_NAME}-ha')
-
-# Constants
-CONFIG_FILE = os.path.join(CONFIG_DIR, 'config.json')
-STATE_FILE = os.path.join(CONFIG_DIR, 'state.json')
-RETROARCH_PORT = 55355  # Default RetroArch Network Control Interface port
-
-# Global state
-current_state = {
-    'machine_status': 'idle',  # idle, playing, shutdown
-    'current_game': None,
-    'game_start_time': None,
-    'last_update': int(time.time()),
-    'game_collection': {
-        'total_games': 0,
-        'favorites': 0,
-        'kid_friendly': 0,
-        'last_scan': 0,
-        'systems': {}
-    }
-}
-
-def ensure_config_dir():
-    """Ensure configuration directory exists"""
-    if not os.path.exists(CONFIG_DIR):
-        os.makedirs(CONFIG_DIR)
-
-def get_config():
-    """Load configuration from file"""
-    try:
-        with open(CONFIG_FILE, 'r') as f:
-            return json.load(f)
-    except Exception as e:
-        logger.error(f"Failed to load configuration: {e}")
-        return {}
-
-def save_state():
-    """Save current state to file"""
-    try:
-        with open(STATE_FILE, 'w') as f:
-            json.dump(current_state, f)
-    except Exception as e:
-        logger.error(f"Failed to save state: {e}")
-
-def load_state():
-    """Load state from file"""
-    global current_state
-    try:
-        if os.path.exists(STATE_FILE):
-            with open(STATE_FILE, 'r') as f:
-                current_state.update(json.load(f))
-    except Exception as e:
-        logger.error(f"Failed to load state: {e}")
-
-def get_cpu_temperature():
-    """Get CPU temperature using vcgencmd"""
-    try:
-        output = subprocess.check_output(['vcgencmd', 'measure_temp'], universal_newlines=True)
-        temp = re.search(r'temp=(\d+\.\d+)', output)
-        if temp:
-            return float(temp.group(1))
-    except Exception as e:
-        logger.error(f"Failed to get CPU temperature: {e}")
-    return None
-
-def get_gpu_temperature():
-    """Get GPU temperature (on Raspberry Pi, this is often the same as CPU)"""
-    try:
-        # On some systems, there might be a separate GPU temperature command
-        # For Raspberry Pi, we typically use the same as CPU
-        return get_cpu_temperature()
-    except Exception as e:
-        logger.error(f"Failed to get GPU temperature: {e}")
-    return None
-
-def get_cpu_frequency():
-    """Get current CPU frequency in MHz using vcgencmd"""
-    try:
-        output = subprocess.check_output(['vcgencmd', 'measure_clock', 'arm'], universal_newlines=True)
-        freq = re.search(r'frequency\(\d+\)=(\d+)', output)
-        if freq:
-            # Convert from Hz to MHz
-            return int(int(freq.group(1)) / 1000000)
-        
-        # Alternative format parsing
-        freq = re.search(r'=(\d+)', output)
-        if freq:
-            # Convert from Hz to MHz
-            return int(int(freq.group(1)) / 1000000)
-    except Exception as e:
-        logger.error(f"Failed to get CPU frequency: {e}")
-    return None
-
-def get_gpu_frequency():
-    """Get current GPU frequency in MHz using vcgencmd"""
-    try:
-        output = subprocess.check_output(['vcgencmd', 'measure_clock', 'core'], universal_newlines=True)
-        freq = re.search(r'frequency\(\d+\)=(\d+)', output)
-        if freq:
-            # Convert from Hz to MHz
-            return int(int(freq.group(1)) / 1000000)
-            
-        # Alternative format parsing
-        freq = re.search(r'=(\d+)', output)
-        if freq:
-            # Convert from Hz to MHz
-            return int(int(freq.group(1)) / 1000000)
-    except Exception as e:
-        logger.error(f"Failed to get GPU frequency: {e}")
-    return None
-
-def get_system_info():
-    """Get basic system information"""
-    hostname = socket.gethostname()
-    
-    # Get system uptime
-    try:
-        with open('/proc/uptime', 'r') as f:
-            uptime_seconds = float(f.readline().split()[0])
-    except Exception:
-        uptime_seconds = 0
-    
-    # Get system load
-    try:
-        with open('/proc/loadavg', 'r') as f:
-            load = f.readline().split()[:3]
-    except Exception:
-        load = [0, 0, 0]
-    
-    # Get memory info
-    mem_info = {}
-    try:
-        output = subprocess.check_output(['free', '-m'], universal_newlines=True).split('\n')
-        mem_line = output[1].split()
-        mem_info = {
-            'total': int(mem_line[1]),
-            'used': int(mem_line[2]),
-            'free': int(mem_line[3])
-        }
-    except Exception as e:
-        logger.error(f"Failed to get memory info: {e}")
-        mem_info = {'total': 0, 'used': 0, 'free': 0}
-    
-    info = {
-        'hostname': hostname,
-        'cpu_temp': get_cpu_temperature(),
-        'gpu_temp': get_gpu_temperature(),
-        'cpu_freq': get_cpu_frequency(),
-        'gpu_freq': get_gpu_frequency(),
-        'uptime_seconds': uptime_seconds,
-        'load': load,
-        'memory': mem_info,
-        'machine_status': current_state.get('machine_status', 'idle'),
-        'current_game': current_state.get('current_game'),
-        'game_start_time': current_state.get('game_start_time')
-    }
-    
-    # Add play duration if a game is running
-    if info['machine_status'] == 'playing' and info['game_start_time']:
-        info['play_duration_seconds'] = int(time.time()) - info['game_start_time']
-    
-    return info
-
-def get_game_metadata(system, rom_path):
-    """Get game metadata from EmulationStation gamelist.xml"""
-    try:
-        # Log the input parameters
-        logger.info(f"Getting metadata for system={system}, rom_path={rom_path}")
-        
-        # Clean up input paths
-        if rom_path.startswith('./'):
-            rom_path = rom_path[2:]  # Remove ./ prefix
-        
-        # Find the gamelist.xml file - check multiple possible locations based on system type
-        gamelist_paths = []
-        
-        # First try system-specific ROM directory (primary location)
-        gamelist_paths.append(os.path.join(ROMS_DIR, system, 'gamelist.xml'))
-        
-        # For Batocera, also check alternative locations
-        if SYSTEM_TYPE == "batocera":
-            # Batocera can have gamelist.xml files in multiple locations
-            gamelist_paths.append(f"/userdata/system/configs/emulationstation/gamelists/{system}/gamelist.xml")
-        
-        # For RetroPie, check alternative location
-        elif SYSTEM_TYPE == "retropie":
-            gamelist_paths.append(os.path.expanduser(f"~/.emulationstation/gamelists/{system}/gamelist.xml"))
-        
-        # Try each path until we find an existing file
-        gamelist_path = None
-        for path in gamelist_paths:
-            if os.path.exists(path):
-                gamelist_path = path
-                logger.info(f"Found gamelist.xml at: {path}")
-                break
-        
-        if not gamelist_path:
-            logger.warning(f"gamelist.xml not found for system {system} in any of the expected locations")
-            return {}
-        
-        # Parse the gamelist.xml
-        tree = ET.parse(gamelist_path)
-        root = tree.getroot()
-        
-        # Get the base name for matching
-        rom_basename = os.path.basename(rom_path)
-        rom_name_no_ext = os.path.splitext(rom_basename)[0]
-        
-        # Clean the name for matching
-        cleaned_rom_name = rom_basename.replace('-', ' ').replace('[!]', '').strip()
-        cleaned_rom_name_no_ext = rom_name_no_ext.replace('-', ' ').replace('[!]', '').strip()
-        
-        logger.info(f"Looking for matches with: basename={rom_basename}, name_no_ext={rom_name_no_ext}, cleaned={cleaned_rom_name}")
-        
-        # Find the game entry
-        for game in root.findall('game'):
-            path_elem = game.find('path')
-            if path_elem is not None:
-                game_path = path_elem.text
-                # Remove ./ prefix if it exists
-                if game_path.startswith('./'):
-                    game_path = game_path[2:]
-                
-                # Get game basename for matching
-                game_basename = os.path.basename(game_path)
-                game_name_no_ext = os.path.splitext(game_basename)[0]
-                cleaned_game_name = game_basename.replace('-', ' ').replace('[!]', '').strip()
-                cleaned_game_name_no_ext = game_name_no_ext.replace('-', ' ').replace('[!]', '').strip()
-                
-                logger.debug(f"Comparing with game: {game_basename}, no_ext={game_name_no_ext}, cleaned={cleaned_game_name}")
-                
-                # Check if paths match - with all possible combinations
-                if (game_basename == rom_basename or 
-                    game_name_no_ext == rom_name_no_ext or
-                    cleaned_game_name == cleaned_rom_name or
-                    cleaned_game_name_no_ext == cleaned_rom_name_no_ext or
-                    # Even looser matching - is the rom name contained in the game name or vice versa
-                    cleaned_rom_name_no_ext in cleaned_game_name_no_ext or
-                    cleaned_game_name_no_ext in cleaned_rom_name_no_ext):
-                    
-                    logger.info(f"Found matching game in gamelist.xml: {game_basename}")
-                    metadata = {}
-                    
-                    # Get basic metadata
-                    for elem in ['desc', 'rating', 'releasedate', 'developer', 'publisher', 'genre']:
-                        if game.find(elem) is not None:
-                            metadata[elem] = game.find(elem).text
-                    
-                    # Get game name (can be in different elements)
-                    if game.find('name') is not None:
-                        metadata['name'] = game.find('name').text
-                    elif game.find('n') is not None:
-                        metadata['name'] = game.find('n').text
-                    
-                    logger.info(f"Game name from metadata: {metadata.get('name', 'Not found')}")
-                    
-                    # Get image paths and convert to base64 if they exist
-                    for img_type in ['image', 'thumbnail', 'marquee']:
-                        img_elem = game.find(img_type)
-                        if img_elem is not None and img_elem.text:
-                            img_path = img_elem.text
-                            if img_path.startswith('./'):
-                                img_path = img_path[2:]
-                            
-                            logger.info(f"Found {img_type} path in metadata: {img_path}")
-                            
-                            # Check if the image exists - carefully handle paths
-                            full_img_path = os.path.join(ROMS_DIR, system, img_path)
-                            logger.info(f"Full image path: {full_img_path}")
-                            
-                            # Try a few variations if the direct path doesn't exist
-                            if not os.path.exists(full_img_path):
-                                logger.info(f"Image not found at {full_img_path}, trying alternatives")
-                                
-                                # Check if there's a .jpg instead of .png or vice versa
-                                alt_paths = []
-                                if full_img_path.endswith('.png'):
-                                    alt_paths.append(full_img_path.replace('.png', '.jpg'))
-                                elif full_img_path.endswith('.jpg'):
-                                    alt_paths.append(full_img_path.replace('.jpg', '.png'))
-                                
-                                # Try each alternative
-                                for alt_path in alt_paths:
-                                    if os.path.exists(alt_path):
-                                        logger.info(f"Found alternative image at {alt_path}")
-                                        full_img_path = alt_path
-                                        img_path = os.path.relpath(alt_path, os.path.join(ROMS_DIR, system))
-                                        break
-                            
-                            if os.path.exists(full_img_path):
-                                try:
-                                    # Store the image path relative to ROMS_DIR 
-                                    rel_img_path = os.path.join(system, img_path)
-                                    metadata['image_path'] = rel_img_path
-                                    logger.info(f"Successfully found image: {rel_img_path}")
-                                    
-                                    # Only include the thumbnail to keep the size reasonable
-                                    if img_type == 'thumbnail':
-                                        with open(full_img_path, 'rb') as img_file:
-                                            img_data = img_file.read()
-                                            metadata['image_data'] = base64.b64encode(img_data).decode('utf-8')
-                                            metadata['full_image_path'] = full_img_path
-                                except Exception as e:
-                                    logger.error(f"Failed to read image file {full_img_path}: {e}")
-                            else:
-                                logger.warning(f"Image file not found: {full_img_path}")
-                    
-                    # Check if we found an image path
-                    if 'image_path' not in metadata:
-                        logger.warning(f"No image path found for game {metadata.get('name', rom_basename)}")
-                    
-                    return metadata
-        
-        logger.warning(f"Game {rom_path} not found in gamelist.xml for system {system}")
-        return {}
-    except Exception as e:
-        logger.error(f"Error getting game metadata: {e}")
-        import traceback
-        logger.error(f"Traceback: {traceback.format_exc()}")
-        return {}
-
-def publish_mqtt_message(topic, message, retain=False, max_retries=5, shutdown_mode=False):
-    """Publish a message to MQTT broker with retry logic"""
-    global args  # Access command line args to check for shutdown mode
-    
-    # Check if we're in shutdown mode from function parameter or command line args
-    if not shutdown_mode and hasattr(args, 'shutdown_mode') and args.shutdown_mode:
-        shutdown_mode = True
-    
-    config = get_config()
-    
-    if not config.get('mqtt_host'):
-        logger.error("MQTT host not configured")
-        return False
-    
-    # Quick network check before attempting MQTT connection (to avoid hanging)
-    if shutdown_mode:
-        try:
-            # Use a very short socket timeout to test connectivity (0.5 seconds)
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            s.settimeout(0.5)
-            result = s.connect_ex((config['mqtt_host'], int(config.get('mqtt_port', 1883))))
-            s.close()
-            if result != 0:
-                logger.warning(f"Network check failed during shutdown - MQTT broker unreachable")
-                return False
-        except Exception as e:
-            logger.warning(f"Network check failed during shutdown: {e}")
-            return False
-      # Use a unique client id to avoid connection conflicts
-    client_id = f"{SYSTEM_NAME}-publisher-{int(time.time())}-{os.getpid()}"
-    # Use the newer API version to avoid deprecation warnings
-    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION1, client_id=client_id)
-    
-    # Set up a connection callback to track successful connections
-    connection_successful = False
-    def on_connect_local(client, userdata, flags, rc):
-        nonlocal connection_successful
-        if rc == 0:
-            connection_successful = True
-        else:
-            logger.warning(f"Connection failed with result code {rc}")
-    
-    client.on_connect = on_connect_local
-    
-    if config.get('mqtt_username') and config.get('mqtt_password'):
-        client.username_pw_set(config['mqtt_username'], config['mqtt_password'])
-    
-    # Set appropriate timeouts and retry counts based on mode
-    if shutdown_mode:
-        # Use minimal retries and timeouts during shutdown
-        actual_max_retries = 1
-        connect_timeout = 2
-        publish_wait = 1
-        max_wait = 1
-    else:
-        # Normal operation values
-        actual_max_retries = max_retries
-        connect_timeout = 15
-        publish_wait = 5
-        max_wait = 60
-    
-    # Add retry logic with exponential backoff
-    retries = 0
-    while retries < actual_max_retries:
-        try:
-            # Set connection timeout based on mode
-            client.connect_async(config['mqtt_host'], int(config.get('mqtt_port', 1883)))
-            client.loop_start()
-            
-            # Wait for connection with timeout
-            connect_start = time.time()
-            while not connection_successful and time.time() - connect_start < connect_timeout:
-                time.sleep(0.1)
-                
-            if not connection_successful:
-                client.loop_stop()
-                raise Exception(f"Connection timed out after {connect_timeout} seconds")
-            
-            # Set up for synchronous publishing with result checking
-            msg_info = client.publish(topic, message, qos=1, retain=retain)
-            
-            # Wait for the message to be sent (with a timeout)
-            publish_success = False
-            start_time = time.time()
-            
-            # Set up a publish callback
-            def on_publish(client, userdata, mid):
-                nonlocal publish_success
-                if mid == msg_info.mid:
-                    publish_success = True
-            
-            client.on_publish = on_publish
-            
-            while not publish_success and time.time() - start_time < publish_wait:
-                time.sleep(0.1)  # Check less frequently to reduce CPU usage
-            
-            # Cleanup
-            client.loop_stop()
-            client.disconnect()
-            
-            # Check if the publish succeeded
-            if not publish_success:
-                raise Exception("Message publish timed out")
-                
-            logger.info(f"Published to {topic}: {message[:100]}{'...' if len(message) > 100 else ''}")
-            return True
-        except Exception as e:
-            retries += 1
-            # Only log as error on final retry, otherwise log as warning
-            if retries >= actual_max_retries:
-                log_level = logging.WARNING if shutdown_mode else logging.ERROR
-                logger.log(log_level, f"Error publishing to MQTT after {actual_max_retries} attempts: {e}")
-                if isinstance(e, socket.error):
-                    logger.log(log_level, f"Socket error details: {e.errno} - {e.strerror}")
-                try:
-                    client.loop_stop()
-                    client.disconnect()
-                except:
-                    pass
-                return False
-            else:
-                # Calculate wait time with exponential backoff (2^retry seconds)
-                wait_time = min(2 ** retries, max_wait)
-                logger.warning(f"Error publishing to MQTT (attempt {retries}/{actual_max_retries}): {e}. Retrying in {wait_time} seconds.")
-                try:
-                    client.loop_stop()
-                    client.disconnect()
-                except:
-                    pass
-                time.sleep(wait_time)
-                
-    # This should never be reached due to the return in the final retry
-    return False
-
-def publish_game_event(event_type, event_args=None):
-    """Publish an EmulationStation game event to MQTT"""
-    global current_state, args
-    
-    # Check if we're in shutdown mode for quit events
-    shutdown_mode = False
-    if event_type == 'quit' and hasattr(args, 'shutdown_mode') and args.shutdown_mode:
-        shutdown_mode = True
-        logger.info("Processing quit event in shutdown mode with reduced timeouts")
-    
-    config = get_config()
-    topic_prefix = config.get('mqtt_topic_prefix', SYSTEM_NAME)
-    device_name = config.get('device_name', socket.gethostname())
-    
-    payload = {
-        'event': event_type,
-        'timestamp': int(time.time()),
-        'device': device_name,
-        'system_info': get_system_info(),
-    }
-    
-    # Update machine status based on event
-    if event_type == 'system-start':
-        current_state['machine_status'] = 'idle'
-        current_state['current_game'] = None
-        current_state['game_start_time'] = None
-        current_state['last_update'] = int(time.time())
-        save_state()
-        
-        # Also publish availability status
-        publish_state_message(f"{topic_prefix}/availability", "online", retain=True)
-        
-    elif event_type == 'game-start' and event_args and len(event_args) >= 3:
-        system = event_args[0]
-        rom_path = event_args[2]
-        emulator = event_args[1]
-        game_name = os.path.basename(rom_path)
-        
-        # Verify RetroArch network commands are enabled for this game session
-        # This runs in a separate thread to avoid blocking the game launch
-        if 'retroarch' in emulator.lower():
-            threading.Thread(target=verify_retroarch_network_commands, daemon=True).start()
-        
-        # Log received arguments for debugging
-        logger.info(f"Game-start event received with system={system}, emulator={emulator}, rom_path={rom_path}")
-        
-        # Get additional game metadata
-        metadata = get_game_metadata(system, rom_path)
-        display_name = metadata.get('name', game_name)
-        
-        # Log found metadata for debugging
-        logger.info(f"Game metadata found: display_name={display_name}, metadata keys: {list(metadata.keys())}")
-        if 'image_path' in metadata:
-            logger.info(f"Image path found in metadata: {metadata['image_path']}")
-        
-        # Update state
-        current_state['machine_status'] = 'playing'
-        current_state['current_game'] = display_name
-        current_state['game_start_time'] = int(time.time())
-        current_state['last_update'] = int(time.time())
-        
-        # Save image path in state if available
-        if 'image_path' in metadata:
-            current_state['image_path'] = metadata['image_path']
-            logger.info(f"Saved image_path to current_state: {metadata['image_path']}")
-        else:
-            logger.warning(f"No image_path found in metadata for game: {display_name}")
-            # Remove image_path from state if it exists
-            if 'image_path' in current_state:
-                current_state.pop('image_path')
-                logger.info("Removed existing image_path from current_state")
-            
-        save_state()
-        
-        # Build payload with metadata
-        game_data = {
-            'system': system,
-            'emulator': emulator,
-            'rom_path': rom_path,
-            'rom_name': game_name,
-            'game_name': display_name,
-            'start_time': current_state['game_start_time']
-        }
-        
-        # Also add image_path to the event payload directly
-        if 'image_path' in metadata:
-            game_data['image_path'] = metadata['image_path']
-            logger.info(f"Added image_path to game_data payload: {metadata['image_path']}")
-        else:
-            logger.warning(f"No image_path to add to game_data payload for game: {display_name}")
-        
-        # Add additional metadata if available
-        if 'desc' in metadata:
-            game_data['description'] = metadata['desc']
-        if 'genre' in metadata:
-            game_data['genre'] = metadata['genre']
-        if 'developer' in metadata:
-            game_data['developer'] = metadata['developer']
-        if 'publisher' in metadata:
-            game_data['publisher'] = metadata['publisher']
-        if 'rating' in metadata:
-            game_data['rating'] = metadata['rating']
-        if 'releasedate' in metadata:
-            game_data['releasedate'] = metadata['releasedate']
-        if 'image_path' in metadata:
-            game_data['image_path'] = metadata['image_path']
-        if 'image_data' in metadata:
-            game_data['image_data'] = metadata['image_data']
-        
-        payload.update(game_data)
-        
-        # Also update machine status
-        publish_machine_status()
-        
-    elif event_type == 'game-end':
-        # Reset current game info but keep system running
-        current_state['machine_status'] = 'idle'
-        
-        # Add game session duration to payload if we have start time
-        if current_state['game_start_time']:
-            payload['game_name'] = current_state['current_game']
-            payload['start_time'] = current_state['game_start_time']
-            payload['duration_seconds'] = int(time.time()) - current_state['game_start_time']
-            payload['end_time'] = int(time.time())
-        
-        # Reset game info
-        current_state['current_game'] = None
-        current_state['game_start_time'] = None
-        current_state['last_update'] = int(time.time())
-        
-        # Clear image path if it was set
-        if 'image_path' in current_state:
-            current_state.pop('image_path')
-            
-        save_state()
-        
-        # Also update machine status
-        publish_machine_status()
-        
-    elif event_type == 'system-select' and args and len(args) >= 2:
-        payload.update({
-            'system_name': args[0],
-            'access_type': args[1]
-        })
-        
-    elif event_type == 'game-select' and args and len(args) >= 4:
-        system = args[0]
-        rom_path = args[1]
-        game_name = args[2]
-        access_type = args[3]
-        
-        # Get additional game metadata
-        metadata = get_game_metadata(system, rom_path)
-        
-        # Build payload with metadata
-        game_data = {
-            'system_name': system,
-            'rom_path': rom_path,
-            'game_name': metadata.get('name', game_name),
-            'access_type': access_type
-        }
-        
-        # Add additional metadata if available
-        if 'desc' in metadata:
-            game_data['description'] = metadata['desc']
-        if 'genre' in metadata:
-            game_data['genre'] = metadata['genre']
-        if 'developer' in metadata:
-            game_data['developer'] = metadata['developer']
-        if 'publisher' in metadata:
-            game_data['publisher'] = metadata['publisher']
-        if 'rating' in metadata:
-            game_data['rating'] = metadata['rating']
-        if 'releasedate' in metadata:
-            game_data['releasedate'] = metadata['releasedate']
-        if 'image_path' in metadata:
-            game_data['image_path'] = metadata['image_path']
-        if 'image_data' in metadata:
-            game_data['image_data'] = metadata['image_data']
-        
-        payload.update(game_data)
-        
-    elif event_type == 'quit':
-        # System is shutting down
-        current_state['machine_status'] = 'shutdown'
-        current_state['last_update'] = int(time.time())
-        save_state()
-        
-        if event_args and len(event_args) >= 1:
-            payload.update({'quit_mode': event_args[0]})
-        
-        # Also publish availability status with shutdown_mode flag
-        publish_state_message(f"{topic_prefix}/availability", "offline", retain=True, shutdown_mode=shutdown_mode)
-        
-        # Skip machine status update during shutdown if in shutdown mode (to save time)
-        if not shutdown_mode:
-            publish_machine_status()
-        else:
-            logger.info("Skipping extra status updates during shutdown mode")
-    
-    topic = f"{topic_prefix}/event/{event_type}"
-    # Events should NOT be retained - they should expire when received
-    # Pass shutdown_mode flag for quit events
-    if event_type == 'quit':
-        return publish_mqtt_message(topic, json.dumps(payload), retain=False, shutdown_mode=shutdown_mode)
-    else:
-        return publish_mqtt_message(topic, json.dumps(payload), retain=False)
-
-def publish_state_message(state_topic, state_value, retain=True, shutdown_mode=False):
-    """Publish a simple state message to MQTT"""
-    return publish_mqtt_message(state_topic, state_value, retain=retain, shutdown_mode=shutdown_mode)
-
-def publish_machine_status():
-    """Publish machine status to MQTT"""
-    config = get_config()
-    topic_prefix = config.get('mqtt_topic_prefix', SYSTEM_NAME)
-    
-    # Create the status payload
-    payload = {
-        'timestamp': int(time.time()),
-        'status': current_state['machine_status'],
-        'current_game': current_state['current_game'],
-        'game_start_time': current_state['game_start_time']
-    }
-    
-    # Add play duration if a game is running
-    if current_state['machine_status'] == 'playing' and current_state['game_start_time']:
-        payload['play_duration_seconds'] = int(time.time()) - current_state['game_start_time']
-        
-        # Add image path if available in state
-        if 'image_path' in current_state:
-            payload['image_path'] = current_state['image_path']
-            logger.info(f"Adding image_path to machine_status payload: {current_state['image_path']}")
-        else:
-            logger.warning("No image_path available in current_state for machine_status payload")
-    
-    # Publish to the machine_status topic
-    topic = f"{topic_prefix}/machine_status"
-    return publish_mqtt_message(topic, json.dumps(payload), retain=True)
-
-def publish_system_status():
-    """Publish system status information to MQTT"""
-    config = get_config()
-    topic_prefix = config.get('mqtt_topic_prefix', SYSTEM_NAME)
-    device_name = config.get('device_name', socket.gethostname())
-    
-    payload = {
-        'timestamp': int(time.time()),
-        'device': device_name,
-        'system_info': get_system_info()
-    }
-    
-    # Update last update time
-    current_state['last_update'] = int(time.time())
-    save_state()
-    
-    topic = f"{topic_prefix}/status"
-    # Status updates should be retained so they're available immediately
-    return publish_mqtt_message(topic, json.dumps(payload), retain=True)
-
-def on_connect(client, userdata, flags, rc):
-    """Callback when connected to MQTT broker"""
-    logger.info(f"Connected to MQTT broker with result code {rc}")
-    
-    # Get topic prefix from config
-    topic_prefix = get_config().get('mqtt_topic_prefix', SYSTEM_NAME)
-    
-    # Subscribe to all command topics
-    command_topics = [
-        # Debug topic for testing
-        f"{topic_prefix}/debug",
-        
-        # TTS
-        f"{topic_prefix}/command/tts",
-        f"{topic_prefix}/tts_text/set",
-        
-        # RetroArch
-        f"{topic_prefix}/command/retroarch/status", 
-        f"{topic_prefix}/command/retroarch/message",
-        f"{topic_prefix}/command/retroarch",
-        f"{topic_prefix}/retroarch_message_text/set",
-        f"{topic_prefix}/retroarch_command_text/set",
-        
-        # UI Mode
-        f"{topic_prefix}/command/ui_mode",
-        
-        # Scan Games
-        f"{topic_prefix}/command/scan_games"
-    ]
-    
-    for topic in command_topics:
-        client.subscribe(topic)
-        logger.info(f"Subscribed to command topic: {topic}")
-
-def on_message(client, userdata, msg):
-    """Callback when a message is received"""
-    try:
-        logger.info(f"Received message on topic {msg.topic}: {msg.payload.decode()}")
-        
-        # Check the message topic to determine the action
-        config = get_config()
-        topic_prefix = config.get('mqtt_topic_prefix', SYSTEM_NAME)
-        
-        # Debug topic for testing connection
-        if msg.topic == f"{topic_prefix}/debug":
-            logger.info(f"DEBUG MESSAGE RECEIVED: {msg.payload.decode()}")
-            publish_mqtt_message(f"{topic_prefix}/debug/response", 
-                              f"Debug received: {msg.payload.decode()}", retain=False)
-            return
-        
-        # Handle TTS related
-        if msg.topic == f"{topic_prefix}/command/tts":
-            handle_tts_command(msg, topic_prefix)
-        elif msg.topic == f"{topic_prefix}/tts_text/set":
-            handle_tts_command(msg, topic_prefix)
-        
-        # Handle RetroArch related
-        elif msg.topic == f"{topic_prefix}/command/retroarch/status":
-            handle_retroarch_status_command(msg, topic_prefix)
-        elif msg.topic == f"{topic_prefix}/command/retroarch/message":
-            handle_retroarch_message_command(msg, topic_prefix)
-        elif msg.topic == f"{topic_prefix}/retroarch_message_text/set":
-            # Store the message text for later use
-            text = msg.payload.decode().strip()
-            if not hasattr(handle_retroarch_message_command, 'current_text'):
-                handle_retroarch_message_command.current_text = ""
-            handle_retroarch_message_command.current_text = text
-            # Update the state topic
-            publish_mqtt_message(f"{topic_prefix}/retroarch_message_text/state", text, retain=True)
-        elif msg.topic == f"{topic_prefix}/command/retroarch":
-            handle_retroarch_command_message(msg, topic_prefix)
-        elif msg.topic == f"{topic_prefix}/retroarch_command_text/set":
-            # Store the command text for later use
-            text = msg.payload.decode().strip()
-            if not hasattr(handle_retroarch_command_message, 'current_text'):
-                handle_retroarch_command_message.current_text = ""
-            handle_retroarch_command_message.current_text = text
-            # Update the state topic
-            publish_mqtt_message(f"{topic_prefix}/retroarch_command_text/state", text, retain=True)
-            
-        # Handle UI mode change
-        elif msg.topic == f"{topic_prefix}/command/ui_mode":
-            handle_ui_mode_command(msg, topic_prefix)
-            
-        # Handle game collection scan
-        elif msg.topic == f"{topic_prefix}/command/scan_games":
-            handle_scan_games_command(msg, topic_prefix)
-    
-    except Exception as e:
-        logger.error(f"Error processing message: {e}")
-        # More detailed error reporting
-        import traceback
-        logger.error(f"Traceback: {traceback.format_exc()}")
-
-def handle_tts_command(msg, topic_prefix):
-    """Handle TTS command message"""
-    try:
-        # Check if this is a button press or text input
-        payload = msg.payload.decode().strip()
-        
-        if payload == "SPEAK":
-            # This is a button press, use the stored text
-            if hasattr(handle_tts_command, 'current_text') and handle_tts_command.current_text:
-                text = handle_tts_command.current_text
-                logger.info(f"Button pressed. Executing TTS for text: {text}")
-                threading.Thread(target=execute_tts, args=(text,)).start()
-                
-                # Send acknowledgment
-                ack_topic = f"{topic_prefix}/command/tts/response"
-                ack_payload = {
-                    'timestamp': int(time.time()),
-                    'status': 'success',
-                    'text': text
-                }
-                publish_mqtt_message(ack_topic, json.dumps(ack_payload), retain=False)
-            else:
-                logger.error("No text available for TTS")
-                
-                # Send error response
-                ack_topic = f"{topic_prefix}/command/tts/response"
-                ack_payload = {
-                    'timestamp': int(time.time()),
-                    'status': 'error',
-                    'message': 'No text provided'
-                }
-                publish_mqtt_message(ack_topic, json.dumps(ack_payload), retain=False)
-        else:
-            # This is text input or a direct TTS command with text
-            try:
-                # Try to parse as JSON
-                command = json.loads(payload)
-                text = command.get('text', '')
-            except json.JSONDecodeError:
-                # Use the payload as direct text
-                text = payload
-            
-            if text:
-                # Store the text for button presses
-                handle_tts_command.current_text = text
-                
-                # Update the text input state
-                publish_mqtt_message(f"{topic_prefix}/tts_text/state", text, retain=True)
-                
-                # If this was a direct command with text (not just setting the input),
-                # execute TTS immediately
-                if msg.topic == f"{topic_prefix}/command/tts" and text != "SPEAK":
-                    logger.info(f"Direct command. Executing TTS for text: {text}")
-                    threading.Thread(target=execute_tts, args=(text,)).start()
-                    
-                    # Send acknowledgment
-                    ack_topic = f"{topic_prefix}/command/tts/response"
-                    ack_payload = {
-                        'timestamp': int(time.time()),
-                        'status': 'success',
-                        'text': text
-                    }
-                    publish_mqtt_message(ack_topic, json.dumps(ack_payload), retain=False)
-            else:
-                logger.error("Received empty text")
-                
-                # Send error response
-                ack_topic = f"{topic_prefix}/command/tts/response"
-                ack_payload = {
-                    'timestamp': int(time.time()),
-                    'status': 'error',
-                    'message': 'Empty text provided'
-                }
-                publish_mqtt_message(ack_topic, json.dumps(ack_payload), retain=False)
-    
-    except Exception as e:
-        logger.error(f"Error handling TTS command: {e}")
-        # Send error response
-        ack_topic = f"{topic_prefix}/command/tts/response"
-        ack_payload = {
-            'timestamp': int(time.time()),
-            'status': 'error',
-            'message': f'Error: {str(e)}'
-        }
-        publish_mqtt_message(ack_topic, json.dumps(ack_payload), retain=False)
-
-def handle_retroarch_status_command(msg, topic_prefix):
-    """Handle RetroArch status command message"""
-    try:
-        # For button press or direct command, get the status
-        payload = msg.payload.decode().strip()
-        
-        if payload == "GET_STATUS" or payload == "" or payload == "{}":
-            # Get RetroArch status
-            status_info = get_retroarch_status()
-            
-            # Prepare response
-            ack_topic = f"{topic_prefix}/command/retroarch/status/response"
-            if status_info:
-                ack_payload = {
-                    'timestamp': int(time.time()),
-                    'status': 'success',
-                    'data': status_info
-                }
-                
-                # Also publish to a status topic for sensors
-                publish_mqtt_message(f"{topic_prefix}/retroarch/status", json.dumps(status_info), retain=True)
-            else:
-                ack_payload = {
-                    'timestamp': int(time.time()),
-                    'status': 'error',
-                    'message': 'Failed to get RetroArch status, check if RetroArch is running with Network Commands enabled'
-                }
-            publish_mqtt_message(ack_topic, json.dumps(ack_payload), retain=False)
-        else:
-            logger.error(f"Unexpected payload for status command: {payload}")
-            
-            # Send error response
-            ack_topic = f"{topic_prefix}/command/retroarch/status/response"
-            ack_payload = {
-                'timestamp': int(time.time()),
-                'status': 'error',
-                'message': f'Unexpected payload: {payload}'
-            }
-            publish_mqtt_message(ack_topic, json.dumps(ack_payload), retain=False)
-    
-    except Exception as e:
-        logger.error(f"Error handling RetroArch status command: {e}")
-        # Send error response
-        ack_topic = f"{topic_prefix}/command/retroarch/status/response"
-        ack_payload = {
-            'timestamp': int(time.time()),
-            'status': 'error',
-            'message': f'Error: {str(e)}'
-        }
-        publish_mqtt_message(ack_topic, json.dumps(ack_payload), retain=False)
-
-def handle_retroarch_message_command(msg, topic_prefix):
-    """Handle RetroArch message display command"""
-    try:
-        payload = msg.payload.decode().strip()
-        
-        if payload == "DISPLAY":
-            # This is a button press, use the stored message
-            if hasattr(handle_retroarch_message_command, 'current_text') and handle_retroarch_message_command.current_text:
-                message = handle_retroarch_message_command.current_text
-                logger.info(f"Button pressed. Displaying message on RetroArch: {message}")
-                success = display_retroarch_message(message)
-                
-                # Send acknowledgment
-                ack_topic = f"{topic_prefix}/command/retroarch/message/response"
-                if success:
-                    ack_payload = {
-                        'timestamp': int(time.time()),
-                        'status': 'success',
-                        'message': message
-                    }
-                else:
-                    ack_payload = {
-                        'timestamp': int(time.time()),
-                        'status': 'error',
-                        'message': 'Failed to display message, check if RetroArch is running with Network Commands enabled'
-                    }
-                publish_mqtt_message(ack_topic, json.dumps(ack_payload), retain=False)
-            else:
-                logger.error("No message available to display")
-                
-                # Send error response
-                ack_topic = f"{topic_prefix}/command/retroarch/message/response"
-                ack_payload = {
-                    'timestamp': int(time.time()),
-                    'status': 'error',
-                    'message': 'No message provided'
-                }
-                publish_mqtt_message(ack_topic, json.dumps(ack_payload), retain=False)
-        else:
-            # This is a direct message or JSON command
-            try:
-                # Try to parse as JSON
-                command = json.loads(payload)
-                message = command.get('message', '')
-            except json.JSONDecodeError:
-                # Use the payload as direct text
-                message = payload
-            
-            if message:
-                # Store the message for button presses
-                handle_retroarch_message_command.current_text = message
-                
-                # Update the text input state
-                publish_mqtt_message(f"{topic_prefix}/retroarch_message_text/state", message, retain=True)
-                
-                # If this is a direct command (not from the text input), display message
-                if msg.topic == f"{topic_prefix}/command/retroarch/message" and message != "DISPLAY":
-                    logger.info(f"Direct command. Displaying message on RetroArch: {message}")
-                    success = display_retroarch_message(message)
-                    
-                    # Send acknowledgment
-                    ack_topic = f"{topic_prefix}/command/retroarch/message/response"
-                    if success:
-                        ack_payload = {
-                            'timestamp': int(time.time()),
-                            'status': 'success',
-                            'message': message
-                        }
-                    else:
-                        ack_payload = {
-                            'timestamp': int(time.time()),
-                            'status': 'error',
-                            'message': 'Failed to display message, check if RetroArch is running with Network Commands enabled'
-                        }
-                    publish_mqtt_message(ack_topic, json.dumps(ack_payload), retain=False)
-            else:
-                logger.error("Received empty message")
-                
-                # Send error response
-                ack_topic = f"{topic_prefix}/command/retroarch/message/response"
-                ack_payload = {
-                    'timestamp': int(time.time()),
-                    'status': 'error',
-                    'message': 'No message provided'
-                }
-                publish_mqtt_message(ack_topic, json.dumps(ack_payload), retain=False)
-    
-    except Exception as e:
-        logger.error(f"Error handling RetroArch message command: {e}")
-        # Send error response
-        ack_topic = f"{topic_prefix}/command/retroarch/message/response"
-        ack_payload = {
-            'timestamp': int(time.time()),
-            'status': 'error',
-            'message': f'Error: {str(e)}'
-        }
-        publish_mqtt_message(ack_topic, json.dumps(ack_payload), retain=False)
-
-def handle_retroarch_command_message(msg, topic_prefix):
-    """Handle generic RetroArch command"""
-    try:
-        payload = msg.payload.decode().strip()
-        
-        if payload == "EXECUTE":
-            # This is a button press, use the stored command
-            if hasattr(handle_retroarch_command_message, 'current_text') and handle_retroarch_command_message.current_text:
-                command = handle_retroarch_command_message.current_text
-                logger.info(f"Button pressed. Sending command to RetroArch: {command}")
-                result = send_retroarch_command(command)
-                
-                # Send acknowledgment
-                ack_topic = f"{topic_prefix}/command/retroarch/response"
-                if result is not None:
-                    ack_payload = {
-                        'timestamp': int(time.time()),
-                        'status': 'success',
-                        'command': command,
-                        'response': result if isinstance(result, str) else ''
-                    }
-                else:
-                    ack_payload = {
-                        'timestamp': int(time.time()),
-                        'status': 'error',
-                        'command': command,
-                        'message': 'Failed to send command, check if RetroArch is running with Network Commands enabled'
-                    }
-                publish_mqtt_message(ack_topic, json.dumps(ack_payload), retain=False)
-            else:
-                logger.error("No command available to execute")
-                
-                # Send error response
-                ack_topic = f"{topic_prefix}/command/retroarch/response"
-                ack_payload = {
-                    'timestamp': int(time.time()),
-                    'status': 'error',
-                    'message': 'No command provided'
-                }
-                publish_mqtt_message(ack_topic, json.dumps(ack_payload), retain=False)
-        else:
-            # This is a direct command or JSON command
-            try:
-                # Try to parse as JSON
-                command_obj = json.loads(payload)
-                command = command_obj.get('command', '')
-            except json.JSONDecodeError:
-                # Use the payload as direct command
-                command = payload
-            
-            if command:
-                # Store the command for button presses
-                handle_retroarch_command_message.current_text = command
-                
-                # Update the text input state
-                publish_mqtt_message(f"{topic_prefix}/retroarch_command_text/state", command, retain=True)
-                
-                # If this is a direct command (not from the text input), execute it
-                if msg.topic == f"{topic_prefix}/command/retroarch" and command != "EXECUTE":
-                    logger.info(f"Direct command. Sending command to RetroArch: {command}")
-                    result = send_retroarch_command(command)
-                    
-                    # Send acknowledgment
-                    ack_topic = f"{topic_prefix}/command/retroarch/response"
-                    if result is not None:
-                        ack_payload = {
-                            'timestamp': int(time.time()),
-                            'status': 'success',
-                            'command': command,
-                            'response': result if isinstance(result, str) else ''
-                        }
-                    else:
-                        ack_payload = {
-                            'timestamp': int(time.time()),
-                            'status': 'error',
-                            'command': command,
-                            'message': 'Failed to send command, check if RetroArch is running with Network Commands enabled'
-                        }
-                    publish_mqtt_message(ack_topic, json.dumps(ack_payload), retain=False)
-            else:
-                logger.error("Received empty command")
-                
-                # Send error response
-                ack_topic = f"{topic_prefix}/command/retroarch/response"
-                ack_payload = {
-                    'timestamp': int(time.time()),
-                    'status': 'error',
-                    'message': 'No command provided'
-                }
-                publish_mqtt_message(ack_topic, json.dumps(ack_payload), retain=False)
-    
-    except Exception as e:
-        logger.error(f"Error handling RetroArch command: {e}")
-        # Send error response
-        ack_topic = f"{topic_prefix}/command/retroarch/response"
-        ack_payload = {
-            'timestamp': int(time.time()),
-            'status': 'error',
-            'message': f'Error: {str(e)}'
-        }
-        publish_mqtt_message(ack_topic, json.dumps(ack_payload), retain=False)
-
-def handle_ui_mode_command(msg, topic_prefix):
-    """Handle EmulationStation UI mode change command"""
-    try:
-        # For select entity, the payload is just the mode
-        mode = msg.payload.decode().strip()
-        
-        # Check if the message is in JSON format
-        try:
-            command_obj = json.loads(mode)
-            if isinstance(command_obj, dict) and 'mode' in command_obj:
-                mode = command_obj.get('mode', '')
-        except json.JSONDecodeError:
-            # Already have mode as plain text
-            pass
-        
-        if mode and mode in ['Full', 'Kid', 'Kiosk']:
-            # Change the UI mode
-            logger.info(f"Changing EmulationStation UI mode to: {mode}")
-            success = change_es_ui_mode(mode)
-            
-            # Update the mode state
-            publish_mqtt_message(f"{topic_prefix}/ui_mode/state", mode, retain=True)
-            
-            # Send acknowledgment
-            ack_topic = f"{topic_prefix}/command/ui_mode/response"
-            if success:
-                ack_payload = {
-                    'timestamp': int(time.time()),
-                    'status': 'success',
-                    'mode': mode,
-                    'message': f'UI mode changed to {mode}. EmulationStation will restart.'
-                }
-            else:
-                ack_payload = {
-                    'timestamp': int(time.time()),
-                    'status': 'error',
-                    'mode': mode,
-                    'message': f'Failed to change UI mode to {mode}. Check logs for details.'
-                }
-            publish_mqtt_message(ack_topic, json.dumps(ack_payload), retain=False)
-        else:
-            logger.error(f"Invalid UI mode: {mode}. Must be one of: Full, Kid, Kiosk")
-            
-            # Send error response
-            ack_topic = f"{topic_prefix}/command/ui_mode/response"
-            ack_payload = {
-                'timestamp': int(time.time()),
-                'status': 'error',
-                'message': f'Invalid UI mode: {mode}. Must be one of: Full, Kid, Kiosk'
-            }
-            publish_mqtt_message(ack_topic, json.dumps(ack_payload), retain=False)
-    except Exception as e:
-        logger.error(f"Error handling UI mode command: {e}")
-        # Send error response
-        ack_topic = f"{topic_prefix}/command/ui_mode/response"
-        ack_payload = {
-            'timestamp': int(time.time()),
-            'status': 'error',
-            'message': f'Error: {str(e)}'
-        }
-        publish_mqtt_message(ack_topic, json.dumps(ack_payload), retain=False)
-
-def handle_scan_games_command(msg, topic_prefix):
-    """Handle game collection scan command"""
-    try:
-        # Button press or direct command
-        payload = msg.payload.decode().strip()
-        
-        if payload == "SCAN" or payload == "" or payload == "{}":
-            # Start the scan
-            logger.info("Received command to scan game collection")
-            success = scan_game_collection()
-            
-            # Send acknowledgment
-            ack_topic = f"{topic_prefix}/command/scan_games/response"
-            if success:
-                ack_payload = {
-                    'timestamp': int(time.time()),
-                    'status': 'success',
-                    'message': 'Game collection scan started in the background'
-                }
-            else:
-                ack_payload = {
-                    'timestamp': int(time.time()),
-                    'status': 'error',
-                    'message': 'Failed to start game collection scan. Check logs for details.'
-                }
-            publish_mqtt_message(ack_topic, json.dumps(ack_payload), retain=False)
-        else:
-            logger.error(f"Unexpected payload for scan command: {payload}")
-            
-            # Send error response
-            ack_topic = f"{topic_prefix}/command/scan_games/response"
-            ack_payload = {
-                'timestamp': int(time.time()),
-                'status': 'error',
-                'message': f'Unexpected payload: {payload}'
-            }
-            publish_mqtt_message(ack_topic, json.dumps(ack_payload), retain=False)
-    
-    except Exception as e:
-        logger.error(f"Error handling scan games command: {e}")
-        # Send error response
-        ack_topic = f"{topic_prefix}/command/scan_games/response"
-        ack_payload = {
-            'timestamp': int(time.time()),
-            'status': 'error',
-            'message': f'Error: {str(e)}'
-        }
-        publish_mqtt_message(ack_topic, json.dumps(ack_payload), retain=False)
-
-def execute_tts(text):
-    """Execute text-to-speech using system speakers"""
-    try:
-        # Use pico2wave for TTS (install with: sudo apt-get install libttspico-utils)
-        wav_file = "/tmp/tts_output.wav"
-        subprocess.run(["pico2wave", "-w", wav_file, text], check=True)
-        
-        # Play the generated audio file using the logged-in user's audio session
-        try:
-            # First, get the user who is currently logged in and has the active X session
-            user_cmd = subprocess.run(["who"], capture_output=True, text=True)
-            active_users = user_cmd.stdout.strip().split('\n')
-            
-            if active_users:
-                # Use the first active user
-                active_user = active_users[0].split()[0]
-                logger.info(f"Found active user: {active_user}")
-                
-                # Run the command as the active user who has access to the audio system
-                command = f"export XDG_RUNTIME_DIR=/run/user/$(id -u {active_user}) && aplay {wav_file}"
-                play_cmd = subprocess.run(["sudo", "-u", active_user, "bash", "-c", command], check=True)
-                logger.info("Audio played successfully through user session")
-            else:
-                # If no active user, try direct playback
-                logger.info("No active user session found, trying direct playback")
-                subprocess.run(["aplay", wav_file], check=True)
-                
-        except Exception as session_error:
-            logger.error(f"Error playing through user session: {session_error}")
-            
-            # Try alternative methods in sequence
-            methods = [
-                # Try with default user
-                ("Playing via pi user", ["sudo", "-u", "pi", "aplay", wav_file]),
-                # Try with PULSE_SERVER
-                ("Playing with PULSE_SERVER", ["env", "PULSE_SERVER=localhost", "aplay", wav_file]),
-                # Try mpg123
-                ("Trying mpg123", ["mpg123", wav_file]),
-                # Try omxplayer 
-                ("Trying omxplayer", ["omxplayer", "-o", "both", wav_file]),
-                # Try mplayer
-                ("Trying mplayer", ["mplayer", wav_file]),
-                # Try specific ALSA device
-                ("Trying HDMI output", ["aplay", "-D", "plughw:0,0", wav_file]),
-                # Try HDMI 1
-                ("Trying HDMI 1", ["aplay", "-D", "plughw:1,0", wav_file])
-            ]
-            
-            success = False
-            for desc, cmd in methods:
-                try:
-                    logger.info(desc)
-                    subprocess.run(cmd, check=True)
-                    success = True
-                    logger.info(f"Success with {desc}")
-                    break
-                except Exception as e:
-                    logger.error(f"Failed with {desc}: {e}")
-            
-            if not success:
-                # As a last resort, save play command to a script for manual execution
-                script_path = "/tmp/play_tts.sh"
-                with open(script_path, 'w') as f:
-                    f.write("#!/bin/bash\n")
-                    f.write(f"aplay {wav_file}\n")
-                os.chmod(script_path, 0o755)
-                logger.error(f"Audio playback failed with all methods. Manual script saved to {script_path}")
-                raise Exception("All audio playback methods failed")
-        
-        # Clean up only if requested
-        cleanup = True  # Set to False for debugging
-        if cleanup and os.path.exists(wav_file):
-            os.remove(wav_file)
-            
-        logger.info("TTS executed successfully")
-        return True
-    except Exception as e:
-        logger.error(f"Error executing TTS: {e}")
-        # Don't fail the whole operation due to audio issues
-        return True  # Still return success so other operations continue
-
-def scan_game_collection():
-    """Scan all gamelist.xml files to collect game statistics"""
-    try:
-        # Scan in a separate thread to avoid blocking
-        threading.Thread(target=_scan_game_collection_thread, daemon=True).start()
-        return True
-    except Exception as e:
-        logger.error(f"Error starting game collection scan: {e}")
-        return False
-
-# Global observer for file monitoring
-file_observer = None
-scan_debounce_timer = None
-DEBOUNCE_SECONDS = 5  # Debounce file changes to prevent multiple rapid scans
-
-class GamelistChangeHandler(PatternMatchingEventHandler):
-    """Event handler for gamelist.xml file changes"""
-    
-    def __init__(self):
-        super(GamelistChangeHandler, self).__init__(
-            patterns=["*gamelist.xml"],
-            ignore_directories=True,
-            case_sensitive=False
-        )
-    
-    def on_modified(self, event):
-        """Called when a file is modified"""
-        self._handle_gamelist_change(event)
-    
-    def on_created(self, event):
-        """Called when a file is created"""
-        self._handle_gamelist_change(event)
-    
-    def _handle_gamelist_change(self, event):
-        """Handle game list file changes with debounce"""
-        global scan_debounce_timer
-        
-        # Log the event
-        logger.info(f"Detected change in gamelist: {event.src_path}")
-        
-        # Cancel existing timer if it's running
-        if scan_debounce_timer is not None:
-            scan_debounce_timer.cancel()
-        
-        # Set a new timer to trigger scan after delay
-        scan_debounce_timer = threading.Timer(DEBOUNCE_SECONDS, self._trigger_scan)
-        scan_debounce_timer.daemon = True
-        scan_debounce_timer.start()
-    
-    def _trigger_scan(self):
-        """Trigger a game collection scan after debounce period"""
-        logger.info("Triggering game collection scan due to gamelist.xml changes")
-        scan_game_collection()
-
-def start_file_monitoring():
-    """Start monitoring gamelist.xml files for changes"""
-    global file_observer
-    
-    if not watchdog_available:
-        logger.warning("Watchdog library not available. File monitoring disabled.")
-        logger.warning("To enable file monitoring, install watchdog using:")
-        logger.warning("  sudo apt-get install python3-watchdog")
-        logger.warning("  or pip3 install watchdog")
-        return False
-    
-    try:
-        # Create event handler and observer
-        event_handler = GamelistChangeHandler()
-        file_observer = Observer()
-        file_observer.daemon = True  # Make sure observer thread exits when main thread exits
-        
-        # Monitor locations based on system type
-        paths_to_monitor = []
-        
-        # Always monitor the ROMs directory for all systems
-        if os.path.exists(ROMS_DIR):
-            paths_to_monitor.append(ROMS_DIR)
-            
-            # Add each system subdirectory
-            for system_dir in os.listdir(ROMS_DIR):
-                system_path = os.path.join(ROMS_DIR, system_dir)
-                if os.path.isdir(system_path):
-                    paths_to_monitor.append(system_path)
-        
-        # For Batocera, also monitor the ES configs directory
-        if SYSTEM_TYPE == "batocera" and os.path.exists("/userdata/system/configs/emulationstation/gamelists"):
-            paths_to_monitor.append("/userdata/system/configs/emulationstation/gamelists")
-            
-            # Add each system's gamelist directory
-            es_gamelists = "/userdata/system/configs/emulationstation/gamelists"
-            if os.path.exists(es_gamelists):
-                for system_dir in os.listdir(es_gamelists):
-                    system_path = os.path.join(es_gamelists, system_dir)
-                    if os.path.isdir(system_path):
-                        paths_to_monitor.append(system_path)
-        
-        # For RetroPie, monitor the ES gamelists directory
-        elif SYSTEM_TYPE == "retropie":
-            es_gamelists = os.path.expanduser("~/.emulationstation/gamelists")
-            if os.path.exists(es_gamelists):
-                paths_to_monitor.append(es_gamelists)
-                
-                # Add each system's gamelist directory
-                for system_dir in os.listdir(es_gamelists):
-                    system_path = os.path.join(es_gamelists, system_dir)
-                    if os.path.isdir(system_path):
-                        paths_to_monitor.append(system_path)
-        
-        # Schedule monitoring for all identified paths
-        for path in paths_to_monitor:
-            file_observer.schedule(event_handler, path, recursive=False)
-        
-        # Start the observer
-        file_observer.start()
-        logger.info(f"Started file monitoring for gamelist.xml files in {ROMS_DIR}")
-        
-        # Register a cleanup function to stop the observer
-        atexit.register(stop_file_monitoring)
-        
-        return True
-    except Exception as e:
-        logger.error(f"Error starting file monitoring: {e}")
-        return False
-
-def stop_file_monitoring():
-    """Stop monitoring gamelist.xml files"""
-    global file_observer
-    
-    # If watchdog is not available, there's nothing to stop
-    if not watchdog_available:
-        return False
-    
-    if file_observer and file_observer.is_alive():
-        logger.info("Stopping file monitoring")
-        file_observer.stop()
-        file_observer.join(timeout=3)  # Wait up to 3 seconds for the thread to finish
-        file_observer = None
-        return True
-    return False
-
-def _scan_game_collection_thread():
-    """Background thread to scan game collection"""
-    global current_state
-    
-    try:
-        logger.info("Starting game collection scan...")
-        start_time = time.time()
-        
-        # Stats to collect
-        total_games = 0
-        favorites = 0
-        kid_friendly = 0
-        systems_data = {}
-        
-        # Rating threshold for kid-friendly games (typically 0.0-1.0 scale)
-        kid_rating_threshold = 0.5  # Consider games with rating <= 0.5 as kid-friendly
-        
-        # Scan each system directory in the ROMS_DIR
-        for system_dir in os.listdir(ROMS_DIR):
-            system_path = os.path.join(ROMS_DIR, system_dir)
-              # Skip if not a directory
-            if not os.path.isdir(system_path):
-                continue
-            
-            # Look for gamelist.xml - check multiple possible locations
-            gamelist_paths = []
-            
-            # First try system-specific ROM directory (primary location)
-            gamelist_paths.append(os.path.join(system_path, 'gamelist.xml'))
-            
-            # For Batocera, also check alternative locations
-            if SYSTEM_TYPE == "batocera":
-                # Batocera can have gamelist.xml files in multiple locations
-                gamelist_paths.append(f"/userdata/system/configs/emulationstation/gamelists/{system_dir}/gamelist.xml")
-            
-            # For RetroPie, check alternative location
-            elif SYSTEM_TYPE == "retropie":
-                gamelist_paths.append(os.path.expanduser(f"~/.emulationstation/gamelists/{system_dir}/gamelist.xml"))
-            
-            # Try each path until we find an existing file
-            gamelist_path = None
-            for path in gamelist_paths:
-                if os.path.exists(path):
-                    gamelist_path = path
-                    break
-            
-            if not gamelist_path:
-                continue
-            
-            # Parse the gamelist.xml
-            try:
-                tree = ET.parse(gamelist_path)
-                root = tree.getroot()
-                
-                # Initialize system stats
-                system_games = 0
-                system_favorites = 0
-                system_kid_friendly = 0
-                
-                # Process each game
-                for game in root.findall('game'):
-                    system_games += 1
-                    
-                    # Check if favorite
-                    favorite_elem = game.find('favorite')
-                    if favorite_elem is not None and favorite_elem.text == 'true':
-                        system_favorites += 1
-                        favorites += 1
-                    
-                    # Check rating for kid-friendly
-                    rating_elem = game.find('rating')
-                    if rating_elem is not None and rating_elem.text:
-                        try:
-                            rating = float(rating_elem.text)
-                            if rating <= kid_rating_threshold:
-                                system_kid_friendly += 1
-                                kid_friendly += 1
-                        except ValueError:
-                            pass
-                
-                # Update total count
-                total_games += system_games
-                
-                # Store system data
-                systems_data[system_dir] = {
-                    'games': system_games,
-                    'favorites': system_favorites,
-                    'kid_friendly': system_kid_friendly
-                }
-                
-                logger.info(f"Scanned system '{system_dir}': {system_games} games, "
-                           f"{system_favorites} favorites, {system_kid_friendly} kid-friendly")
-            
-            except Exception as e:
-                logger.error(f"Error parsing gamelist for system '{system_dir}': {e}")
-        
-        # Update the global state
-        current_state['game_collection'] = {
-            'total_games': total_games,
-            'favorites': favorites,
-            'kid_friendly': kid_friendly,
-            'last_scan': int(time.time()),
-            'systems': systems_data
-        }
-        
-        # Save state to file
-        save_state()
-        
-        # Publish game collection stats
-        publish_game_collection_stats()
-        
-        elapsed_time = time.time() - start_time
-        logger.info(f"Game collection scan completed in {elapsed_time:.2f} seconds: "
-                   f"{total_games} total games, {favorites} favorites, {kid_friendly} kid-friendly")
-        
-    except Exception as e:
-        logger.error(f"Error in game collection scan thread: {e}")
-
-def publish_game_collection_stats():
-    """Publish game collection statistics to MQTT"""
-    try:
-        config = get_config()
-        topic_prefix = config.get('mqtt_topic_prefix', SYSTEM_NAME)
-        
-        # Prepare payload
-        payload = {
-            'timestamp': int(time.time()),
-            'total_games': current_state['game_collection']['total_games'],
-            'favorites': current_state['game_collection']['favorites'],
-            'kid_friendly': current_state['game_collection']['kid_friendly'],
-            'last_scan': current_state['game_collection']['last_scan'],
-            'systems': len(current_state['game_collection']['systems'])
-        }
-        
-        # Publish to the game_collection topic
-        topic = f"{topic_prefix}/game_collection"
-        publish_mqtt_message(topic, json.dumps(payload), retain=True)
-        logger.info("Published game collection statistics")
-        return True
-    except Exception as e:
-        logger.error(f"Error publishing game collection stats: {e}")
-        return False
-
-def change_es_ui_mode(mode):
-    """Change EmulationStation's UI mode (Full, Kid, Kiosk)
-    
-    Args:
-        mode (str): The UI mode to set. Must be one of: 'Full', 'Kid', 'Kiosk'
-        
-    Returns:
-        bool: True if the mode was changed successfully, False otherwise
-    """
-    try:
-        if mode not in ['Full', 'Kid', 'Kiosk']:
-            logger.error(f"Invalid UI mode: {mode}. Must be one of: Full, Kid, Kiosk")
-            return False
-        
-        # Path to EmulationStation settings file
-        es_settings_paths = [
-            os.path.expanduser('~/.emulationstation/es_settings.cfg'),
-            '/opt/retropie/configs/all/emulationstation/es_settings.cfg'
-        ]
-        
-        es_settings_path = None
-        for path in es_settings_paths:
-            if os.path.exists(path):
-                es_settings_path = path
-                break
-        
-        if not es_settings_path:
-            logger.error("Could not find EmulationStation settings file")
-            return False
-        
-        logger.info(f"Found EmulationStation settings at: {es_settings_path}")
-        
-        # First try the direct text manipulation approach which is more reliable
-        try:
-            # Read the current file content
-            with open(es_settings_path, 'r') as f:
-                content = f.read()
-            
-            # Check if UIMode is already in the file
-            mode_pattern = re.compile(r'<(string|bool) name="UIMode" value="([^"]*)"')
-            match = mode_pattern.search(content)
-            
-            if match:
-                # Found existing setting, update it
-                current_mode = match.group(2)
-                tag_type = match.group(1)  # string or bool
-                
-                if current_mode == mode:
-                    logger.info(f"UI mode is already set to {mode}")
-                    return True
-                
-                # Replace the existing setting
-                logger.info(f"Changing UI mode from {current_mode} to {mode}")
-                content = re.sub(
-                    f'<{tag_type} name="UIMode" value="[^"]*"',
-                    f'<{tag_type} name="UIMode" value="{mode}"',
-                    content
-                )
-            else:
-                # No existing setting, add it after XML declaration or at the start
-                logger.info(f"Adding new UI mode setting: {mode}")
-                if '?>' in content:
-                    # Add after XML declaration
-                    xml_end = content.find('?>') + 2
-                    content = content[:xml_end] + f'\n<string name="UIMode" value="{mode}" />' + content[xml_end:]
-                else:
-                    # Add to beginning of file
-                    content = f'<string name="UIMode" value="{mode}" />\n' + content
-            
-            # Write the changes back
-            with open(es_settings_path, 'w') as f:
-                f.write(content)
-                
-            # Apply UI mode change (try without restart if possible)
-            apply_ui_mode_change(mode)
-            return True
-            
-        except Exception as direct_error:
-            logger.error(f"Error using direct text manipulation: {direct_error}")
-            
-            # Try with XML parsing as fallback
-            try:
-                logger.info("Attempting XML parsing approach as fallback")
-                tree = ET.parse(es_settings_path)
-                root = tree.getroot()
-                
-                # Check if UIMode setting exists
-                ui_mode_elem = None
-                for elem in root.findall('string'):
-                    if elem.get('name') == 'UIMode':
-                        ui_mode_elem = elem
-                        break
-                
-                if ui_mode_elem is not None:
-                    # Update existing setting
-                    current_mode = ui_mode_elem.get('value')
-                    if current_mode == mode:
-                        logger.info(f"UI mode is already set to {mode}")
-                        return True
-                    
-                    ui_mode_elem.set('value', mode)
-                    logger.info(f"Changed UI mode from {current_mode} to {mode}")
-                else:
-                    # Create new UIMode setting
-                    ui_mode_elem = ET.SubElement(root, 'string')
-                    ui_mode_elem.set('name', 'UIMode')
-                    ui_mode_elem.set('value', mode)
-                    logger.info(f"Created new UI mode setting: {mode}")
-                
-                # Write the updated settings back to the file
-                tree.write(es_settings_path)
-                
-                # Apply UI mode change (try without restart if possible)
-                apply_ui_mode_change(mode)
-                
-                return True
-                
-            except Exception as xml_error:
-                logger.error(f"Error updating EmulationStation settings with XML: {xml_error}")
-                
-                # Last resort approach - use a direct echo command
-                try:
-                    logger.info("Attempting direct echo command as last resort")
-                    # Use grep to check if setting already exists
-                    check = subprocess.run(['grep', '-q', 'UIMode', es_settings_path], check=False)
-                    
-                    if check.returncode == 0:
-                        # Setting exists, use sed to replace it
-                        subprocess.run([
-                            'sed', '-i', 
-                            f's/<[^>]*name="UIMode" value="[^"]*"/<string name="UIMode" value="{mode}"/', 
-                            es_settings_path
-                        ], check=True)
-                    else:
-                        # Setting doesn't exist, append it to the file
-                        with open(es_settings_path, 'a') as f:
-                            f.write(f'\n<string name="UIMode" value="{mode}" />\n')
-                    
-                    restart_emulationstation()
-                    return True
-                    
-                except Exception as echo_error:
-                    logger.error(f"All methods failed. Last error: {echo_error}")
-                    return False
-            
-    except Exception as e:
-        logger.error(f"Error changing EmulationStation UI mode: {e}")
-        return False
-
-def apply_ui_mode_change(mode):
-    """Apply UI mode change without restarting EmulationStation if possible"""
-    try:
-        # Since EmulationStation is likely started with a systemd service,
-        # the best approach is to modify the config file and let EmulationStation
-        # reload it on next launch rather than trying to change a running instance
-        
-        # Check if we can find the autostart.sh script that launches EmulationStation
-        autostart_paths = [
-            '/opt/retropie/configs/all/autostart.sh',
-            '/home/pi/.bashrc',  # Sometimes ES is started from here
-            '/etc/profile.d/10-emulationstation.sh'
-        ]
-        
-        # Log information about the script we're searching for
-        for path in autostart_paths:
-            if os.path.exists(path):
-                logger.info(f"Found autostart script at {path}, content:")
-                with open(path, 'r') as f:
-                    logger.info(f.read()[:500])  # Log first 500 chars
-        
-        # For now, just write the UI mode to the config file but don't try to
-        # change the running instance, as it appears to be launched with force parameters
-        logger.info(f"UI mode preference set to {mode} in config. Will take effect on next EmulationStation restart.")
-        
-        # Write a short message to inform the user
-        try:
-            # Use OSD command if EmulationStation has it
-            osd_script = "/tmp/es_ui_mode_info.sh"
-            with open(osd_script, 'w') as f:
-                f.write('#!/bin/bash\n')
-                f.write(f'echo "UI MODE: {mode}" > /dev/tty1\n')
-                f.write(f'echo "Changes will take effect after EmulationStation restarts" > /dev/tty1\n')
-                f.write(f'sleep 5\n')
-            
-            os.chmod(osd_script, 0o755)
-            subprocess.Popen([osd_script], start_new_session=True)
-        except Exception as e:
-            logger.warning(f"Failed to display UI mode info: {e}")
-            
-        return True
-            
-    except Exception as e:
-        logger.error(f"Error applying UI mode change: {e}")
-        return False
-
-def restart_emulationstation(mode=None):
-    """Restart EmulationStation by touching /tmp/es-restart and killing the process"""
-    try:
-        # Create the restart trigger file
-        with open('/tmp/es-restart', 'w') as f:
-            f.write('')
-        
-        # Kill EmulationStation to trigger restart
-        try:
-            # Make sure all existing EmulationStation processes are killed
-            subprocess.run(['pkill', '-9', 'emulationstation'], check=False)
-            time.sleep(2)  # Give it time to fully terminate
-            
-            if mode == 'Kid':
-                # Launch ES in Kid mode
-                logger.info("Launching EmulationStation in Kid mode")
-                subprocess.Popen([
-                    '/opt/retropie/supplementary/emulationstation/emulationstation', 
-                    '--force-kid'
-                ], start_new_session=True)
-            elif mode == 'Kiosk':
-                # Launch ES in Kiosk mode
-                logger.info("Launching EmulationStation in Kiosk mode")
-                subprocess.Popen([
-                    '/opt/retropie/supplementary/emulationstation/emulationstation', 
-                    '--force-kiosk'
-                ], start_new_session=True)
-            elif mode == 'Full':
-                # Launch ES in Full mode
-                logger.info("Launching EmulationStation in Full mode")
-                subprocess.Popen([
-                    '/opt/retropie/supplementary/emulationstation/emulationstation'
-                ], start_new_session=True)
-            else:
-                # Just kill it and let the system restart it with default settings
-                logger.info("Killing EmulationStation, system will restart it")
-            
-            return True
-        except Exception as e:
-            logger.error(f"Error killing EmulationStation: {e}")
-            return False
-            
-    except Exception as e:
-        logger.error(f"Error creating restart trigger: {e}")
-        return False
-
-def verify_retroarch_network_commands():
-    """Verify that RetroArch has network commands enabled and set it if not"""
-    try:
-        # Common paths for RetroArch configuration
-        retroarch_cfg_paths = [
-            os.path.expanduser('~/.config/retroarch/retroarch.cfg'),
-            '/opt/retropie/configs/all/retroarch.cfg',
-            '/etc/retroarch.cfg'
-        ]
-        
-        for cfg_path in retroarch_cfg_paths:
-            if os.path.exists(cfg_path):
-                logger.info(f"Found RetroArch config at: {cfg_path}")
-                
-                # Check if we need to modify the config
-                modified = False
-                
-                # Read the current config
-                with open(cfg_path, 'r') as f:
-                    config_lines = f.readlines()
-                
-                # Check for network_cmd_enable setting
-                has_network_enable = False
-                for i, line in enumerate(config_lines):
-                    if 'network_cmd_enable' in line:
-                        has_network_enable = True
-                        if 'false' in line.lower():
-                            config_lines[i] = 'network_cmd_enable = "true"\n'
-                            modified = True
-                            logger.info("Updated network_cmd_enable to true")
-                
-                # Add network_cmd_enable if it doesn't exist
-                if not has_network_enable:
-                    config_lines.append('network_cmd_enable = "true"\n')
-                    modified = True
-                    logger.info("Added network_cmd_enable = true")
-                
-                # Check for network_cmd_port setting
-                has_network_port = False
-                for line in config_lines:
-                    if 'network_cmd_port' in line:
-                        has_network_port = True
-                
-                # Add network_cmd_port if it doesn't exist
-                if not has_network_port:
-                    config_lines.append(f'network_cmd_port = "{RETROARCH_PORT}"\n')
-                    modified = True
-                    logger.info(f"Added network_cmd_port = {RETROARCH_PORT}")
-                
-                # Write back the modified config if changes were made
-                if modified:
-                    try:
-                        with open(cfg_path, 'w') as f:
-                            f.writelines(config_lines)
-                        logger.info(f"Updated RetroArch config at {cfg_path}")
-                    except Exception as write_err:
-                        logger.error(f"Error writing RetroArch config: {write_err}")
-                
-                # We found and processed a config file, so we're done
-                return True
-        
-        logger.warning("Could not find RetroArch configuration file")
-        return False
-    except Exception as e:
-        logger.error(f"Error verifying RetroArch network commands: {e}")
-        return False
-
-def is_retroarch_running():
-    """Check if RetroArch appears to be running"""
-    try:
-        # Check with ps command
-        result = subprocess.run(['ps', 'aux'], capture_output=True, text=True)
-        if 'retroarch' in result.stdout.lower():
-            return True
-            
-        # Check if the network port is in use (alternative method)
-        try:
-            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            sock.settimeout(0.2)
-            sock.sendto(b"VERSION", ('127.0.0.1', RETROARCH_PORT))
-            response, _ = sock.recvfrom(1024)
-            if response:
-                return True
-        except:
-            pass
-            
-        return False
-    except Exception as e:
-        logger.error(f"Error checking if RetroArch is running: {e}")
-        return False
-
-def send_retroarch_command(command):
-    """Send a command to RetroArch via Network Control Interface"""
-    try:
-        # Check if RetroArch might be running first
-        retroarch_status = is_retroarch_running()
-        if not retroarch_status:
-            logger.warning("RetroArch does not appear to be running. Command might not work.")
-        
-        # Create a UDP socket
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock.settimeout(1.0)  # Set a 1-second timeout
-        
-        # Send the command
-        sock.sendto(command.encode(), ('127.0.0.1', RETROARCH_PORT))
-        
-        # For commands that expect a response, wait for it
-        if command in ["VERSION", "GET_STATUS", "GET_CONFIG_PARAM"]:
-            try:
-                response, addr = sock.recvfrom(1024)
-                return response.decode().strip()
-            except socket.timeout:
-                logger.warning(f"Timeout waiting for response to command: {command}")
-                return None
-        
-        return True
-    except Exception as e:
-        logger.error(f"Error sending RetroArch command: {e}")
-        # Include more descriptive error message
-        if isinstance(e, socket.error) and e.errno == 111:
-            logger.error("Connection refused. RetroArch might not be running or network commands are disabled.")
-        return None
-    finally:
-        if 'sock' in locals() and sock:
-            sock.close()
-
-def display_retroarch_message(message):
-    """Display a message on the RetroArch screen"""
-    try:
-        # The SHOW_MESG command requires the message in a specific format
-        command = f"SHOW_MESG {message}"
-        result = send_retroarch_command(command)
-        return result is not None
-    except Exception as e:
-        logger.error(f"Error displaying RetroArch message: {e}")
-        return False
-
-def get_retroarch_status():
-    """Get the current status of RetroArch"""
-    try:
-        response = send_retroarch_command("GET_STATUS")
-        if response:
-            # Parse the response
-            status_info = {}
-            lines = response.split('\n')
-            for line in lines:
-                if ':' in line:
-                    key, value = line.split(':', 1)
-                    status_info[key.strip()] = value.strip()
-            return status_info
-        return None
-    except Exception as e:
-        logger.error(f"Error getting RetroArch status: {e}")
-        return None
-
-def start_mqtt_listener(max_retries=10):
-    """Start a background MQTT listener for commands with retry logic"""
-    config = get_config()
-    
-    if not config.get('mqtt_host'):
-        logger.error("MQTT host not configured, cannot start listener")
-        return False
-      # Create a more robust client with auto-reconnect
-    # Use the newer API version to avoid deprecation warnings
-    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION1, client_id=f"{SYSTEM_NAME}-ha-{int(time.time())}", clean_session=True)
-    client.on_connect = on_connect
-    client.on_message = on_message
-    
-    # Set up auto-reconnect parameters - very important for stability
-    client.reconnect_delay_set(min_delay=1, max_delay=60)
-    
-    # Add a disconnect callback to log disconnections
-    def on_disconnect(client, userdata, rc):
-        if rc != 0:
-            logger.warning(f"Unexpected MQTT disconnection with code {rc}. Will auto-reconnect.")
-        else:
-            logger.info("MQTT client disconnected cleanly")
-    
-    client.on_disconnect = on_disconnect
-    
-    if config.get('mqtt_username') and config.get('mqtt_password'):
-        client.username_pw_set(config['mqtt_username'], config['mqtt_password'])
-    
-    # Add retry logic with exponential backoff
-    retries = 0
-    max_wait = 60  # Maximum wait time in seconds
-    while retries < max_retries:
-        try:
-            # Set a shorter connection timeout for quicker failure detection
-            client.connect(config['mqtt_host'], int(config.get('mqtt_port', 1883)), 15)
-            client.loop_start()
-            logger.info("MQTT listener started successfully")
-              # Add will message so Home Assistant knows when we're offline
-            topic_prefix = config.get('mqtt_topic_prefix', SYSTEM_NAME)
-            will_topic = f"{topic_prefix}/availability"
-            client.will_set(will_topic, "offline", qos=1, retain=True)
-            
-            # Immediately publish online status
-            client.publish(will_topic, "online", qos=1, retain=True)
-            
-            # Add a periodic ping to verify connection is still alive
-            def maintain_connection():
-                """Periodic function to maintain connection and verify it's working"""
-                while True:
-                    try:
-                        time.sleep(60)  # Check connection every minute
-                        if not client.is_connected():
-                            logger.warning("MQTT connection lost, reconnecting...")
-                            try:
-                                client.reconnect()
-                                logger.info("MQTT reconnection successful")
-                            except Exception as reconnect_error:
-                                logger.error(f"Failed to reconnect: {reconnect_error}")
-                        else:
-                            # Send a ping by publishing to a debug topic periodically
-                            client.publish(f"{topic_prefix}/availability", "online", qos=1, retain=True)
-                    except Exception as e:
-                        logger.error(f"Error in connection maintenance thread: {e}")
-            
-            # Start connection maintenance in a background thread
-            connection_thread = threading.Thread(target=maintain_connection, daemon=True)
-            connection_thread.start()
-            
-            return client
-        except Exception as e:
-            retries += 1
-            # Calculate wait time with exponential backoff (2^retry seconds)
-            wait_time = min(2 ** retries, max_wait)
-            
-            if retries >= max_retries:
-                logger.error(f"Failed to start MQTT listener after {max_retries} attempts: {e}")
-                return None
-            else:
-                logger.warning(f"Error starting MQTT listener (attempt {retries}/{max_retries}): {e}. Retrying in {wait_time} seconds...")
-                time.sleep(wait_time)
-    
-    # Should never reach here due to the return in the max retries case
-    return None
-
-def register_with_ha():
-    """Register device with Home Assistant via MQTT discovery"""
-    config = get_config()
-    topic_prefix = config.get('mqtt_topic_prefix', SYSTEM_NAME)
-    device_name = config.get('device_name', socket.gethostname())
-    
-    # Clean device_name to avoid issues with MQTT topics
-    safe_device_name = re.sub(r'[^a-zA-Z0-9_]', '_', device_name)
-    
-    # Package version
-    sw_version = "1.0.0"
-    
-    # Create device information
-    device_info = {
-        "identifiers": [
-            f"retropie_{safe_device_name}"
-        ],
-        "name": f"RetroPie {device_name}",
-        "model": "RetroPie Arcade",
-        "manufacturer": "RetroPie",
-        "sw_version": sw_version
-    }
-    
-    # Origin information
-    origin_info = {
-        "name": "RetroPie Home Assistant Integration",
-        "sw": sw_version,
-        "url": "https://github.com/yourusername/retropie-ha-integration"
-    }
-    
-    # Availability definition (common for all sensors)
-    availability = [
-        {
-            "topic": f"{topic_prefix}/availability",
-            "value_template": "{{ value }}"
-        }
-    ]
-    
-    # Register CPU temperature sensor
-    cpu_temp_config = {
-        "device": device_info,
-        "name": f"RetroPie {device_name} CPU Temperature",
-        "unique_id": f"retropie_{safe_device_name}_cpu_temp",
-        "object_id": f"retropie_{safe_device_name}_cpu_temp",
-        "state_topic": f"{topic_prefix}/status",
-        "value_template": "{{ value_json.system_info.cpu_temp }}",
-        "unit_of_measurement": "°C",
-        "device_class": "temperature",
-        "state_class": "measurement",
-        "icon": "mdi:chip",
-        "availability": availability,
-        "availability_mode": "all",
-        "enabled_by_default": True,
-        "origin": origin_info
-    }
-    
-    # Register GPU temperature sensor
-    gpu_temp_config = {
-        "device": device_info,
-        "name": f"RetroPie {device_name} GPU Temperature",
-        "unique_id": f"retropie_{safe_device_name}_gpu_temp",
-        "object_id": f"retropie_{safe_device_name}_gpu_temp",
-        "state_topic": f"{topic_prefix}/status",
-        "value_template": "{{ value_json.system_info.gpu_temp }}",
-        "unit_of_measurement": "°C",
-        "device_class": "temperature",
-        "state_class": "measurement",
-        "icon": "mdi:gpu",
-        "availability": availability,
-        "availability_mode": "all",
-        "enabled_by_default": True,
-        "origin": origin_info
-    }
-    
-    # Register machine status sensor
-    machine_status_config = {
-        "device": device_info,
-        "name": f"RetroPie {device_name} Machine Status",
-        "unique_id": f"retropie_{safe_device_name}_machine_status",
-        "object_id": f"retropie_{safe_device_name}_machine_status",
-        "state_topic": f"{topic_prefix}/machine_status",
-        "value_template": "{{ value_json.status }}",
-        "icon": "mdi:nintendo-switch",
-        "availability": availability,
-        "availability_mode": "all",
-        "enabled_by_default": True,
-        "origin": origin_info
-    }
-    
-    # Register game status sensor with enhanced information
-    game_status_config = {
-        "device": device_info,
-        "name": f"RetroPie {device_name} Game Status",
-        "unique_id": f"retropie_{safe_device_name}_game_status",
-        "object_id": f"retropie_{safe_device_name}_game_status",
-        "state_topic": f"{topic_prefix}/machine_status",
-        "value_template": "{{ value_json.current_game if value_json.current_game else 'None' }}",
-        "json_attributes_topic": f"{topic_prefix}/event/game-start",
-        "json_attributes_template": "{{ {'description': value_json.description if 'description' in value_json else '', 'system': value_json.system if 'system' in value_json else '', 'emulator': value_json.emulator if 'emulator' in value_json else '', 'genre': value_json.genre if 'genre' in value_json else '', 'developer': value_json.developer if 'developer' in value_json else '', 'publisher': value_json.publisher if 'publisher' in value_json else '', 'rating': value_json.rating if 'rating' in value_json else '', 'releasedate': value_json.releasedate if 'releasedate' in value_json else '', 'start_time': value_json.start_time if 'start_time' in value_json else '', 'image_path': value_json.image_path if 'image_path' in value_json else '' } | tojson }}",
-        "icon": "mdi:gamepad-variant",
-        "availability": availability,
-        "availability_mode": "all",
-        "enabled_by_default": True,
-        "origin": origin_info
-    }
-    
-    # Register dedicated game image path sensor
-    game_image_path_config = {
-        "device": device_info,
-        "name": f"RetroPie {device_name} Game Image Path",
-        "unique_id": f"retropie_{safe_device_name}_game_image_path",
-        "object_id": f"retropie_{safe_device_name}_game_image_path",
-        "state_topic": f"{topic_prefix}/machine_status",
-        "value_template": "{{ value_json.image_path if 'image_path' in value_json else '' }}",
-        "icon": "mdi:image",
-        "availability": availability,
-        "availability_mode": "all",
-        "enabled_by_default": True,
-        "origin": origin_info
-    }
-    
-    # Register play duration sensor
-    play_duration_config = {
-        "device": device_info,
-        "name": f"RetroPie {device_name} Play Duration",
-        "unique_id": f"retropie_{safe_device_name}_play_duration",
-        "object_id": f"retropie_{safe_device_name}_play_duration",
-        "state_topic": f"{topic_prefix}/machine_status",
-        "value_template": "{{ value_json.play_duration_seconds if 'play_duration_seconds' in value_json else 0 }}",
-        "unit_of_measurement": "s",
-        "icon": "mdi:timer",
-        "state_class": "measurement",
-        "availability": availability,
-        "availability_mode": "all",
-        "enabled_by_default": True,
-        "origin": origin_info
-    }
-    
-    # Register memory usage sensor
-    memory_usage_config = {
-        "device": device_info,
-        "name": f"RetroPie {device_name} Memory Usage",
-        "unique_id": f"retropie_{safe_device_name}_memory_usage",
-        "object_id": f"retropie_{safe_device_name}_memory_usage",
-        "state_topic": f"{topic_prefix}/status",
-        "value_template": "{{ value_json.system_info.memory.used / value_json.system_info.memory.total * 100 }}",
-        "unit_of_measurement": "%",
-        "icon": "mdi:memory",
-        "state_class": "measurement",
-        "availability": availability,
-        "availability_mode": "all",
-        "enabled_by_default": True,
-        "origin": origin_info
-    }
-    
-    # Register CPU load sensor
-    cpu_load_config = {
-        "device": device_info,
-        "name": f"RetroPie {device_name} CPU Load",
-        "unique_id": f"retropie_{safe_device_name}_cpu_load",
-        "object_id": f"retropie_{safe_device_name}_cpu_load",
-        "state_topic": f"{topic_prefix}/status",
-        "value_template": "{{ value_json.system_info.load[0] }}",
-        "icon": "mdi:chip",
-        "state_class": "measurement",
-        "availability": availability,
-        "availability_mode": "all",
-        "enabled_by_default": True,
-        "origin": origin_info
-    }
-    
-    # Register CPU frequency sensor
-    cpu_frequency_config = {
-        "device": device_info,
-        "name": f"RetroPie {device_name} CPU Frequency",
-        "unique_id": f"retropie_{safe_device_name}_cpu_freq",
-        "object_id": f"retropie_{safe_device_name}_cpu_freq",
-        "state_topic": f"{topic_prefix}/status",
-        "value_template": "{{ value_json.system_info.cpu_freq }}",
-        "unit_of_measurement": "MHz",
-        "icon": "mdi:sine-wave",
-        "state_class": "measurement",
-        "availability": availability,
-        "availability_mode": "all",
-        "enabled_by_default": True,
-        "origin": origin_info
-    }
-    
-    # Register GPU frequency sensor
-    gpu_frequency_config = {
-        "device": device_info,
-        "name": f"RetroPie {device_name} GPU Frequency",
-        "unique_id": f"retropie_{safe_device_name}_gpu_freq",
-        "object_id": f"retropie_{safe_device_name}_gpu_freq",
-        "state_topic": f"{topic_prefix}/status",
-        "value_template": "{{ value_json.system_info.gpu_freq }}",
-        "unit_of_measurement": "MHz",
-        "icon": "mdi:video",
-        "state_class": "measurement",
-        "availability": availability,
-        "availability_mode": "all",
-        "enabled_by_default": True,
-        "origin": origin_info
-    }
-    
-    # Register TTS input text entity
-    tts_input_config = {
-        "device": device_info,
-        "name": f"RetroPie {device_name} TTS Text",
-        "unique_id": f"retropie_{safe_device_name}_tts_text",
-        "state_topic": f"{topic_prefix}/tts_text/state",
-        "command_topic": f"{topic_prefix}/tts_text/set",
-        "icon": "mdi:text-to-speech",
-        "availability": availability,
-        "availability_mode": "all",
-        "retain": False,
-        "enabled_by_default": True,
-        "origin": origin_info
-    }
-    
-    # Register TTS button entity
-    tts_button_config = {
-        "device": device_info,
-        "name": f"RetroPie {device_name} TTS Speak",
-        "unique_id": f"retropie_{safe_device_name}_tts_speak",
-        "command_topic": f"{topic_prefix}/command/tts",
-        "payload_press": "SPEAK",
-        "icon": "mdi:text-to-speech",
-        "availability": availability,
-        "availability_mode": "all",
-        "enabled_by_default": True,
-        "origin": origin_info
-    }
-    
-    # Create an active client to ensure connection before publishing
-    # Use the newer API version to avoid deprecation warnings
-    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION1)
-    client.on_connect = on_connect
-    
-    if config.get('mqtt_username') and config.get('mqtt_password'):
-        client.username_pw_set(config['mqtt_username'], config['mqtt_password'])
-    
-    try:
-        # Connect to broker and wait for on_connect callback
-        client.connect(config['mqtt_host'], int(config.get('mqtt_port', 1883)), 60)
-        client.loop_start()
-        time.sleep(1)  # Give time for the connection to establish
-        
-        # Publish availability status topic first
-        availability_payload = "online"
-        client.publish(
-            f"{topic_prefix}/availability",
-            availability_payload,
-            qos=1,
-            retain=True
-        )
-        logger.info(f"Published availability status")
-        
-        # Publish initial machine status
-        publish_machine_status()
-        
-        # Publish all discovery messages with retain flag set to True
-        # This ensures they persist in the broker
-        client.publish(
-            f"homeassistant/sensor/retropie_{safe_device_name}/cpu_temp/config",
-            json.dumps(cpu_temp_config),
-            qos=1,
-            retain=True
-        )
-        logger.info(f"Published CPU temperature sensor config")
-        
-        client.publish(
-            f"homeassistant/sensor/retropie_{safe_device_name}/gpu_temp/config",
-            json.dumps(gpu_temp_config),
-            qos=1,
-            retain=True
-        )
-        logger.info(f"Published GPU temperature sensor config")
-        
-        client.publish(
-            f"homeassistant/sensor/retropie_{safe_device_name}/machine_status/config",
-            json.dumps(machine_status_config),
-            qos=1,
-            retain=True
-        )
-        logger.info(f"Published machine status sensor config")
-        
-        client.publish(
-            f"homeassistant/sensor/retropie_{safe_device_name}/game_status/config",
-            json.dumps(game_status_config),
-            qos=1,
-            retain=True
-        )
-        logger.info(f"Published game status sensor config")
-        
-        # Publish game image path sensor config
-        client.publish(
-            f"homeassistant/sensor/retropie_{safe_device_name}/game_image_path/config",
-            json.dumps(game_image_path_config),
-            qos=1,
-            retain=True
-        )
-        logger.info(f"Published game image path sensor config")
-        
-        client.publish(
-            f"homeassistant/sensor/retropie_{safe_device_name}/play_duration/config",
-            json.dumps(play_duration_config),
-            qos=1,
-            retain=True
-        )
-        logger.info(f"Published play duration sensor config")
-        
-        client.publish(
-            f"homeassistant/sensor/retropie_{safe_device_name}/memory_usage/config",
-            json.dumps(memory_usage_config),
-            qos=1,
-            retain=True
-        )
-        logger.info(f"Published memory usage sensor config")
-        
-        client.publish(
-            f"homeassistant/sensor/retropie_{safe_device_name}/cpu_load/config",
-            json.dumps(cpu_load_config),
-            qos=1,
-            retain=True
-        )
-        logger.info(f"Published CPU load sensor config")
-        
-        # Publish CPU frequency sensor
-        client.publish(
-            f"homeassistant/sensor/retropie_{safe_device_name}/cpu_freq/config",
-            json.dumps(cpu_frequency_config),
-            qos=1,
-            retain=True
-        )
-        logger.info(f"Published CPU frequency sensor config")
-        
-        # Publish GPU frequency sensor
-        client.publish(
-            f"homeassistant/sensor/retropie_{safe_device_name}/gpu_freq/config",
-            json.dumps(gpu_frequency_config),
-            qos=1,
-            retain=True
-        )
-        logger.info(f"Published GPU frequency sensor config")
-        
-        # Register total games sensor
-        total_games_config = {
-            "device": device_info,
-            "name": f"RetroPie {device_name} Total Games",
-            "unique_id": f"retropie_{safe_device_name}_total_games",
-            "object_id": f"retropie_{safe_device_name}_total_games",
-            "state_topic": f"{topic_prefix}/game_collection",
-            "value_template": "{{ value_json.total_games }}",
-            "icon": "mdi:gamepad-variant-outline",
-            "state_class": "measurement",
-            "availability": availability,
-            "availability_mode": "all",
-            "enabled_by_default": True,
-            "origin": origin_info
-        }
-        
-        client.publish(
-            f"homeassistant/sensor/retropie_{safe_device_name}/total_games/config",
-            json.dumps(total_games_config),
-            qos=1,
-            retain=True
-        )
-        logger.info(f"Published total games sensor config")
-        
-        # Register favorites sensor
-        favorites_config = {
-            "device": device_info,
-            "name": f"RetroPie {device_name} Favorite Games",
-            "unique_id": f"retropie_{safe_device_name}_favorites",
-            "object_id": f"retropie_{safe_device_name}_favorites",
-            "state_topic": f"{topic_prefix}/game_collection",
-            "value_template": "{{ value_json.favorites }}",
-            "icon": "mdi:star",
-            "state_class": "measurement",
-            "availability": availability,
-            "availability_mode": "all",
-            "enabled_by_default": True,
-            "origin": origin_info
-        }
-        
-        client.publish(
-            f"homeassistant/sensor/retropie_{safe_device_name}/favorites/config",
-            json.dumps(favorites_config),
-            qos=1,
-            retain=True
-        )
-        logger.info(f"Published favorites sensor config")
-        
-        # Register kid-friendly games sensor
-        kid_friendly_config = {
-            "device": device_info,
-            "name": f"RetroPie {device_name} Kid-Friendly Games",
-            "unique_id": f"retropie_{safe_device_name}_kid_friendly",
-            "object_id": f"retropie_{safe_device_name}_kid_friendly",
-            "state_topic": f"{topic_prefix}/game_collection",
-            "value_template": "{{ value_json.kid_friendly }}",
-            "icon": "mdi:human-male-child",
-            "state_class": "measurement",
-            "availability": availability,
-            "availability_mode": "all",
-            "enabled_by_default": True,
-            "origin": origin_info
-        }
-        
-        client.publish(
-            f"homeassistant/sensor/retropie_{safe_device_name}/kid_friendly/config",
-            json.dumps(kid_friendly_config),
-            qos=1,
-            retain=True
-        )
-        logger.info(f"Published kid-friendly games sensor config")
-        
-        client.publish(
-            f"homeassistant/text/retropie_{safe_device_name}/tts_text/config",
-            json.dumps(tts_input_config),
-            qos=1,
-            retain=True
-        )
-        logger.info(f"Published TTS text input config")
-        
-        client.publish(
-            f"homeassistant/button/retropie_{safe_device_name}/tts_speak/config",
-            json.dumps(tts_button_config),
-            qos=1,
-            retain=True
-        )
-        logger.info(f"Published TTS button config")
-        
-        # Register RetroArch message input text
-        retroarch_message_input_config = {
-            "device": device_info,
-            "name": f"RetroPie {device_name} RetroArch Message Text",
-            "unique_id": f"retropie_{safe_device_name}_retroarch_message_text",
-            "state_topic": f"{topic_prefix}/retroarch_message_text/state",
-            "command_topic": f"{topic_prefix}/retroarch_message_text/set",
-            "icon": "mdi:message-text",
-            "availability": availability,
-            "availability_mode": "all",
-            "retain": False,
-            "enabled_by_default": True,
-            "origin": origin_info
-        }
-        
-        client.publish(
-            f"homeassistant/text/retropie_{safe_device_name}/retroarch_message_text/config",
-            json.dumps(retroarch_message_input_config),
-            qos=1,
-            retain=True
-        )
-        logger.info(f"Published RetroArch message text input config")
-        
-        # Register RetroArch message button
-        retroarch_message_button_config = {
-            "device": device_info,
-            "name": f"RetroPie {device_name} Display Message",
-            "unique_id": f"retropie_{safe_device_name}_retroarch_display_message",
-            "command_topic": f"{topic_prefix}/command/retroarch/message",
-            "payload_press": "DISPLAY",
-            "icon": "mdi:message-text",
-            "availability": availability,
-            "availability_mode": "all",
-            "enabled_by_default": True,
-            "origin": origin_info
-        }
-        
-        client.publish(
-            f"homeassistant/button/retropie_{safe_device_name}/retroarch_display_message/config",
-            json.dumps(retroarch_message_button_config),
-            qos=1,
-            retain=True
-        )
-        logger.info(f"Published RetroArch message button config")
-        
-        # Register RetroArch command input text
-        retroarch_command_input_config = {
-            "device": device_info,
-            "name": f"RetroPie {device_name} RetroArch Command Text",
-            "unique_id": f"retropie_{safe_device_name}_retroarch_command_text",
-            "state_topic": f"{topic_prefix}/retroarch_command_text/state",
-            "command_topic": f"{topic_prefix}/retroarch_command_text/set",
-            "icon": "mdi:gamepad-variant",
-            "availability": availability,
-            "availability_mode": "all",
-            "retain": False,
-            "enabled_by_default": True,
-            "origin": origin_info
-        }
-        
-        client.publish(
-            f"homeassistant/text/retropie_{safe_device_name}/retroarch_command_text/config",
-            json.dumps(retroarch_command_input_config),
-            qos=1,
-            retain=True
-        )
-        logger.info(f"Published RetroArch command text input config")
-        
-        # Register RetroArch command button
-        retroarch_command_button_config = {
-            "device": device_info,
-            "name": f"RetroPie {device_name} Execute Command",
-            "unique_id": f"retropie_{safe_device_name}_retroarch_execute_command",
-            "command_topic": f"{topic_prefix}/command/retroarch",
-            "payload_press": "EXECUTE",
-            "icon": "mdi:gamepad-variant",
-            "availability": availability,
-            "availability_mode": "all",
-            "enabled_by_default": True,
-            "origin": origin_info
-        }
-        
-        client.publish(
-            f"homeassistant/button/retropie_{safe_device_name}/retroarch_execute_command/config",
-            json.dumps(retroarch_command_button_config),
-            qos=1,
-            retain=True
-        )
-        logger.info(f"Published RetroArch command button config")
-        
-        # Register RetroArch status button
-        retroarch_status_button_config = {
-            "device": device_info,
-            "name": f"RetroPie {device_name} Get Status",
-            "unique_id": f"retropie_{safe_device_name}_retroarch_get_status",
-            "command_topic": f"{topic_prefix}/command/retroarch/status",
-            "payload_press": "GET_STATUS",
-            "icon": "mdi:information-outline",
-            "availability": availability,
-            "availability_mode": "all",
-            "enabled_by_default": True,
-            "origin": origin_info
-        }
-        
-        client.publish(
-            f"homeassistant/button/retropie_{safe_device_name}/retroarch_get_status/config",
-            json.dumps(retroarch_status_button_config),
-            qos=1,
-            retain=True
-        )
-        logger.info(f"Published RetroArch status button config")
-        
-        # Register UI mode select entity
-        ui_mode_select_config = {
-            "device": device_info,
-            "name": f"RetroPie {device_name} UI Mode",
-            "unique_id": f"retropie_{safe_device_name}_ui_mode_select",
-            "state_topic": f"{topic_prefix}/ui_mode/state",
-            "command_topic": f"{topic_prefix}/command/ui_mode",
-            "options": ["Full", "Kid", "Kiosk"],
-            "icon": "mdi:view-dashboard",
-            "availability": availability,
-            "availability_mode": "all",
-            "enabled_by_default": True,
-            "origin": origin_info
-        }
-        
-        client.publish(
-            f"homeassistant/select/retropie_{safe_device_name}/ui_mode/config",
-            json.dumps(ui_mode_select_config),
-            qos=1,
-            retain=True
-        )
-        logger.info(f"Published UI mode select config")
-        
-        # Register scan games button
-        scan_games_button_config = {
-            "device": device_info,
-            "name": f"RetroPie {device_name} Scan Games",
-            "unique_id": f"retropie_{safe_device_name}_scan_games_button",
-            "command_topic": f"{topic_prefix}/command/scan_games",
-            "payload_press": "SCAN",
-            "icon": "mdi:database-search",
-            "availability": availability,
-            "availability_mode": "all",
-            "enabled_by_default": True,
-            "origin": origin_info
-        }
-        
-        client.publish(
-            f"homeassistant/button/retropie_{safe_device_name}/scan_games/config",
-            json.dumps(scan_games_button_config),
-            qos=1,
-            retain=True
-        )
-        logger.info(f"Published scan games button config")
-        
-        # Also publish an initial status message to make the sensors available immediately
-        status_payload = {
-            'timestamp': int(time.time()),
-            'device': device_name,
-            'system_info': get_system_info()
-        }
-        client.publish(
-            f"{topic_prefix}/status",
-            json.dumps(status_payload),
-            qos=1,
-            retain=True
-        )
-        logger.info(f"Published initial status update")
-        
-        # Disconnect cleanly
-        time.sleep(2)  # Give time for messages to be delivered
-        client.loop_stop()
-        client.disconnect()
-        return True
-    except Exception as e:
-        logger.error(f"Error registering with Home Assistant: {e}")
-        if client.is_connected():
-            client.loop_stop()
-            client.disconnect()
-        return False
-
-if __name__ == '__main__':
-    # Ensure config directory exists
-    ensure_config_dir()
-    
-    # Load saved state if exists
-    load_state()
-    
-    parser = argparse.ArgumentParser(description='RetroPie Home Assistant Integration')
-    parser.add_argument('--event', help='Event type (game-start, game-end, etc.)')
-    parser.add_argument('--status', action='store_true', help='Publish system status')
-    parser.add_argument('--register', action='store_true', help='Register with Home Assistant')
-    parser.add_argument('--tts', help='Text to speak')
-    parser.add_argument('--listen', action='store_true', help='Start MQTT listener for commands')
-    parser.add_argument('--shutdown-mode', action='store_true', help='Use reduced timeouts for shutdown operations')
-    parser.add_argument('args', nargs='*', help='Event arguments')
-    
-    args = parser.parse_args()
-    
-    if args.register:
-        logger.info("Registering with Home Assistant...")
-        if register_with_ha():
-            logger.info("Successfully registered with Home Assistant")
-        else:
-            logger.error("Failed to register with Home Assistant")
-        sys.exit(0)
-    
-    if args.tts:
-        logger.info(f"Executing TTS: {args.tts}")
-        execute_tts(args.tts)
-        sys.exit(0)
-    
-    if args.listen:
-        logger.info("Starting MQTT listener...")
-        # Send system-start event
-        publish_game_event('system-start')
-        
-        # Start MQTT listener
-        # Start a game collection scan in the background
-        logger.info("Starting initial game collection scan...")
-        scan_game_collection()
-        
-        # Start monitoring gamelist.xml files for changes
-        start_file_monitoring()
-        
-        mqtt_client = start_mqtt_listener()
-        if mqtt_client:
-            try:
-                # Keep the program running
-                while True:
-                    time.sleep(10)
-                    # Publish status update periodically
-                    publish_system_status()
-            except KeyboardInterrupt:
-                logger.info("Stopping MQTT listener...")
-                mqtt_client.loop_stop()
-                # Stop file monitoring
-                stop_file_monitoring()
-                
-                # Send system-shutdown event before exiting
-                publish_game_event('quit')
-        sys.exit(0)
-    
-    if args.status:
-        publish_system_status()
-        sys.exit(0)
-    
-    if args.event:
-        # For quit events, if shutdown_mode is specified, pass it to ensure lower timeouts
-        if args.event == 'quit' and args.shutdown_mode:
-            logger.info("Running quit event in shutdown mode")
-        publish_game_event(args.event, args.args)
-        sys.exit(0)
-    
-    # If no arguments provided, just publish status
+#!/usr/bin/env python3
+import json
+import paho.mqtt.client as mqtt
+import argparse
+import time
+import os
+import subprocess
+import socket
+import re
+import signal
+import sys
+import logging
+import logging.handlers
+import xml.etree.ElementTree as ET
+import base64
+import hashlib
+import io
+import mmap
+import pwd
+import queue
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from pathlib import Path
+import threading
+import atexit
+# Try to import watchdog, but don't crash if it's not available
+try:
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.events import PatternMatchingEventHandler
+    watchdog_available = True
+except ImportError:
+    watchdog_available = False
+    # Don't log here, since logger isn't initialized yet
+    # We'll log this later
+# Try to use lxml for faster C-level XML parsing, fall back to stdlib
+try:
+    from lxml import etree as lxml_etree
+    lxml_available = True
+except ImportError:
+    lxml_available = False
+# Try to use Pillow to shrink thumbnails before publishing; without it we
+# fall back to shipping the raw image file
+try:
+    from PIL import Image
+    pil_available = True
+except ImportError:
+    pil_available = False
+# Try orjson for payload serialization (C-backed, returns bytes paho can
+# publish directly); fall back to stdlib json
+try:
+    import orjson
+    _dumps = orjson.dumps
+    orjson_available = True
+except ImportError:
+    _dumps = json.dumps
+    orjson_available = False
+# Try zstandard for optional compressed status payloads (enabled with the
+# payload_format = "json+zstd" config knob); one compressor is reused so the
+# context setup cost is paid once
+try:
+    import zstandard
+    _zstd_compressor = zstandard.ZstdCompressor(level=3)
+    zstd_available = True
+except ImportError:
+    zstd_available = False
+
+# Detect system type
+SYSTEM_TYPE = "unknown"
+if os.path.exists("/opt/retropie"):
+    SYSTEM_TYPE = "retropie"
+    CONFIG_DIR = os.path.expanduser('~/.config/retropie-ha')
+    ROMS_DIR = os.path.expanduser('~/RetroPie/roms')
+    SYSTEM_NAME = "retropie"
+elif os.path.exists("/userdata/system"):
+    SYSTEM_TYPE = "batocera"
+    CONFIG_DIR = "/userdata/system/retropie-ha"  # Fixed path to match installation script
+    ROMS_DIR = "/userdata/roms"
+    SYSTEM_NAME = "batocera"
+else:
+    # Fallback to RetroPie defaults
+    CONFIG_DIR = os.path.expanduser('~/.config/retropie-ha')
+    ROMS_DIR = os.path.expanduser('~/RetroPie/roms')
+    SYSTEM_NAME = "retropie"
+
+# Set up logging: a rotating file target (so the log can't grow without
+# bound) fed through a memory buffer that batches INFO records and flushes
+# immediately on ERROR, keeping per-event SD-card writes down
+_log_target = logging.handlers.RotatingFileHandler(
+    os.path.join(CONFIG_DIR, 'retropie-ha.log'),
+    maxBytes=1_000_000, backupCount=3)
+_log_target.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+logging.basicConfig(
+    level=logging.INFO,
+    handlers=[
+        logging.handlers.MemoryHandler(capacity=64, flushLevel=logging.ERROR,
+                                       target=_log_target)
+        # Removed StreamHandler to prevent console output
+    ]
+)
+logger = logging.getLogger(f'{SYSTEM_NAME}-ha')
+
+# Constants
+CONFIG_FILE = os.path.join(CONFIG_DIR, 'config.json')
+STATE_FILE = os.path.join(CONFIG_DIR, 'state.json')
+GAMELIST_CACHE_DIR = os.path.join(CONFIG_DIR, 'gamelist_cache')
+THUMB_CACHE_DIR = os.path.join(CONFIG_DIR, 'thumb_cache')
+RETROARCH_PORT = 55355  # Default RetroArch Network Control Interface port
+EVENT_SOCKET = os.path.join(CONFIG_DIR, 'event.sock')  # Listener event hand-off
+THUMBNAIL_MAX_SIZE = (160, 160)  # Largest thumbnail dimensions sent over MQTT
+THUMBNAIL_JPEG_QUALITY = 70
+
+# Patterns used on hot paths, compiled once at import
+_TEMP_RE = re.compile(r'temp=(\d+\.\d+)')
+_FREQ_RE = re.compile(r'frequency\(\d+\)=(\d+)')
+_EQ_RE = re.compile(r'=(\d+)')
+_SAFE_NAME_RE = re.compile(r'[^a-zA-Z0-9_]')
+
+# Global state
+current_state = {
+    'machine_status': 'idle',  # idle, playing, shutdown
+    'current_game': None,
+    'game_start_time': None,
+    'last_update': int(time.time()),
+    'game_collection': {
+        'total_games': 0,
+        'favorites': 0,
+        'kid_friendly': 0,
+        'last_scan': 0,
+        'systems': {}
+    }
+}
+
+def ensure_config_dir():
+    """Ensure configuration directory exists"""
+    if not os.path.exists(CONFIG_DIR):
+        os.makedirs(CONFIG_DIR)
+
+# Parsed config cache, invalidated whenever config.json changes on disk
+_config_cache = None
+_config_mtime = None
+
+# Hostname doesn't change while the process runs; resolve it once instead
+# of a syscall per event
+_HOSTNAME = socket.gethostname()
+
+def get_config():
+    """Load configuration from file, cached until the file changes on disk"""
+    global _config_cache, _config_mtime
+    try:
+        mtime = os.path.getmtime(CONFIG_FILE)
+        if _config_cache is None or mtime != _config_mtime:
+            with open(CONFIG_FILE, 'r') as f:
+                _config_cache = json.load(f)
+            _config_mtime = mtime
+        return _config_cache
+    except Exception as e:
+        logger.error(f"Failed to load configuration: {e}")
+        return {}
+
+# Debounced state persistence: ES navigation fires events in bursts, and
+# each one calls save_state(); coalescing the writes through a short timer
+# turns a burst into a single flash write on the SD card
+_save_timer = None
+_save_lock = threading.Lock()
+SAVE_DEBOUNCE_SECONDS = 0.1
+
+def _write_state():
+    """Write the current state to disk (the debounced half of save_state)"""
+    global _save_timer
+    with _save_lock:
+        _save_timer = None
+    try:
+        # Serialize first so the file sees a single write() instead of the
+        # many small writes json.dump issues, and replace atomically so a
+        # crash mid-write can't leave a truncated state file
+        data = json.dumps(current_state)
+        tmp_file = STATE_FILE + '.tmp'
+        with open(tmp_file, 'w') as f:
+            f.write(data)
+        os.replace(tmp_file, STATE_FILE)
+    except Exception as e:
+        logger.error(f"Failed to save state: {e}")
+
+def save_state():
+    """Schedule a debounced save of the current state to file"""
+    global _save_timer
+    with _save_lock:
+        if _save_timer is not None:
+            _save_timer.cancel()
+        _save_timer = threading.Timer(SAVE_DEBOUNCE_SECONDS, _write_state)
+        _save_timer.daemon = True
+        _save_timer.start()
+
+def _flush_state():
+    """Write any pending debounced state immediately (process exit path)"""
+    with _save_lock:
+        pending = _save_timer is not None
+        if pending:
+            _save_timer.cancel()
+    if pending:
+        _write_state()
+
+atexit.register(_flush_state)
+
+def load_state():
+    """Load state from file"""
+    global current_state
+    try:
+        if os.path.exists(STATE_FILE):
+            with open(STATE_FILE, 'r') as f:
+                current_state.update(json.load(f))
+    except Exception as e:
+        logger.error(f"Failed to load state: {e}")
+
+def _read_small(path):
+    """Read a small /proc or /sys file in a single call and return its text"""
+    with open(path, 'r') as f:
+        return f.read()
+
+def get_cpu_temperature():
+    """Get CPU temperature from sysfs, falling back to vcgencmd"""
+    try:
+        # The kernel exposes the same SoC sensor vcgencmd reads; a sysfs
+        # read avoids forking a process on every status update. One decimal
+        # matches vcgencmd's resolution and keeps the JSON short, and the
+        # millidegree noise would otherwise defeat the status change check.
+        return round(int(_read_small('/sys/class/thermal/thermal_zone0/temp')) / 1000.0, 1)
+    except Exception:
+        pass
+    try:
+        output = subprocess.check_output(['vcgencmd', 'measure_temp'], universal_newlines=True)
+        temp = _TEMP_RE.search(output)
+        if temp:
+            return float(temp.group(1))
+    except Exception as e:
+        logger.error(f"Failed to get CPU temperature: {e}")
+    return None
+
+def get_gpu_temperature():
+    """Get GPU temperature (on Raspberry Pi, this is often the same as CPU)"""
+    try:
+        # On some systems, there might be a separate GPU temperature command
+        # For Raspberry Pi, we typically use the same as CPU
+        return get_cpu_temperature()
+    except Exception as e:
+        logger.error(f"Failed to get GPU temperature: {e}")
+    return None
+
+def get_cpu_frequency():
+    """Get current CPU frequency in MHz from sysfs, falling back to vcgencmd"""
+    try:
+        # cpufreq reports kHz; a sysfs read avoids forking vcgencmd on
+        # every status update
+        return int(_read_small('/sys/devices/system/cpu/cpu0/cpufreq/scaling_cur_freq')) // 1000
+    except Exception:
+        pass
+    try:
+        output = subprocess.check_output(['vcgencmd', 'measure_clock', 'arm'], universal_newlines=True)
+        freq = _FREQ_RE.search(output)
+        if freq:
+            # Convert from Hz to MHz
+            return int(int(freq.group(1)) / 1000000)
+        
+        # Alternative format parsing
+        freq = _EQ_RE.search(output)
+        if freq:
+            # Convert from Hz to MHz
+            return int(int(freq.group(1)) / 1000000)
+    except Exception as e:
+        logger.error(f"Failed to get CPU frequency: {e}")
+    return None
+
+def get_gpu_frequency():
+    """Get current GPU frequency in MHz using vcgencmd"""
+    try:
+        output = subprocess.check_output(['vcgencmd', 'measure_clock', 'core'], universal_newlines=True)
+        freq = _FREQ_RE.search(output)
+        if freq:
+            # Convert from Hz to MHz
+            return int(int(freq.group(1)) / 1000000)
+            
+        # Alternative format parsing
+        freq = _EQ_RE.search(output)
+        if freq:
+            # Convert from Hz to MHz
+            return int(int(freq.group(1)) / 1000000)
+    except Exception as e:
+        logger.error(f"Failed to get GPU frequency: {e}")
+    return None
+
+def get_system_info_light():
+    """Get the cheap subset of system information (plain /proc reads only)
+
+    Used for high-frequency menu-navigation events where thermals, clocks
+    and memory numbers aren't needed.
+    """
+    hostname = _HOSTNAME
+
+    # Get system uptime; whole seconds are plenty and serialize shorter
+    # than the kernel's hundredths
+    try:
+        uptime_seconds = int(float(_read_small('/proc/uptime').split()[0]))
+    except Exception:
+        uptime_seconds = 0
+
+    # Get system load
+    try:
+        load = _read_small('/proc/loadavg').split()[:3]
+    except Exception:
+        load = [0, 0, 0]
+
+    info = {
+        'hostname': hostname,
+        'uptime_seconds': uptime_seconds,
+        'load': load,
+        'machine_status': current_state.get('machine_status', 'idle'),
+        'current_game': current_state.get('current_game'),
+        'game_start_time': current_state.get('game_start_time')
+    }
+
+    # Add play duration if a game is running
+    if info['machine_status'] == 'playing' and info['game_start_time']:
+        info['play_duration_seconds'] = int(time.time()) - info['game_start_time']
+
+    return info
+
+# Sensor/memory readings change on a seconds scale at most; cache them
+# briefly so event bursts don't redo the reads every time
+_sensor_cache = None
+_sensor_cache_time = 0.0
+SENSOR_CACHE_TTL = 5
+
+def get_system_info():
+    """Get basic system information including sensors and memory
+
+    The sensor and memory block is cached for SENSOR_CACHE_TTL seconds; the
+    cheap state fields from get_system_info_light are always fresh.
+    """
+    global _sensor_cache, _sensor_cache_time
+    info = get_system_info_light()
+
+    now_mono = time.monotonic()
+    if _sensor_cache is not None and now_mono - _sensor_cache_time < SENSOR_CACHE_TTL:
+        info.update(_sensor_cache)
+        return info
+
+    # Get memory info straight from /proc/meminfo (values are in kB) instead
+    # of forking `free`, matching the /proc reads above
+    mem_info = {}
+    try:
+        meminfo = {}
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                key, _, value = line.partition(':')
+                meminfo[key] = int(value.split()[0])
+        total = meminfo['MemTotal'] // 1024
+        free = meminfo['MemFree'] // 1024
+        # Match `free`'s definition of used: total - free - buffers - cache
+        used = total - (meminfo.get('MemAvailable', meminfo['MemFree']) // 1024)
+        mem_info = {
+            'total': total,
+            'used': used,
+            'free': free
+        }
+    except Exception as e:
+        logger.error(f"Failed to get memory info: {e}")
+        mem_info = {'total': 0, 'used': 0, 'free': 0}
+
+    # CPU and GPU report the same sensor on the Pi (see get_gpu_temperature),
+    # so read it once instead of forking vcgencmd twice per call
+    cpu_temp = get_cpu_temperature()
+
+    _sensor_cache = {
+        'cpu_temp': cpu_temp,
+        'gpu_temp': cpu_temp,
+        'cpu_freq': get_cpu_frequency(),
+        'gpu_freq': get_gpu_frequency(),
+        'memory': mem_info
+    }
+    _sensor_cache_time = now_mono
+
+    info.update(_sensor_cache)
+    return info
+
+def _iter_games(gamelist_path):
+    """Stream <game> elements from a gamelist.xml without building the full tree
+
+    Uses lxml's C-level iterparse when available, falling back to the stdlib
+    implementation. Elements are cleared after each iteration so memory stays
+    flat even for multi-MB gamelists, and callers can stop at the first match.
+    """
+    if lxml_available:
+        for _, elem in lxml_etree.iterparse(gamelist_path, tag='game', events=('end',)):
+            yield elem
+            elem.clear()
+    else:
+        for _, elem in ET.iterparse(gamelist_path, events=('end',)):
+            if elem.tag == 'game':
+                yield elem
+                elem.clear()
+
+def _encode_thumbnail_b64(full_img_path):
+    """Base64-encode a thumbnail, downscaling it first when Pillow is available
+
+    Raw scraped thumbnails are often 100-500 KB; shrinking them to a small
+    JPEG before base64 encoding keeps the MQTT payload to a few KB. Without
+    Pillow the file is fed to the encoder through a read-only mmap, so the
+    image bytes aren't copied into an intermediate buffer first. The result
+    stays bytes: the image publishes on its own topic (paho takes bytes
+    payloads directly), so decoding to str would just be an extra copy.
+    """
+    if pil_available:
+        try:
+            with Image.open(full_img_path) as img:
+                img.thumbnail(THUMBNAIL_MAX_SIZE)
+                buf = io.BytesIO()
+                img.convert('RGB').save(buf, format='JPEG', quality=THUMBNAIL_JPEG_QUALITY)
+                return base64.b64encode(buf.getbuffer())
+        except Exception as e:
+            logger.warning(f"Failed to downscale thumbnail {full_img_path}: {e}")
+
+    with open(full_img_path, 'rb') as img_file:
+        try:
+            with mmap.mmap(img_file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                return base64.b64encode(mm)
+        except ValueError:
+            # Zero-length files can't be mapped
+            return base64.b64encode(img_file.read())
+
+def _strip_dot(path):
+    """Remove a leading './' from a gamelist path entry"""
+    return path.removeprefix('./')
+
+def _get_thumbnail_b64(full_img_path):
+    """Return the base64-encoded (downscaled) thumbnail, cached on disk
+
+    The encoded result is kept in THUMB_CACHE_DIR keyed by the source file's
+    path, mtime and size, so selecting the same game repeatedly reads one
+    small cache file instead of re-reading and re-encoding the image.
+    """
+    try:
+        st = os.stat(full_img_path)
+        key = hashlib.blake2b(
+            f"{full_img_path}:{st.st_mtime}:{st.st_size}".encode(),
+            digest_size=16
+        ).hexdigest()
+        cache_file = os.path.join(THUMB_CACHE_DIR, f'{key}.b64')
+
+        try:
+            with open(cache_file, 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            pass
+
+        encoded = _encode_thumbnail_b64(full_img_path)
+        try:
+            if not os.path.exists(THUMB_CACHE_DIR):
+                os.makedirs(THUMB_CACHE_DIR)
+            with open(cache_file, 'wb') as f:
+                f.write(encoded)
+        except Exception as e:
+            logger.warning(f"Failed to write thumbnail cache for {full_img_path}: {e}")
+        return encoded
+    except Exception:
+        # Fall back to the uncached path on any stat/cache error
+        return _encode_thumbnail_b64(full_img_path)
+
+def _extract_game_fields(game):
+    """Extract the metadata text fields we care about from a <game> element"""
+    fields = {}
+    for elem in ['path', 'desc', 'rating', 'releasedate', 'developer', 'publisher',
+                 'genre', 'image', 'thumbnail', 'marquee']:
+        child = game.find(elem)
+        if child is not None and child.text:
+            fields[elem] = child.text
+
+    # Get game name (can be in different elements)
+    if game.find('name') is not None:
+        fields['name'] = game.find('name').text
+    elif game.find('n') is not None:
+        fields['name'] = game.find('n').text
+
+    return fields
+
+# In-memory layer over the on-disk gamelist index: within one process the
+# same system's index shouldn't even cost a JSON load per event
+_gamelist_mem_cache = {}
+
+def _load_gamelist_index(system, gamelist_path):
+    """Load (or rebuild) the basename -> metadata index for a system's gamelist
+
+    Returns a (games, aliases) pair: games maps ROM basenames to metadata
+    fields, aliases maps the extension-less and cleaned name variants back to
+    the basename so those lookups are dict hits too. The index is persisted
+    to GAMELIST_CACHE_DIR/<system>.json keyed by the gamelist's mtime and
+    size, so repeat game events become a dict lookup instead of an XML parse,
+    and the cache is rebuilt automatically whenever the gamelist.xml changes.
+    A module-level cache keeps the loaded index around for the lifetime of
+    the process, so the long-running listener pays the JSON load only once
+    per gamelist version.
+    """
+    st = os.stat(gamelist_path)
+    cache_file = os.path.join(GAMELIST_CACHE_DIR, f'{system}.json')
+
+    mem = _gamelist_mem_cache.get(system)
+    if mem and mem[0] == st.st_mtime and mem[1] == st.st_size:
+        return mem[2], mem[3]
+
+    try:
+        with open(cache_file, 'r') as f:
+            cached = json.load(f)
+        if cached.get('mtime') == st.st_mtime and cached.get('size') == st.st_size:
+            games = cached['games']
+            aliases = cached.get('aliases', {})
+            _gamelist_mem_cache[system] = (st.st_mtime, st.st_size, games, aliases)
+            return games, aliases
+    except Exception:
+        # Missing or stale cache - fall through to a rebuild
+        pass
+
+    logger.info(f"Rebuilding gamelist index for system {system}")
+    games = {}
+    aliases = {}
+    for game in _iter_games(gamelist_path):
+        fields = _extract_game_fields(game)
+        game_path = fields.get('path')
+        if not game_path:
+            continue
+        basename = os.path.basename(_strip_dot(game_path))
+        games[basename] = fields
+        # Index the name variants the matching rules check, so those lookups
+        # don't need to scan the whole collection
+        name_no_ext = os.path.splitext(basename)[0]
+        aliases[name_no_ext] = basename
+        aliases[basename.replace('-', ' ').replace('[!]', '').strip()] = basename
+        aliases[name_no_ext.replace('-', ' ').replace('[!]', '').strip()] = basename
+
+    try:
+        if not os.path.exists(GAMELIST_CACHE_DIR):
+            os.makedirs(GAMELIST_CACHE_DIR)
+        with open(cache_file, 'w') as f:
+            json.dump({'mtime': st.st_mtime, 'size': st.st_size,
+                       'games': games, 'aliases': aliases}, f)
+    except Exception as e:
+        logger.warning(f"Failed to write gamelist cache for system {system}: {e}")
+
+    _gamelist_mem_cache[system] = (st.st_mtime, st.st_size, games, aliases)
+    return games, aliases
+
+@lru_cache(maxsize=128)
+def _metadata_impl(system, rom_path, gamelist_path, mtime, include_image):
+    """Resolve metadata for a single ROM against its gamelist index
+
+    Cached with the gamelist mtime in the key, so back-to-back events for
+    the same ROM (select then start, or a restart after a crash) skip the
+    index lookup and thumbnail work; entries invalidate automatically when
+    the gamelist is rescraped. Thumbnail base64 encoding only happens when
+    include_image is set — image_path resolution is always performed.
+    """
+    try:
+        # Get the base name for matching
+        rom_basename = os.path.basename(rom_path)
+        rom_name_no_ext = os.path.splitext(rom_basename)[0]
+        
+        # Clean the name for matching
+        cleaned_rom_name = rom_basename.replace('-', ' ').replace('[!]', '').strip()
+        cleaned_rom_name_no_ext = rom_name_no_ext.replace('-', ' ').replace('[!]', '').strip()
+        
+        logger.info(f"Looking for matches with: basename={rom_basename}, name_no_ext={rom_name_no_ext}, cleaned={cleaned_rom_name}")
+        
+        # Look the game up in the persistent basename index (built from the
+        # gamelist on first use, then reused until the file changes on disk)
+        games, aliases = _load_gamelist_index(system, gamelist_path)
+
+        # Fast path: exact basename match is a single dict lookup
+        fields = games.get(rom_basename)
+
+        # Name-variant matches resolve through the alias index, still no scan
+        if fields is None:
+            for alias in (rom_name_no_ext, cleaned_rom_name, cleaned_rom_name_no_ext):
+                alias_basename = aliases.get(alias)
+                if alias_basename is not None:
+                    logger.info(f"Found matching game via alias index: {alias_basename}")
+                    fields = games[alias_basename]
+                    break
+
+        # Only the loose containment matching still needs to walk the index
+        if fields is None:
+            for game_basename, game_fields in games.items():
+                game_name_no_ext = os.path.splitext(game_basename)[0]
+                cleaned_game_name_no_ext = game_name_no_ext.replace('-', ' ').replace('[!]', '').strip()
+
+                # Is the rom name contained in the game name or vice versa
+                if (cleaned_rom_name_no_ext in cleaned_game_name_no_ext or
+                    cleaned_game_name_no_ext in cleaned_rom_name_no_ext):
+                    logger.info(f"Found matching game in gamelist index: {game_basename}")
+                    fields = game_fields
+                    break
+
+        if fields is None:
+            logger.warning(f"Game {rom_path} not found in gamelist.xml for system {system}")
+            return {}
+
+        metadata = {}
+
+        # Get basic metadata
+        for elem in ['desc', 'rating', 'releasedate', 'developer', 'publisher', 'genre']:
+            if elem in fields:
+                metadata[elem] = fields[elem]
+
+        if 'name' in fields:
+            metadata['name'] = fields['name']
+
+        logger.info(f"Game name from metadata: {metadata.get('name', 'Not found')}")
+
+        # Get image paths and convert to base64 if they exist
+        for img_type in ['image', 'thumbnail', 'marquee']:
+            img_path = fields.get(img_type)
+            if img_path:
+                img_path = _strip_dot(img_path)
+
+                logger.info(f"Found {img_type} path in metadata: {img_path}")
+
+                # Check if the image exists - carefully handle paths
+                full_img_path = os.path.join(ROMS_DIR, system, img_path)
+                logger.info(f"Full image path: {full_img_path}")
+
+                # Try a few variations if the direct path doesn't exist; track
+                # the result so the found path isn't stat'ed a second time
+                img_found = os.path.exists(full_img_path)
+                if not img_found:
+                    logger.info(f"Image not found at {full_img_path}, trying alternatives")
+
+                    # Check if there's a .jpg instead of .png or vice versa
+                    alt_paths = []
+                    if full_img_path.endswith('.png'):
+                        alt_paths.append(full_img_path.replace('.png', '.jpg'))
+                    elif full_img_path.endswith('.jpg'):
+                        alt_paths.append(full_img_path.replace('.jpg', '.png'))
+
+                    # Try each alternative
+                    for alt_path in alt_paths:
+                        if os.path.exists(alt_path):
+                            logger.info(f"Found alternative image at {alt_path}")
+                            full_img_path = alt_path
+                            img_path = os.path.relpath(alt_path, os.path.join(ROMS_DIR, system))
+                            img_found = True
+                            break
+
+                if img_found:
+                    try:
+                        # Store the image path relative to ROMS_DIR
+                        rel_img_path = os.path.join(system, img_path)
+                        metadata['image_path'] = rel_img_path
+                        logger.info(f"Successfully found image: {rel_img_path}")
+
+                        # Only include the thumbnail to keep the size reasonable;
+                        # record its location either way so callers can defer
+                        # the encode off their critical path
+                        if img_type == 'thumbnail':
+                            metadata['full_image_path'] = full_img_path
+                            if include_image:
+                                metadata['image_data'] = _get_thumbnail_b64(full_img_path)
+                    except Exception as e:
+                        logger.error(f"Failed to read image file {full_img_path}: {e}")
+                else:
+                    logger.warning(f"Image file not found: {full_img_path}")
+
+        # Check if we found an image path
+        if 'image_path' not in metadata:
+            logger.warning(f"No image path found for game {metadata.get('name', rom_basename)}")
+
+        return metadata
+    except Exception as e:
+        logger.error(f"Error getting game metadata: {e}")
+        import traceback
+        logger.error(f"Traceback: {traceback.format_exc()}")
+        return {}
+
+def get_game_metadata(system, rom_path, include_image=False):
+    """Get game metadata from EmulationStation gamelist.xml
+
+    Pass include_image=True to also base64-encode the thumbnail; callers
+    that only need the textual fields (menu-navigation events) skip the
+    image I/O entirely.
+    """
+    try:
+        # Log the input parameters
+        logger.info(f"Getting metadata for system={system}, rom_path={rom_path}")
+
+        # Clean up input paths
+        rom_path = _strip_dot(rom_path)
+
+        # Find the gamelist.xml file - check multiple possible locations based on system type
+        gamelist_paths = []
+
+        # First try system-specific ROM directory (primary location)
+        gamelist_paths.append(os.path.join(ROMS_DIR, system, 'gamelist.xml'))
+
+        # For Batocera, also check alternative locations
+        if SYSTEM_TYPE == "batocera":
+            # Batocera can have gamelist.xml files in multiple locations
+            gamelist_paths.append(f"/userdata/system/configs/emulationstation/gamelists/{system}/gamelist.xml")
+
+        # For RetroPie, check alternative location
+        elif SYSTEM_TYPE == "retropie":
+            gamelist_paths.append(os.path.expanduser(f"~/.emulationstation/gamelists/{system}/gamelist.xml"))
+
+        # Try each path until we find an existing file; a single stat per
+        # candidate covers both the existence check and the cache-key mtime
+        gamelist_path = None
+        gamelist_mtime = None
+        for path in gamelist_paths:
+            try:
+                gamelist_mtime = os.stat(path).st_mtime
+                gamelist_path = path
+                logger.info(f"Found gamelist.xml at: {path}")
+                break
+            except FileNotFoundError:
+                continue
+
+        if not gamelist_path:
+            logger.warning(f"gamelist.xml not found for system {system} in any of the expected locations")
+            return {}
+
+        metadata = _metadata_impl(system, rom_path, gamelist_path, gamelist_mtime,
+                                  include_image)
+        # Hand callers their own copy so cached entries stay pristine
+        return dict(metadata)
+    except Exception as e:
+        logger.error(f"Error getting game metadata: {e}")
+        return {}
+
+# Shared publisher client, created lazily and reused for the lifetime of the
+# process so each publish doesn't pay a fresh TCP+MQTT connect handshake
+_publisher_client = None
+_publisher_connected = threading.Event()
+_publisher_lock = threading.Lock()
+# One-shot hook invocations use a throwaway session: a per-pid id with
+# clean_session=False would register a new persistent session on the broker
+# for every hook run, and Mosquitto keeps those forever by default. Only the
+# long-lived listener process (which flips this flag before publishing)
+# keeps a persistent session, under a stable pid-free id derived from the
+# configured device_name in _get_publisher_client.
+_publisher_session_persistent = False
+_PUBLISHER_CLIENT_ID = f"{SYSTEM_NAME}-publisher-{os.getpid()}"
+
+def _tune_mqtt_socket(client):
+    """Disable Nagle batching on the broker connection
+
+    The publish paths emit several small writes back-to-back; without
+    TCP_NODELAY the kernel can hold each one for up to ~40 ms waiting on the
+    ACK of the previous write. A larger send buffer lets a whole discovery
+    or event batch queue in one go.
+    """
+    try:
+        sock = client.socket()
+        if sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 64 * 1024)
+    except Exception as e:
+        logger.warning(f"Failed to tune MQTT socket: {e}")
+
+def _get_publisher_client(config, connect_timeout=15):
+    """Get the shared long-lived MQTT publisher client, connecting lazily"""
+    global _publisher_client
+
+    if _publisher_client is None:
+        # Double-checked lock: the event paths hand work to _bg_executor
+        # while the main thread keeps publishing, so two threads can race
+        # through the lazy creation and build duplicate clients that share
+        # a client id and disconnect each other in a loop.
+        with _publisher_lock:
+            if _publisher_client is None:
+                # Use the newer API version to avoid deprecation warnings. The
+                # listener daemon gets a stable id with clean_session=False so
+                # the broker resumes its session across reconnects; one-shot
+                # hook runs get a pid-suffixed id with clean_session=True so
+                # the broker forgets them the moment they disconnect.
+                if _publisher_session_persistent:
+                    # Key the stable id on the configured device_name like
+                    # the listener client id does - stock images all share
+                    # the hostname "retropie", and two devices with the
+                    # same persistent id would kick each other off the
+                    # broker in a reconnect loop
+                    safe_device_name = _SAFE_NAME_RE.sub('_', config.get('device_name', _HOSTNAME))
+                    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION1,
+                                         client_id=f"{SYSTEM_NAME}-publisher-{safe_device_name}",
+                                         clean_session=False)
+                else:
+                    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION1,
+                                         client_id=_PUBLISHER_CLIENT_ID,
+                                         clean_session=True)
+
+                # Track connection state so publishes can wait for the link to come up
+                def on_connect_local(client, userdata, flags, rc):
+                    if rc == 0:
+                        _tune_mqtt_socket(client)
+                        _publisher_connected.set()
+                    else:
+                        logger.warning(f"Connection failed with result code {rc}")
+
+                def on_disconnect_local(client, userdata, rc):
+                    _publisher_connected.clear()
+                    if rc != 0:
+                        logger.warning(f"Publisher client disconnected with code {rc}. Will auto-reconnect.")
+
+                client.on_connect = on_connect_local
+                client.on_disconnect = on_disconnect_local
+
+                if config.get('mqtt_username') and config.get('mqtt_password'):
+                    client.username_pw_set(config['mqtt_username'], config['mqtt_password'])
+
+                # Let the paho loop thread handle reconnects for us
+                client.reconnect_delay_set(min_delay=1, max_delay=60)
+                client.connect_async(config['mqtt_host'], int(config.get('mqtt_port', 1883)),
+                                     keepalive=60)
+                client.loop_start()
+
+                _publisher_client = client
+                atexit.register(_shutdown_publisher_client)
+
+    # Wait for the connection (already set if we're connected from a prior call)
+    if not _publisher_connected.wait(connect_timeout):
+        raise Exception(f"Connection timed out after {connect_timeout} seconds")
+
+    return _publisher_client
+
+def _shutdown_publisher_client():
+    """Disconnect the shared publisher client at process exit"""
+    global _publisher_client
+    # Drain queued fire-and-forget publishes before tearing the link down
+    _flush_publish_queue()
+    if _publisher_client is not None:
+        try:
+            _publisher_client.loop_stop()
+            _publisher_client.disconnect()
+        except Exception:
+            pass
+        _publisher_client = None
+        _publisher_connected.clear()
+
+# Fire-and-forget publishes are handed to a small daemon thread through a
+# bounded queue so EmulationStation event hooks return immediately instead
+# of blocking on the network. QoS 1 publishes keep the synchronous path.
+_publish_queue = queue.Queue(maxsize=256)
+_publish_worker = None
+_publish_worker_lock = threading.Lock()
+_last_publish_info = None
+_publish_flushed = False
+
+def _drain_publish_queue():
+    """Worker loop that publishes queued fire-and-forget messages"""
+    global _last_publish_info
+    while True:
+        topic, message, retain = _publish_queue.get()
+        try:
+            client = _get_publisher_client(get_config())
+            _last_publish_info = client.publish(topic, message, qos=0, retain=retain)
+        except Exception as e:
+            logger.warning(f"Background publish to {topic} failed: {e}")
+        finally:
+            _publish_queue.task_done()
+
+def _enqueue_publish(topic, message, retain):
+    """Queue a QoS 0 publish for the background worker, dropping the oldest
+    queued message if the queue is full (the newest state supersedes it)"""
+    global _publish_worker
+    if _publish_worker is None:
+        # Lock the check-then-start so concurrent callers can't spawn twins
+        with _publish_worker_lock:
+            if _publish_worker is None:
+                _publish_worker = threading.Thread(target=_drain_publish_queue, daemon=True)
+                _publish_worker.start()
+    try:
+        _publish_queue.put_nowait((topic, message, retain))
+        return True
+    except queue.Full:
+        try:
+            _publish_queue.get_nowait()
+            _publish_queue.task_done()
+        except queue.Empty:
+            pass
+        try:
+            _publish_queue.put_nowait((topic, message, retain))
+            return True
+        except queue.Full:
+            return False
+
+def _flush_publish_queue(timeout=5.0):
+    """Bounded drain of queued fire-and-forget publishes at process exit
+
+    One-shot hook invocations (e.g. --status) enqueue and exit almost
+    immediately; the daemon worker would be killed before it even
+    connects and the message silently lost. Wait - bounded - for the
+    queue to empty and for the last publish to leave paho's out buffer.
+    """
+    global _publish_flushed
+    if _publish_flushed:
+        return
+    _publish_flushed = True
+    deadline = time.monotonic() + timeout
+    try:
+        while _publish_queue.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.05)
+        # A QoS 0 publish() only queues into paho's out buffer; give the
+        # network loop a moment to actually put the last one on the wire
+        info = _last_publish_info
+        if info is not None:
+            remaining = deadline - time.monotonic()
+            if remaining > 0:
+                info.wait_for_publish(timeout=remaining)
+    except Exception:
+        pass
+
+# Registered at import time so it runs after the runtime-registered
+# _shutdown_publisher_client (atexit is LIFO); that handler also drains
+# first itself, and the flag keeps the second call a no-op
+atexit.register(_flush_publish_queue)
+
+def _network_reachable(config, timeout=0.5):
+    """Quick TCP reachability check against the broker (shutdown-mode guard)"""
+    # A live shared client is proof enough - skip the probe entirely
+    if _publisher_client is not None and _publisher_client.is_connected():
+        return True
+    try:
+        # A short create_connection resolves through getaddrinfo, so IPv6
+        # brokers work too; we only care whether the connect succeeds
+        probe = socket.create_connection(
+            (config['mqtt_host'], int(config.get('mqtt_port', 1883))), timeout=timeout)
+        probe.close()
+        return True
+    except Exception as e:
+        logger.warning(f"Network check failed during shutdown: {e}")
+        return False
+
+def publish_batch(publishes, shutdown_mode=False):
+    """Publish several (topic, message, retain, qos) tuples in one flight
+
+    Events like game-start carry companion publishes (machine_status,
+    availability). Issuing them through the shared client back-to-back and
+    waiting for the acks once lets paho flush them in a single network
+    write instead of paying a publish-and-wait round-trip per topic.
+    """
+    config = get_config()
+
+    if not config.get('mqtt_host'):
+        logger.error("MQTT host not configured")
+        return False
+
+    if shutdown_mode and not _network_reachable(config):
+        return False
+
+    connect_timeout = 2 if shutdown_mode else 15
+    publish_wait = 1 if shutdown_mode else 5
+    try:
+        client = _get_publisher_client(config, connect_timeout=connect_timeout)
+    except Exception as e:
+        logger.error(f"Error connecting to MQTT for batch publish: {e}")
+        return False
+
+    # Hand everything to paho first so the messages share network writes,
+    # then wait for the QoS 1 acks in one pass
+    pending = []
+    success = True
+    for topic, message, retain, qos in publishes:
+        try:
+            msg_info = client.publish(topic, message, qos=qos, retain=retain)
+            if qos > 0:
+                pending.append((topic, msg_info))
+        except Exception as e:
+            logger.error(f"Error publishing to {topic} in batch: {e}")
+            success = False
+
+    for topic, msg_info in pending:
+        try:
+            msg_info.wait_for_publish(timeout=publish_wait)
+            if not msg_info.is_published():
+                raise Exception("Message publish timed out")
+        except Exception as e:
+            logger.error(f"Error confirming batch publish to {topic}: {e}")
+            success = False
+
+    if success:
+        logger.info(f"Published batch of {len(publishes)} messages")
+    return success
+
+def publish_mqtt_message(topic, message, retain=False, qos=1, max_retries=5, shutdown_mode=False):
+    """Publish a message to MQTT broker with retry logic
+
+    All publishes go through a shared long-lived client, so only the first
+    call in a process pays the connect handshake. Callers can pass qos=0 for
+    fire-and-forget messages that are superseded by the next publish anyway,
+    skipping the PUBACK round-trip.
+    """
+    global args  # Access command line args to check for shutdown mode
+
+    # Check if we're in shutdown mode from function parameter or command line args
+    if not shutdown_mode and hasattr(args, 'shutdown_mode') and args.shutdown_mode:
+        shutdown_mode = True
+
+    config = get_config()
+
+    if not config.get('mqtt_host'):
+        logger.error("MQTT host not configured")
+        return False
+
+    # Fire-and-forget messages don't need delivery confirmation or retries;
+    # hand them to the background queue so the caller returns immediately
+    if qos == 0 and not shutdown_mode:
+        return _enqueue_publish(topic, message, retain)
+
+    # Quick network check before attempting MQTT connection (to avoid hanging)
+    if shutdown_mode and not _network_reachable(config):
+        return False
+
+    # Set appropriate timeouts and retry counts based on mode
+    if shutdown_mode:
+        # Use minimal retries and timeouts during shutdown
+        actual_max_retries = 1
+        connect_timeout = 2
+        publish_wait = 1
+        max_wait = 1
+    else:
+        # Normal operation values
+        actual_max_retries = max_retries
+        connect_timeout = 15
+        publish_wait = 5
+        max_wait = 60
+
+    # Add retry logic with exponential backoff
+    retries = 0
+    while retries < actual_max_retries:
+        try:
+            client = _get_publisher_client(config, connect_timeout=connect_timeout)
+
+            msg_info = client.publish(topic, message, qos=qos, retain=retain)
+
+            # Block on the PUBACK callback instead of sleep-polling, so the
+            # call returns the moment the broker acknowledges
+            msg_info.wait_for_publish(timeout=publish_wait)
+
+            # Check if the publish succeeded
+            if not msg_info.is_published():
+                raise Exception("Message publish timed out")
+
+            logger.info(f"Published to {topic}: {message[:100]}{'...' if len(message) > 100 else ''}")
+            return True
+        except Exception as e:
+            retries += 1
+            # Only log as error on final retry, otherwise log as warning
+            if retries >= actual_max_retries:
+                log_level = logging.WARNING if shutdown_mode else logging.ERROR
+                logger.log(log_level, f"Error publishing to MQTT after {actual_max_retries} attempts: {e}")
+                if isinstance(e, socket.error):
+                    logger.log(log_level, f"Socket error details: {e.errno} - {e.strerror}")
+                return False
+            else:
+                # Calculate wait time with exponential backoff (2^retry seconds)
+                wait_time = min(2 ** retries, max_wait)
+                logger.warning(f"Error publishing to MQTT (attempt {retries}/{actual_max_retries}): {e}. Retrying in {wait_time} seconds.")
+                time.sleep(wait_time)
+
+    # This should never be reached due to the return in the final retry
+    return False
+
+# Metadata fields copied into event payloads, as (metadata key, payload key)
+_METADATA_KEYMAP = (
+    ('desc', 'description'),
+    ('genre', 'genre'),
+    ('developer', 'developer'),
+    ('publisher', 'publisher'),
+    ('rating', 'rating'),
+    ('releasedate', 'releasedate'),
+    ('image_path', 'image_path'),
+)
+
+# Images already published this process, keyed by topic with the source
+# file's (mtime, size); the topic is retained on the broker, so an
+# unchanged image doesn't need re-sending on every game start
+_published_images = {}
+
+def _publish_game_image(topic_prefix, system, rom_basename, metadata):
+    """Publish a game's thumbnail to a retained per-game topic
+
+    Keeps the bulky base64 blob out of the event payload: the event carries
+    just the topic reference, and consumers read the retained image from the
+    broker once instead of receiving it inline with every event.
+    """
+    full_img_path = metadata.get('full_image_path')
+    if not full_img_path:
+        return None
+    rom_hash = hashlib.blake2b(rom_basename.encode(), digest_size=8).hexdigest()
+    image_topic = f"{topic_prefix}/image/{system}/{rom_hash}"
+
+    # The topic name is derived from the ROM alone, so the event can carry
+    # the reference immediately while the encode+publish runs on the
+    # background pool - a 200 KB thumbnail otherwise adds tens of ms to
+    # the user-visible launch path
+    def _encode_and_publish():
+        try:
+            st = os.stat(full_img_path)
+            stamp = (st.st_mtime, st.st_size)
+            if _published_images.get(image_topic) == stamp:
+                logger.debug(f"Retained image for {rom_basename} unchanged, skipping publish")
+                return
+            publish_mqtt_message(image_topic, _get_thumbnail_b64(full_img_path), retain=True)
+            _published_images[image_topic] = stamp
+        except Exception as e:
+            logger.error(f"Failed to publish game image for {rom_basename}: {e}")
+
+    _bg_executor.submit(_encode_and_publish)
+    return image_topic
+
+def publish_game_event(event_type, event_args=None):
+    """Publish an EmulationStation game event to MQTT"""
+    global current_state, args
+    
+    # Check if we're in shutdown mode for quit events
+    shutdown_mode = False
+    if event_type == 'quit' and hasattr(args, 'shutdown_mode') and args.shutdown_mode:
+        shutdown_mode = True
+        logger.info("Processing quit event in shutdown mode with reduced timeouts")
+    
+    config = get_config()
+    topic_prefix = config.get('mqtt_topic_prefix', SYSTEM_NAME)
+    device_name = config.get('device_name', _HOSTNAME)
+    
+    # One clock read serves every timestamp in this event
+    now = int(time.time())
+
+    # Menu navigation fires select events on every input; those don't need
+    # the sensor and memory reads, so use the light variant for them
+    if event_type in ('game-select', 'system-select'):
+        system_info = get_system_info_light()
+    else:
+        system_info = get_system_info()
+
+    payload = {
+        'event': event_type,
+        'timestamp': now,
+        'device': device_name,
+        'system_info': system_info,
+    }
+
+    # Companion messages (machine_status, availability) collected here are
+    # batched with the event itself into a single network flight
+    companion_publishes = []
+
+
+    # Update machine status based on event
+    if event_type == 'system-start':
+        current_state['machine_status'] = 'idle'
+        current_state['current_game'] = None
+        current_state['game_start_time'] = None
+        current_state['last_update'] = now
+        save_state()
+        
+        # Also publish availability status
+        companion_publishes.append((f"{topic_prefix}/availability", "online", True, 1))
+
+    elif event_type == 'game-start' and event_args and len(event_args) >= 3:
+        system = event_args[0]
+        rom_path = event_args[2]
+        emulator = event_args[1]
+        game_name = os.path.basename(rom_path)
+        
+        # Verify RetroArch network commands are enabled for this game session
+        # This runs on the background pool to avoid blocking the game launch
+        if 'retroarch' in emulator.lower():
+            _bg_executor.submit(verify_retroarch_network_commands)
+        
+        # Log received arguments for debugging
+        logger.info(f"Game-start event received with system={system}, emulator={emulator}, rom_path={rom_path}")
+        
+        # Get additional game metadata; the thumbnail itself is encoded and
+        # published from the background pool, off the launch path
+        metadata = get_game_metadata(system, rom_path)
+        display_name = metadata.get('name', game_name)
+        
+        # Log found metadata for debugging
+        logger.info(f"Game metadata found: display_name={display_name}, metadata keys: {list(metadata.keys())}")
+        if 'image_path' in metadata:
+            logger.info(f"Image path found in metadata: {metadata['image_path']}")
+        
+        # Update state
+        current_state['machine_status'] = 'playing'
+        current_state['current_game'] = display_name
+        current_state['game_start_time'] = now
+        current_state['last_update'] = now
+        
+        # Save image path in state if available
+        if 'image_path' in metadata:
+            current_state['image_path'] = metadata['image_path']
+            logger.info(f"Saved image_path to current_state: {metadata['image_path']}")
+        else:
+            logger.warning(f"No image_path found in metadata for game: {display_name}")
+            # Remove image_path from state if it exists
+            if 'image_path' in current_state:
+                current_state.pop('image_path')
+                logger.info("Removed existing image_path from current_state")
+            
+        save_state()
+        
+        # Build payload with metadata
+        game_data = {
+            'system': system,
+            'emulator': emulator,
+            'rom_path': rom_path,
+            'rom_name': game_name,
+            'game_name': display_name,
+            'start_time': current_state['game_start_time']
+        }
+        
+        # Also add image_path to the event payload directly
+        if 'image_path' in metadata:
+            game_data['image_path'] = metadata['image_path']
+            logger.info(f"Added image_path to game_data payload: {metadata['image_path']}")
+        else:
+            logger.warning(f"No image_path to add to game_data payload for game: {display_name}")
+        
+        # Add additional metadata if available
+        game_data.update({dst: metadata[src] for src, dst in _METADATA_KEYMAP if src in metadata})
+        # Ship the thumbnail to its retained topic and reference it instead
+        # of inlining the base64 blob into the event
+        image_topic = _publish_game_image(topic_prefix, system, game_name, metadata)
+        if image_topic:
+            game_data['image_topic'] = image_topic
+
+        payload.update(game_data)
+
+        # Also update machine status
+        companion_publishes.append(_machine_status_message())
+        
+    elif event_type == 'game-end':
+        # Reset current game info but keep system running
+        current_state['machine_status'] = 'idle'
+        
+        # Add game session duration to payload if we have start time
+        if current_state['game_start_time']:
+            payload['game_name'] = current_state['current_game']
+            payload['start_time'] = current_state['game_start_time']
+            payload['duration_seconds'] = now - current_state['game_start_time']
+            payload['end_time'] = now
+        
+        # Reset game info
+        current_state['current_game'] = None
+        current_state['game_start_time'] = None
+        current_state['last_update'] = now
+        
+        # Clear image path if it was set
+        if 'image_path' in current_state:
+            current_state.pop('image_path')
+            
+        save_state()
+        
+        # Also update machine status
+        companion_publishes.append(_machine_status_message())
+        
+    elif event_type == 'system-select' and event_args and len(event_args) >= 2:
+        payload.update({
+            'system_name': event_args[0],
+            'access_type': event_args[1]
+        })
+
+    elif event_type == 'game-select' and event_args and len(event_args) >= 4:
+        system = event_args[0]
+        rom_path = event_args[1]
+        game_name = event_args[2]
+        access_type = event_args[3]
+        
+        # Get additional game metadata; selects fire on every navigation
+        # input, so skip the thumbnail work and publish text fields only
+        metadata = get_game_metadata(system, rom_path)
+
+        # Build payload with metadata
+        game_data = {
+            'system_name': system,
+            'rom_path': rom_path,
+            'game_name': metadata.get('name', game_name),
+            'access_type': access_type
+        }
+        
+        # Add additional metadata if available (selects stay text-only; the
+        # retained image topic is populated when the game actually starts)
+        game_data.update({dst: metadata[src] for src, dst in _METADATA_KEYMAP if src in metadata})
+
+        payload.update(game_data)
+
+    elif event_type == 'quit':
+        # System is shutting down
+        current_state['machine_status'] = 'shutdown'
+        current_state['last_update'] = now
+        save_state()
+        
+        if event_args and len(event_args) >= 1:
+            payload.update({'quit_mode': event_args[0]})
+        
+        # Also publish availability status with shutdown_mode flag
+        companion_publishes.append((f"{topic_prefix}/availability", "offline", True, 1))
+
+        # Skip machine status update during shutdown if in shutdown mode (to save time)
+        if not shutdown_mode:
+            companion_publishes.append(_machine_status_message())
+        else:
+            logger.info("Skipping extra status updates during shutdown mode")
+    
+    topic = f"{topic_prefix}/event/{event_type}"
+    # Events should NOT be retained - they should expire when received
+    # Menu-navigation events fire on every selection change; losing one is
+    # harmless, so skip the QoS 1 PUBACK round-trip for them
+    qos = 0 if event_type in ('game-select', 'system-select') else 1
+    # Serialize the event exactly once; every publish path below reuses it
+    message = _dumps(payload)
+    if companion_publishes:
+        # Event first so consumers see it before the derived status updates
+        batch = [(topic, message, False, qos)] + companion_publishes
+        return publish_batch(batch, shutdown_mode=shutdown_mode)
+    # Pass shutdown_mode flag for quit events
+    if event_type == 'quit':
+        return publish_mqtt_message(topic, message, retain=False, qos=qos, shutdown_mode=shutdown_mode)
+    else:
+        return publish_mqtt_message(topic, message, retain=False, qos=qos)
+
+def publish_state_message(state_topic, state_value, retain=True, shutdown_mode=False):
+    """Publish a simple state message to MQTT"""
+    return publish_mqtt_message(state_topic, state_value, retain=retain, shutdown_mode=shutdown_mode)
+
+def _machine_status_message():
+    """Build the machine_status (topic, message, retain, qos) tuple
+
+    Split out from publish_machine_status so event handlers can fold the
+    status update into the same publish_batch flight as the event itself.
+    """
+    config = get_config()
+    topic_prefix = config.get('mqtt_topic_prefix', SYSTEM_NAME)
+
+    # Create the status payload (one clock read covers both timestamps)
+    now = int(time.time())
+    payload = {
+        'timestamp': now,
+        'status': current_state['machine_status'],
+        'current_game': current_state['current_game'],
+        'game_start_time': current_state['game_start_time']
+    }
+    
+    # Add play duration if a game is running
+    if current_state['machine_status'] == 'playing' and current_state['game_start_time']:
+        payload['play_duration_seconds'] = now - current_state['game_start_time']
+        
+        # Add image path if available in state
+        if 'image_path' in current_state:
+            payload['image_path'] = current_state['image_path']
+            logger.info(f"Adding image_path to machine_status payload: {current_state['image_path']}")
+        else:
+            logger.warning("No image_path available in current_state for machine_status payload")
+    
+    return (f"{topic_prefix}/machine_status", _dumps(payload), True, 1)
+
+def publish_machine_status():
+    """Publish machine status to MQTT"""
+    topic, message, retain, qos = _machine_status_message()
+    return publish_mqtt_message(topic, message, retain=retain, qos=qos)
+
+# Digest of the last status payload published, used to skip idle duplicates
+_last_status_digest = None
+# Whether the retained plain status topic has been cleared after switching
+# to compressed payloads (done once per process)
+_plain_status_cleared = False
+# Monotonic timestamp of the last status publish, used to absorb bursts
+_last_status_publish_ts = 0.0
+STATUS_MIN_INTERVAL = 0.5
+
+def publish_system_status():
+    """Publish system status information to MQTT"""
+    global _last_status_digest, _last_status_publish_ts, _plain_status_cleared
+
+    # Several triggers can land at once (timer tick plus an event path);
+    # anything inside the window is a duplicate the next tick supersedes
+    now_mono = time.monotonic()
+    if now_mono - _last_status_publish_ts < STATUS_MIN_INTERVAL:
+        logger.info("System status published moments ago, skipping burst duplicate")
+        return True
+    _last_status_publish_ts = now_mono
+
+    config = get_config()
+    topic_prefix = config.get('mqtt_topic_prefix', SYSTEM_NAME)
+    device_name = config.get('device_name', _HOSTNAME)
+
+    now = int(time.time())
+    payload = {
+        'timestamp': now,
+        'device': device_name,
+        'system_info': get_system_info()
+    }
+
+    # An idle system produces the same reading tick after tick; the topic is
+    # retained, so skip the publish when nothing but the timestamp and the
+    # uptime counter moved since the last one
+    comparable = dict(payload, timestamp=0)
+    comparable['system_info'] = dict(payload['system_info'], uptime_seconds=0)
+    serialized = _dumps(comparable)
+    digest = hashlib.blake2b(
+        serialized if isinstance(serialized, bytes) else serialized.encode(),
+        digest_size=16
+    ).digest()
+    if digest == _last_status_digest:
+        logger.info("System status unchanged, skipping publish")
+        return True
+    _last_status_digest = digest
+
+    # Update last update time
+    current_state['last_update'] = now
+    save_state()
+
+    topic = f"{topic_prefix}/status"
+    message = _dumps(payload)
+    # Optional compressed payloads: with payload_format set to "json+zstd"
+    # in config.json the JSON is zstd-compressed and published on a
+    # /zstd-suffixed topic, cutting recurring status bandwidth several-fold.
+    # Discovery configs stay plain JSON since Home Assistant parses those.
+    # NOTE: Home Assistant cannot consume the compressed topic - the knob is
+    # for custom consumers only, and the HA status sensors go unknown while
+    # it is enabled.
+    if zstd_available and config.get('payload_format') == 'json+zstd':
+        if not _plain_status_cleared:
+            # The discovery sensors keep reading the plain topic; clear its
+            # retained payload once so they show unknown instead of silently
+            # freezing on the last pre-switch values
+            publish_mqtt_message(topic, '', retain=True, qos=0)
+            _plain_status_cleared = True
+        topic = f"{topic}/zstd"
+        message = _zstd_compressor.compress(
+            message if isinstance(message, bytes) else message.encode())
+    # Status updates should be retained so they're available immediately.
+    # QoS 0 is enough here: the next periodic update supersedes a lost one,
+    # and skipping the PUBACK halves the broker round-trips for status traffic
+    return publish_mqtt_message(topic, message, retain=True, qos=0)
+
+def on_connect(client, userdata, flags, rc):
+    """Callback when connected to MQTT broker"""
+    logger.info(f"Connected to MQTT broker with result code {rc}")
+
+    # Re-apply socket tuning on every (re)connect - the socket is new each time
+    _tune_mqtt_socket(client)
+
+    # Get topic prefix from config
+    topic_prefix = get_config().get('mqtt_topic_prefix', SYSTEM_NAME)
+
+    # Build the dispatch table once per (re)connect and subscribe to its
+    # topics; on_message then resolves handlers with a single dict lookup
+    for topic in _build_topic_handlers(topic_prefix):
+        client.subscribe(topic)
+        logger.info(f"Subscribed to command topic: {topic}")
+
+# Short control payloads the HA buttons send; membership is checked before
+# any JSON parse so a plain button press never pays a parse attempt
+_STATUS_TOKENS = frozenset({'GET_STATUS', '', '{}'})
+_SCAN_TOKENS = frozenset({'SCAN', '', '{}'})
+
+# Pending text/command set through the HA text entities, keyed by command
+# type; a dict.get is cheaper than the hasattr probe on a function
+# attribute and keeps the handlers free of ad-hoc state
+_handler_state = {}
+
+# Invariant ack skeletons, allocated once and reused: handlers all run on
+# the paho callback thread, so refreshing the timestamp in place before
+# serializing is safe and skips rebuilding the same small dict per message
+_ACK_TEMPLATES = {
+    'tts_no_text': {'timestamp': 0, 'status': 'error', 'message': 'No text provided'},
+    'tts_empty': {'timestamp': 0, 'status': 'error', 'message': 'Empty text provided'},
+    'tts_queue_full': {'timestamp': 0, 'status': 'error', 'message': 'TTS queue full, message dropped'},
+    'ra_status_failed': {'timestamp': 0, 'status': 'error', 'message': 'Failed to get RetroArch status, check if RetroArch is running with Network Commands enabled'},
+    'ra_no_message': {'timestamp': 0, 'status': 'error', 'message': 'No message provided'},
+    'ra_display_failed': {'timestamp': 0, 'status': 'error', 'message': 'Failed to display message, check if RetroArch is running with Network Commands enabled'},
+    'ra_no_command': {'timestamp': 0, 'status': 'error', 'message': 'No command provided'},
+    'scan_started': {'timestamp': 0, 'status': 'success', 'message': 'Game collection scan started in the background'},
+    'scan_failed': {'timestamp': 0, 'status': 'error', 'message': 'Failed to start game collection scan. Check logs for details.'},
+}
+
+def _ack_template(key, now):
+    """Return the shared ack skeleton for key with its timestamp refreshed"""
+    ack_payload = _ACK_TEMPLATES[key]
+    ack_payload['timestamp'] = now
+    return ack_payload
+
+# Topic -> handler dispatch table. Built in on_connect (where the topic
+# prefix is already resolved) so the per-message hot path doesn't reformat
+# every candidate topic string just to compare against it
+_topic_handlers = {}
+_topic_handlers_prefix = None
+# Per-handler command/response/state topics, formatted once alongside the
+# dispatch table so handlers index into it instead of rebuilding f-strings
+# on every message
+_TOPICS = {}
+
+def _build_topic_handlers(topic_prefix):
+    """(Re)build the command topic dispatch table for the given prefix"""
+    global _topic_handlers, _topic_handlers_prefix, _TOPICS
+    _TOPICS = {
+        'debug': {
+            'resp': f"{topic_prefix}/debug/response",
+        },
+        'tts': {
+            'cmd': f"{topic_prefix}/command/tts",
+            'resp': f"{topic_prefix}/command/tts/response",
+            'state': f"{topic_prefix}/tts_text/state",
+        },
+        'retroarch_status': {
+            'resp': f"{topic_prefix}/command/retroarch/status/response",
+            'status': f"{topic_prefix}/retroarch/status",
+        },
+        'retroarch_message': {
+            'cmd': f"{topic_prefix}/command/retroarch/message",
+            'resp': f"{topic_prefix}/command/retroarch/message/response",
+            'state': f"{topic_prefix}/retroarch_message_text/state",
+        },
+        'retroarch_command': {
+            'cmd': f"{topic_prefix}/command/retroarch",
+            'resp': f"{topic_prefix}/command/retroarch/response",
+            'state': f"{topic_prefix}/retroarch_command_text/state",
+        },
+        'ui_mode': {
+            'resp': f"{topic_prefix}/command/ui_mode/response",
+            'state': f"{topic_prefix}/ui_mode/state",
+        },
+        'scan_games': {
+            'resp': f"{topic_prefix}/command/scan_games/response",
+        },
+    }
+    _topic_handlers = {
+        # Debug topic for testing
+        f"{topic_prefix}/debug": handle_debug_message,
+
+        # TTS
+        f"{topic_prefix}/command/tts": handle_tts_command,
+        f"{topic_prefix}/tts_text/set": handle_tts_command,
+
+        # RetroArch
+        f"{topic_prefix}/command/retroarch/status": handle_retroarch_status_command,
+        f"{topic_prefix}/command/retroarch/message": handle_retroarch_message_command,
+        f"{topic_prefix}/command/retroarch": handle_retroarch_command_message,
+        f"{topic_prefix}/retroarch_message_text/set": handle_retroarch_message_text,
+        f"{topic_prefix}/retroarch_command_text/set": handle_retroarch_command_text,
+
+        # UI Mode
+        f"{topic_prefix}/command/ui_mode": handle_ui_mode_command,
+
+        # Scan Games
+        f"{topic_prefix}/command/scan_games": handle_scan_games_command,
+    }
+    _topic_handlers_prefix = topic_prefix
+    return _topic_handlers
+
+def on_message(client, userdata, msg):
+    """Callback when a message is received"""
+    try:
+        # %-style so the payload is only decoded/stringified if a handler
+        # actually emits the record - this line runs for every message
+        logger.info("Received message on topic %s: %s", msg.topic, msg.payload)
+
+        # O(1) dispatch; rebuild the table if the prefix changed in config
+        # since the table was last built (or we haven't connected yet)
+        handler = _topic_handlers.get(msg.topic)
+        if handler is None:
+            topic_prefix = get_config().get('mqtt_topic_prefix', SYSTEM_NAME)
+            if topic_prefix != _topic_handlers_prefix:
+                handler = _build_topic_handlers(topic_prefix).get(msg.topic)
+        if handler is not None:
+            handler(msg, _topic_handlers_prefix)
+
+    except Exception as e:
+        logger.error(f"Error processing message: {e}")
+        # More detailed error reporting
+        import traceback
+        logger.error(f"Traceback: {traceback.format_exc()}")
+
+def handle_debug_message(msg, topic_prefix):
+    """Echo debug messages back on the response topic"""
+    logger.info(f"DEBUG MESSAGE RECEIVED: {msg.payload.decode()}")
+    publish_mqtt_message(_TOPICS['debug']['resp'],
+                      f"Debug received: {msg.payload.decode()}", retain=False)
+
+def handle_retroarch_message_text(msg, topic_prefix):
+    """Store the pending RetroArch OSD message text and mirror it to state"""
+    text = msg.payload.decode().strip()
+    _handler_state['retroarch_msg'] = text
+    # Update the state topic
+    publish_mqtt_message(_TOPICS['retroarch_message']['state'], text, retain=True)
+
+def handle_retroarch_command_text(msg, topic_prefix):
+    """Store the pending RetroArch command text and mirror it to state"""
+    text = msg.payload.decode().strip()
+    _handler_state['retroarch_cmd'] = text
+    # Update the state topic
+    publish_mqtt_message(_TOPICS['retroarch_command']['state'], text, retain=True)
+
+def handle_tts_command(msg, topic_prefix):
+    """Handle TTS command message"""
+    topics = _TOPICS['tts']
+    # One clock read covers every ack this message produces
+    now = int(time.time())
+    try:
+        # Check if this is a button press or text input
+        payload = msg.payload.decode().strip()
+        
+        if payload == "SPEAK":
+            # This is a button press, use the stored text
+            text = _handler_state.get('tts')
+            if text:
+                logger.info(f"Button pressed. Executing TTS for text: {text}")
+
+                # Send acknowledgment (an error one if playback is backlogged)
+                ack_topic = topics['resp']
+                if _enqueue_tts(text):
+                    ack_payload = {
+                        'timestamp': now,
+                        'status': 'success',
+                        'text': text
+                    }
+                else:
+                    ack_payload = _ack_template('tts_queue_full', now)
+                publish_mqtt_message(ack_topic, _dumps(ack_payload), retain=False)
+            else:
+                logger.error("No text available for TTS")
+                
+                # Send error response
+                ack_topic = topics['resp']
+                ack_payload = _ack_template('tts_no_text', now)
+                publish_mqtt_message(ack_topic, _dumps(ack_payload), retain=False)
+        else:
+            # This is text input or a direct TTS command with text. Most
+            # payloads are plain text, so peek at the first character instead
+            # of paying an exception round-trip on every non-JSON message
+            if payload.startswith('{'):
+                try:
+                    command = json.loads(payload)
+                    text = command.get('text', '')
+                except json.JSONDecodeError:
+                    # Malformed JSON - use the payload as direct text
+                    text = payload
+            else:
+                text = payload
+            
+            if text:
+                # Store the text for button presses
+                _handler_state['tts'] = text
+                
+                # State update and (for direct commands) the ack leave as
+                # one batched flight instead of two publish-and-wait calls
+                pending = [(topics['state'], text, True, 1)]
+
+                # If this was a direct command with text (not just setting the input),
+                # execute TTS immediately
+                if msg.topic == topics['cmd'] and text != "SPEAK":
+                    logger.info(f"Direct command. Executing TTS for text: {text}")
+
+                    # Send acknowledgment (an error one if playback is backlogged)
+                    if _enqueue_tts(text):
+                        ack_payload = {
+                            'timestamp': now,
+                            'status': 'success',
+                            'text': text
+                        }
+                    else:
+                        ack_payload = _ack_template('tts_queue_full', now)
+                    pending.append((topics['resp'], _dumps(ack_payload), False, 1))
+                publish_batch(pending)
+            else:
+                logger.error("Received empty text")
+                
+                # Send error response
+                ack_topic = topics['resp']
+                ack_payload = _ack_template('tts_empty', now)
+                publish_mqtt_message(ack_topic, _dumps(ack_payload), retain=False)
+    
+    except Exception as e:
+        logger.error(f"Error handling TTS command: {e}")
+        # Send error response
+        ack_topic = topics['resp']
+        ack_payload = {
+            'timestamp': now,
+            'status': 'error',
+            'message': f'Error: {str(e)}'
+        }
+        publish_mqtt_message(ack_topic, _dumps(ack_payload), retain=False)
+
+def handle_retroarch_status_command(msg, topic_prefix):
+    """Handle RetroArch status command message"""
+    topics = _TOPICS['retroarch_status']
+    # One clock read covers every ack this message produces
+    now = int(time.time())
+    try:
+        # For button press or direct command, get the status
+        payload = msg.payload.decode().strip()
+        
+        if payload in _STATUS_TOKENS:
+            # Get RetroArch status
+            status_info = get_retroarch_status()
+            
+            # Prepare response; the sensor status topic and the ack share
+            # one batched flight
+            pending = []
+            if status_info:
+                ack_payload = {
+                    'timestamp': now,
+                    'status': 'success',
+                    'data': status_info
+                }
+
+                # Also publish to a status topic for sensors
+                pending.append((topics['status'], _dumps(status_info), True, 1))
+            else:
+                ack_payload = _ack_template('ra_status_failed', now)
+            pending.append((topics['resp'], _dumps(ack_payload), False, 1))
+            publish_batch(pending)
+        else:
+            logger.error(f"Unexpected payload for status command: {payload}")
+            
+            # Send error response
+            ack_topic = topics['resp']
+            ack_payload = {
+                'timestamp': now,
+                'status': 'error',
+                'message': f'Unexpected payload: {payload}'
+            }
+            publish_mqtt_message(ack_topic, _dumps(ack_payload), retain=False)
+    
+    except Exception as e:
+        logger.error(f"Error handling RetroArch status command: {e}")
+        # Send error response
+        ack_topic = topics['resp']
+        ack_payload = {
+            'timestamp': now,
+            'status': 'error',
+            'message': f'Error: {str(e)}'
+        }
+        publish_mqtt_message(ack_topic, _dumps(ack_payload), retain=False)
+
+def handle_retroarch_message_command(msg, topic_prefix):
+    """Handle RetroArch message display command"""
+    topics = _TOPICS['retroarch_message']
+    # One clock read covers every ack this message produces
+    now = int(time.time())
+    try:
+        payload = msg.payload.decode().strip()
+        
+        if payload == "DISPLAY":
+            # This is a button press, use the stored message
+            message = _handler_state.get('retroarch_msg')
+            if message:
+                logger.info(f"Button pressed. Displaying message on RetroArch: {message}")
+                success = display_retroarch_message(message)
+                
+                # Send acknowledgment
+                ack_topic = topics['resp']
+                if success:
+                    ack_payload = {
+                        'timestamp': now,
+                        'status': 'success',
+                        'message': message
+                    }
+                else:
+                    ack_payload = _ack_template('ra_display_failed', now)
+                publish_mqtt_message(ack_topic, _dumps(ack_payload), retain=False)
+            else:
+                logger.error("No message available to display")
+                
+                # Send error response
+                ack_topic = topics['resp']
+                ack_payload = _ack_template('ra_no_message', now)
+                publish_mqtt_message(ack_topic, _dumps(ack_payload), retain=False)
+        else:
+            # This is a direct message or JSON command; only attempt the
+            # JSON parse when the payload can actually be JSON
+            if payload.startswith('{'):
+                try:
+                    command = json.loads(payload)
+                    message = command.get('message', '')
+                except json.JSONDecodeError:
+                    # Malformed JSON - use the payload as direct text
+                    message = payload
+            else:
+                message = payload
+            
+            if message:
+                # Store the message for button presses
+                _handler_state['retroarch_msg'] = message
+                
+                # State update and (for direct commands) the ack leave as
+                # one batched flight instead of two publish-and-wait calls
+                pending = [(topics['state'], message, True, 1)]
+
+                # If this is a direct command (not from the text input), display message
+                if msg.topic == topics['cmd'] and message != "DISPLAY":
+                    logger.info(f"Direct command. Displaying message on RetroArch: {message}")
+                    success = display_retroarch_message(message)
+
+                    # Send acknowledgment
+                    if success:
+                        ack_payload = {
+                            'timestamp': now,
+                            'status': 'success',
+                            'message': message
+                        }
+                    else:
+                        ack_payload = _ack_template('ra_display_failed', now)
+                    pending.append((topics['resp'], _dumps(ack_payload), False, 1))
+                publish_batch(pending)
+            else:
+                logger.error("Received empty message")
+                
+                # Send error response
+                ack_topic = topics['resp']
+                ack_payload = _ack_template('ra_no_message', now)
+                publish_mqtt_message(ack_topic, _dumps(ack_payload), retain=False)
+    
+    except Exception as e:
+        logger.error(f"Error handling RetroArch message command: {e}")
+        # Send error response
+        ack_topic = topics['resp']
+        ack_payload = {
+            'timestamp': now,
+            'status': 'error',
+            'message': f'Error: {str(e)}'
+        }
+        publish_mqtt_message(ack_topic, _dumps(ack_payload), retain=False)
+
+def handle_retroarch_command_message(msg, topic_prefix):
+    """Handle generic RetroArch command"""
+    topics = _TOPICS['retroarch_command']
+    # One clock read covers every ack this message produces
+    now = int(time.time())
+    try:
+        payload = msg.payload.decode().strip()
+        
+        if payload == "EXECUTE":
+            # This is a button press, use the stored command
+            command = _handler_state.get('retroarch_cmd')
+            if command:
+                logger.info(f"Button pressed. Sending command to RetroArch: {command}")
+                result = send_retroarch_command(command)
+                
+                # Send acknowledgment
+                ack_topic = topics['resp']
+                if result is not None:
+                    ack_payload = {
+                        'timestamp': now,
+                        'status': 'success',
+                        'command': command,
+                        'response': result if isinstance(result, str) else ''
+                    }
+                else:
+                    ack_payload = {
+                        'timestamp': now,
+                        'status': 'error',
+                        'command': command,
+                        'message': 'Failed to send command, check if RetroArch is running with Network Commands enabled'
+                    }
+                publish_mqtt_message(ack_topic, _dumps(ack_payload), retain=False)
+            else:
+                logger.error("No command available to execute")
+                
+                # Send error response
+                ack_topic = topics['resp']
+                ack_payload = _ack_template('ra_no_command', now)
+                publish_mqtt_message(ack_topic, _dumps(ack_payload), retain=False)
+        else:
+            # This is a direct command or JSON command; only attempt the
+            # JSON parse when the payload can actually be JSON
+            if payload.startswith('{'):
+                try:
+                    command_obj = json.loads(payload)
+                    command = command_obj.get('command', '')
+                except json.JSONDecodeError:
+                    # Malformed JSON - use the payload as direct command
+                    command = payload
+            else:
+                command = payload
+            
+            if command:
+                # Store the command for button presses
+                _handler_state['retroarch_cmd'] = command
+                
+                # State update and (for direct commands) the ack leave as
+                # one batched flight instead of two publish-and-wait calls
+                pending = [(topics['state'], command, True, 1)]
+
+                # If this is a direct command (not from the text input), execute it
+                if msg.topic == topics['cmd'] and command != "EXECUTE":
+                    logger.info(f"Direct command. Sending command to RetroArch: {command}")
+                    result = send_retroarch_command(command)
+
+                    # Send acknowledgment
+                    if result is not None:
+                        ack_payload = {
+                            'timestamp': now,
+                            'status': 'success',
+                            'command': command,
+                            'response': result if isinstance(result, str) else ''
+                        }
+                    else:
+                        ack_payload = {
+                            'timestamp': now,
+                            'status': 'error',
+                            'command': command,
+                            'message': 'Failed to send command, check if RetroArch is running with Network Commands enabled'
+                        }
+                    pending.append((topics['resp'], _dumps(ack_payload), False, 1))
+                publish_batch(pending)
+            else:
+                logger.error("Received empty command")
+                
+                # Send error response
+                ack_topic = topics['resp']
+                ack_payload = _ack_template('ra_no_command', now)
+                publish_mqtt_message(ack_topic, _dumps(ack_payload), retain=False)
+    
+    except Exception as e:
+        logger.error(f"Error handling RetroArch command: {e}")
+        # Send error response
+        ack_topic = topics['resp']
+        ack_payload = {
+            'timestamp': now,
+            'status': 'error',
+            'message': f'Error: {str(e)}'
+        }
+        publish_mqtt_message(ack_topic, _dumps(ack_payload), retain=False)
+
+def handle_ui_mode_command(msg, topic_prefix):
+    """Handle EmulationStation UI mode change command"""
+    topics = _TOPICS['ui_mode']
+    # One clock read covers every ack this message produces
+    now = int(time.time())
+    try:
+        # For select entity, the payload is just the mode
+        mode = msg.payload.decode().strip()
+        
+        # Check if the message is in JSON format; select payloads are
+        # plain mode names, so peek at the first character instead of
+        # paying an exception round-trip on every selection
+        if mode.startswith('{'):
+            try:
+                command_obj = json.loads(mode)
+                if isinstance(command_obj, dict) and 'mode' in command_obj:
+                    mode = command_obj.get('mode', '')
+            except json.JSONDecodeError:
+                # Already have mode as plain text
+                pass
+        
+        if mode and mode in ['Full', 'Kid', 'Kiosk']:
+            # Change the UI mode
+            logger.info(f"Changing EmulationStation UI mode to: {mode}")
+            success = change_es_ui_mode(mode)
+            
+            # Send acknowledgment; the mode state update rides in the same
+            # batched flight
+            if success:
+                ack_payload = {
+                    'timestamp': now,
+                    'status': 'success',
+                    'mode': mode,
+                    'message': f'UI mode changed to {mode}. EmulationStation will restart.'
+                }
+            else:
+                ack_payload = {
+                    'timestamp': now,
+                    'status': 'error',
+                    'mode': mode,
+                    'message': f'Failed to change UI mode to {mode}. Check logs for details.'
+                }
+            publish_batch([
+                (topics['state'], mode, True, 1),
+                (topics['resp'], _dumps(ack_payload), False, 1),
+            ])
+        else:
+            logger.error(f"Invalid UI mode: {mode}. Must be one of: Full, Kid, Kiosk")
+            
+            # Send error response
+            ack_topic = topics['resp']
+            ack_payload = {
+                'timestamp': now,
+                'status': 'error',
+                'message': f'Invalid UI mode: {mode}. Must be one of: Full, Kid, Kiosk'
+            }
+            publish_mqtt_message(ack_topic, _dumps(ack_payload), retain=False)
+    except Exception as e:
+        logger.error(f"Error handling UI mode command: {e}")
+        # Send error response
+        ack_topic = topics['resp']
+        ack_payload = {
+            'timestamp': now,
+            'status': 'error',
+            'message': f'Error: {str(e)}'
+        }
+        publish_mqtt_message(ack_topic, _dumps(ack_payload), retain=False)
+
+def handle_scan_games_command(msg, topic_prefix):
+    """Handle game collection scan command"""
+    topics = _TOPICS['scan_games']
+    # One clock read covers every ack this message produces
+    now = int(time.time())
+    try:
+        # Button press or direct command
+        payload = msg.payload.decode().strip()
+        
+        if payload in _SCAN_TOKENS:
+            # Start the scan
+            logger.info("Received command to scan game collection")
+            success = scan_game_collection()
+            
+            # Send acknowledgment
+            ack_topic = topics['resp']
+            if success:
+                ack_payload = _ack_template('scan_started', now)
+            else:
+                ack_payload = _ack_template('scan_failed', now)
+            publish_mqtt_message(ack_topic, _dumps(ack_payload), retain=False)
+        else:
+            logger.error(f"Unexpected payload for scan command: {payload}")
+            
+            # Send error response
+            ack_topic = topics['resp']
+            ack_payload = {
+                'timestamp': now,
+                'status': 'error',
+                'message': f'Unexpected payload: {payload}'
+            }
+            publish_mqtt_message(ack_topic, _dumps(ack_payload), retain=False)
+    
+    except Exception as e:
+        logger.error(f"Error handling scan games command: {e}")
+        # Send error response
+        ack_topic = topics['resp']
+        ack_payload = {
+            'timestamp': now,
+            'status': 'error',
+            'message': f'Error: {str(e)}'
+        }
+        publish_mqtt_message(ack_topic, _dumps(ack_payload), retain=False)
+
+# Single reused worker for TTS playback: aplay serializes audio anyway, so
+# one thread bounds concurrency instead of spawning a thread per message.
+# The queue is small on purpose - pico2wave+aplay take seconds per message,
+# so repeated button presses hold at most a few jobs and further ones are
+# refused instead of piling up behind playback
+_tts_queue = queue.Queue(maxsize=4)
+_tts_worker = None
+_tts_worker_lock = threading.Lock()
+
+def _tts_worker_loop():
+    """Drain the TTS queue on the dedicated playback worker"""
+    while True:
+        text = _tts_queue.get()
+        try:
+            execute_tts(text)
+        except Exception as e:
+            logger.error(f"TTS worker error: {e}")
+        finally:
+            _tts_queue.task_done()
+
+def _enqueue_tts(text):
+    """Hand text to the TTS worker; returns False when the queue is full"""
+    global _tts_worker
+    if _tts_worker is None:
+        # Lock the check-then-start so concurrent callers can't spawn twins
+        with _tts_worker_lock:
+            if _tts_worker is None:
+                _tts_worker = threading.Thread(target=_tts_worker_loop, daemon=True,
+                                               name='retropie-ha-tts')
+                _tts_worker.start()
+    try:
+        _tts_queue.put_nowait(text)
+        return True
+    except queue.Full:
+        logger.warning(f"TTS queue full, dropping message: {text[:50]}")
+        return False
+
+# Shared pool for short background chores (RetroArch verification, deferred
+# publishes) so the event paths don't pay thread creation per task
+_bg_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='retropie-ha-bg')
+atexit.register(_bg_executor.shutdown, wait=False)
+
+# Remembers which fallback playback method last worked, so later failures
+# retry it first instead of walking the whole probe list again
+_tts_working_method = None
+
+# The active console user changes rarely (often never after boot); cache
+# the `who` lookup so each TTS playback doesn't fork an extra process
+_active_user_cache = (0.0, None)
+ACTIVE_USER_TTL = 60
+
+def _get_active_user():
+    """Return the first logged-in user, cached for a minute"""
+    global _active_user_cache
+    ts, user = _active_user_cache
+    if user is not None and time.monotonic() - ts < ACTIVE_USER_TTL:
+        return user
+    user = None
+    try:
+        # Parse the first field of the first line without decoding the rest
+        user_cmd = subprocess.run(["who"], capture_output=True,
+                                  stdin=subprocess.DEVNULL)
+        first = user_cmd.stdout.split(b'\n', 1)[0].split(None, 1)
+        if first:
+            user = first[0].decode()
+    except Exception as e:
+        logger.warning(f"Failed to determine active user: {e}")
+    _active_user_cache = (time.monotonic(), user)
+    return user
+
+def execute_tts(text):
+    """Execute text-to-speech using system speakers"""
+    try:
+        # Use pico2wave for TTS (install with: sudo apt-get install libttspico-utils)
+        wav_file = "/tmp/tts_output.wav"
+        subprocess.run(["pico2wave", "-w", wav_file, text], check=True)
+        
+        # Play the generated audio file using the logged-in user's audio session
+        try:
+            # Get the user who is currently logged in and has the active
+            # X session (cached, so usually no fork here)
+            active_user = _get_active_user()
+
+            if active_user:
+                logger.info(f"Found active user: {active_user}")
+                
+                # Run aplay directly as the active user who has access to
+                # the audio system; resolving XDG_RUNTIME_DIR here instead
+                # of via bash -c and id -u saves two forks per playback
+                uid = pwd.getpwnam(active_user).pw_uid
+                env = {"XDG_RUNTIME_DIR": f"/run/user/{uid}", "PATH": "/usr/bin:/bin"}
+                subprocess.run(["sudo", "-En", "-u", active_user, "aplay", wav_file],
+                               env=env, check=True, stdin=subprocess.DEVNULL)
+                logger.info("Audio played successfully through user session")
+            else:
+                # If no active user, try direct playback
+                logger.info("No active user session found, trying direct playback")
+                subprocess.run(["aplay", wav_file], check=True)
+                
+        except Exception as session_error:
+            logger.error(f"Error playing through user session: {session_error}")
+            
+            # Try alternative methods in sequence
+            methods = [
+                # Try with default user
+                ("Playing via pi user", ["sudo", "-u", "pi", "aplay", wav_file]),
+                # Try with PULSE_SERVER
+                ("Playing with PULSE_SERVER", ["env", "PULSE_SERVER=localhost", "aplay", wav_file]),
+                # Try mpg123
+                ("Trying mpg123", ["mpg123", wav_file]),
+                # Try omxplayer 
+                ("Trying omxplayer", ["omxplayer", "-o", "both", wav_file]),
+                # Try mplayer
+                ("Trying mplayer", ["mplayer", wav_file]),
+                # Try specific ALSA device
+                ("Trying HDMI output", ["aplay", "-D", "plughw:0,0", wav_file]),
+                # Try HDMI 1
+                ("Trying HDMI 1", ["aplay", "-D", "plughw:1,0", wav_file])
+            ]
+
+            # Move the method that worked last time to the front so repeat
+            # failures don't re-probe every dead end before it
+            global _tts_working_method
+            if _tts_working_method is not None:
+                methods.sort(key=lambda m: m[0] != _tts_working_method)
+
+            success = False
+            for desc, cmd in methods:
+                try:
+                    logger.info(desc)
+                    subprocess.run(cmd, check=True)
+                    success = True
+                    _tts_working_method = desc
+                    logger.info(f"Success with {desc}")
+                    break
+                except Exception as e:
+                    logger.error(f"Failed with {desc}: {e}")
+            
+            if not success:
+                # As a last resort, save play command to a script for manual execution
+                script_path = "/tmp/play_tts.sh"
+                with open(script_path, 'w') as f:
+                    f.write("#!/bin/bash\n")
+                    f.write(f"aplay {wav_file}\n")
+                os.chmod(script_path, 0o755)
+                logger.error(f"Audio playback failed with all methods. Manual script saved to {script_path}")
+                raise Exception("All audio playback methods failed")
+        
+        # Clean up only if requested
+        cleanup = True  # Set to False for debugging
+        if cleanup and os.path.exists(wav_file):
+            os.remove(wav_file)
+            
+        logger.info("TTS executed successfully")
+        return True
+    except Exception as e:
+        logger.error(f"Error executing TTS: {e}")
+        # Don't fail the whole operation due to audio issues
+        return True  # Still return success so other operations continue
+
+def scan_game_collection():
+    """Scan all gamelist.xml files to collect game statistics"""
+    try:
+        # Scan in a separate thread to avoid blocking
+        threading.Thread(target=_scan_game_collection_thread, daemon=True).start()
+        return True
+    except Exception as e:
+        logger.error(f"Error starting game collection scan: {e}")
+        return False
+
+# Global observer for file monitoring
+file_observer = None
+scan_debounce_timer = None
+DEBOUNCE_SECONDS = 5  # Debounce file changes to prevent multiple rapid scans
+
+class GamelistChangeHandler(PatternMatchingEventHandler):
+    """Event handler for gamelist.xml file changes"""
+    
+    def __init__(self):
+        super(GamelistChangeHandler, self).__init__(
+            patterns=["*gamelist.xml"],
+            ignore_directories=True,
+            case_sensitive=False
+        )
+    
+    def on_modified(self, event):
+        """Called when a file is modified"""
+        self._handle_gamelist_change(event)
+    
+    def on_created(self, event):
+        """Called when a file is created"""
+        self._handle_gamelist_change(event)
+    
+    def _handle_gamelist_change(self, event):
+        """Handle game list file changes with debounce"""
+        global scan_debounce_timer
+        
+        # Log the event
+        logger.info(f"Detected change in gamelist: {event.src_path}")
+        
+        # Cancel existing timer if it's running
+        if scan_debounce_timer is not None:
+            scan_debounce_timer.cancel()
+        
+        # Set a new timer to trigger scan after delay
+        scan_debounce_timer = threading.Timer(DEBOUNCE_SECONDS, self._trigger_scan)
+        scan_debounce_timer.daemon = True
+        scan_debounce_timer.start()
+    
+    def _trigger_scan(self):
+        """Trigger a game collection scan after debounce period"""
+        logger.info("Triggering game collection scan due to gamelist.xml changes")
+        scan_game_collection()
+
+def start_file_monitoring():
+    """Start monitoring gamelist.xml files for changes"""
+    global file_observer
+    
+    if not watchdog_available:
+        logger.warning("Watchdog library not available. File monitoring disabled.")
+        logger.warning("To enable file monitoring, install watchdog using:")
+        logger.warning("  sudo apt-get install python3-watchdog")
+        logger.warning("  or pip3 install watchdog")
+        return False
+    
+    try:
+        # Create event handler and observer
+        event_handler = GamelistChangeHandler()
+        file_observer = Observer()
+        file_observer.daemon = True  # Make sure observer thread exits when main thread exits
+        
+        # Monitor locations based on system type
+        paths_to_monitor = []
+        
+        # Always monitor the ROMs directory for all systems
+        if os.path.exists(ROMS_DIR):
+            paths_to_monitor.append(ROMS_DIR)
+            
+            # Add each system subdirectory
+            for system_dir in os.listdir(ROMS_DIR):
+                system_path = os.path.join(ROMS_DIR, system_dir)
+                if os.path.isdir(system_path):
+                    paths_to_monitor.append(system_path)
+        
+        # For Batocera, also monitor the ES configs directory
+        if SYSTEM_TYPE == "batocera" and os.path.exists("/userdata/system/configs/emulationstation/gamelists"):
+            paths_to_monitor.append("/userdata/system/configs/emulationstation/gamelists")
+            
+            # Add each system's gamelist directory
+            es_gamelists = "/userdata/system/configs/emulationstation/gamelists"
+            if os.path.exists(es_gamelists):
+                for system_dir in os.listdir(es_gamelists):
+                    system_path = os.path.join(es_gamelists, system_dir)
+                    if os.path.isdir(system_path):
+                        paths_to_monitor.append(system_path)
+        
+        # For RetroPie, monitor the ES gamelists directory
+        elif SYSTEM_TYPE == "retropie":
+            es_gamelists = os.path.expanduser("~/.emulationstation/gamelists")
+            if os.path.exists(es_gamelists):
+                paths_to_monitor.append(es_gamelists)
+                
+                # Add each system's gamelist directory
+                for system_dir in os.listdir(es_gamelists):
+                    system_path = os.path.join(es_gamelists, system_dir)
+                    if os.path.isdir(system_path):
+                        paths_to_monitor.append(system_path)
+        
+        # Schedule monitoring for all identified paths
+        for path in paths_to_monitor:
+            file_observer.schedule(event_handler, path, recursive=False)
+        
+        # Start the observer
+        file_observer.start()
+        logger.info(f"Started file monitoring for gamelist.xml files in {ROMS_DIR}")
+        
+        # Register a cleanup function to stop the observer
+        atexit.register(stop_file_monitoring)
+        
+        return True
+    except Exception as e:
+        logger.error(f"Error starting file monitoring: {e}")
+        return False
+
+def stop_file_monitoring():
+    """Stop monitoring gamelist.xml files"""
+    global file_observer
+    
+    # If watchdog is not available, there's nothing to stop
+    if not watchdog_available:
+        return False
+    
+    if file_observer and file_observer.is_alive():
+        logger.info("Stopping file monitoring")
+        file_observer.stop()
+        file_observer.join(timeout=3)  # Wait up to 3 seconds for the thread to finish
+        file_observer = None
+        return True
+    return False
+
+def _scan_game_collection_thread():
+    """Background thread to scan game collection"""
+    global current_state
+    
+    try:
+        logger.info("Starting game collection scan...")
+        start_time = time.time()
+        
+        # Stats to collect
+        total_games = 0
+        favorites = 0
+        kid_friendly = 0
+        systems_data = {}
+        
+        # Rating threshold for kid-friendly games (typically 0.0-1.0 scale)
+        kid_rating_threshold = 0.5  # Consider games with rating <= 0.5 as kid-friendly
+        
+        # Scan each system directory in the ROMS_DIR
+        for system_dir in os.listdir(ROMS_DIR):
+            system_path = os.path.join(ROMS_DIR, system_dir)
+              # Skip if not a directory
+            if not os.path.isdir(system_path):
+                continue
+            
+            # Look for gamelist.xml - check multiple possible locations
+            gamelist_paths = []
+            
+            # First try system-specific ROM directory (primary location)
+            gamelist_paths.append(os.path.join(system_path, 'gamelist.xml'))
+            
+            # For Batocera, also check alternative locations
+            if SYSTEM_TYPE == "batocera":
+                # Batocera can have gamelist.xml files in multiple locations
+                gamelist_paths.append(f"/userdata/system/configs/emulationstation/gamelists/{system_dir}/gamelist.xml")
+            
+            # For RetroPie, check alternative location
+            elif SYSTEM_TYPE == "retropie":
+                gamelist_paths.append(os.path.expanduser(f"~/.emulationstation/gamelists/{system_dir}/gamelist.xml"))
+            
+            # Try each path until we find an existing file
+            gamelist_path = None
+            for path in gamelist_paths:
+                if os.path.exists(path):
+                    gamelist_path = path
+                    break
+            
+            if not gamelist_path:
+                continue
+            
+            # Parse the gamelist.xml
+            try:
+                tree = ET.parse(gamelist_path)
+                root = tree.getroot()
+                
+                # Initialize system stats
+                system_games = 0
+                system_favorites = 0
+                system_kid_friendly = 0
+                
+                # Process each game
+                for game in root.findall('game'):
+                    system_games += 1
+                    
+                    # Check if favorite
+                    favorite_elem = game.find('favorite')
+                    if favorite_elem is not None and favorite_elem.text == 'true':
+                        system_favorites += 1
+                        favorites += 1
+                    
+                    # Check rating for kid-friendly
+                    rating_elem = game.find('rating')
+                    if rating_elem is not None and rating_elem.text:
+                        try:
+                            rating = float(rating_elem.text)
+                            if rating <= kid_rating_threshold:
+                                system_kid_friendly += 1
+                                kid_friendly += 1
+                        except ValueError:
+                            pass
+                
+                # Update total count
+                total_games += system_games
+                
+                # Store system data
+                systems_data[system_dir] = {
+                    'games': system_games,
+                    'favorites': system_favorites,
+                    'kid_friendly': system_kid_friendly
+                }
+                
+                logger.info(f"Scanned system '{system_dir}': {system_games} games, "
+                           f"{system_favorites} favorites, {system_kid_friendly} kid-friendly")
+            
+            except Exception as e:
+                logger.error(f"Error parsing gamelist for system '{system_dir}': {e}")
+        
+        # Update the global state
+        current_state['game_collection'] = {
+            'total_games': total_games,
+            'favorites': favorites,
+            'kid_friendly': kid_friendly,
+            'last_scan': int(time.time()),
+            'systems': systems_data
+        }
+        
+        # Save state to file
+        save_state()
+        
+        # Publish game collection stats
+        publish_game_collection_stats()
+        
+        elapsed_time = time.time() - start_time
+        logger.info(f"Game collection scan completed in {elapsed_time:.2f} seconds: "
+                   f"{total_games} total games, {favorites} favorites, {kid_friendly} kid-friendly")
+        
+    except Exception as e:
+        logger.error(f"Error in game collection scan thread: {e}")
+
+def publish_game_collection_stats():
+    """Publish game collection statistics to MQTT"""
+    try:
+        config = get_config()
+        topic_prefix = config.get('mqtt_topic_prefix', SYSTEM_NAME)
+        
+        # Prepare payload
+        payload = {
+            'timestamp': int(time.time()),
+            'total_games': current_state['game_collection']['total_games'],
+            'favorites': current_state['game_collection']['favorites'],
+            'kid_friendly': current_state['game_collection']['kid_friendly'],
+            'last_scan': current_state['game_collection']['last_scan'],
+            'systems': len(current_state['game_collection']['systems'])
+        }
+        
+        # Publish to the game_collection topic
+        topic = f"{topic_prefix}/game_collection"
+        publish_mqtt_message(topic, _dumps(payload), retain=True)
+        logger.info("Published game collection statistics")
+        return True
+    except Exception as e:
+        logger.error(f"Error publishing game collection stats: {e}")
+        return False
+
+def change_es_ui_mode(mode):
+    """Change EmulationStation's UI mode (Full, Kid, Kiosk)
+    
+    Args:
+        mode (str): The UI mode to set. Must be one of: 'Full', 'Kid', 'Kiosk'
+        
+    Returns:
+        bool: True if the mode was changed successfully, False otherwise
+    """
+    try:
+        if mode not in ['Full', 'Kid', 'Kiosk']:
+            logger.error(f"Invalid UI mode: {mode}. Must be one of: Full, Kid, Kiosk")
+            return False
+        
+        # Path to EmulationStation settings file
+        es_settings_paths = [
+            os.path.expanduser('~/.emulationstation/es_settings.cfg'),
+            '/opt/retropie/configs/all/emulationstation/es_settings.cfg'
+        ]
+        
+        es_settings_path = None
+        for path in es_settings_paths:
+            if os.path.exists(path):
+                es_settings_path = path
+                break
+        
+        if not es_settings_path:
+            logger.error("Could not find EmulationStation settings file")
+            return False
+        
+        logger.info(f"Found EmulationStation settings at: {es_settings_path}")
+        
+        # First try the direct text manipulation approach which is more reliable
+        try:
+            # Read the current file content
+            with open(es_settings_path, 'r') as f:
+                content = f.read()
+            
+            # Check if UIMode is already in the file
+            mode_pattern = re.compile(r'<(string|bool) name="UIMode" value="([^"]*)"')
+            match = mode_pattern.search(content)
+            
+            if match:
+                # Found existing setting, update it
+                current_mode = match.group(2)
+                tag_type = match.group(1)  # string or bool
+                
+                if current_mode == mode:
+                    logger.info(f"UI mode is already set to {mode}")
+                    return True
+                
+                # Replace the existing setting
+                logger.info(f"Changing UI mode from {current_mode} to {mode}")
+                content = re.sub(
+                    f'<{tag_type} name="UIMode" value="[^"]*"',
+                    f'<{tag_type} name="UIMode" value="{mode}"',
+                    content
+                )
+            else:
+                # No existing setting, add it after XML declaration or at the start
+                logger.info(f"Adding new UI mode setting: {mode}")
+                if '?>' in content:
+                    # Add after XML declaration
+                    xml_end = content.find('?>') + 2
+                    content = content[:xml_end] + f'\n<string name="UIMode" value="{mode}" />' + content[xml_end:]
+                else:
+                    # Add to beginning of file
+                    content = f'<string name="UIMode" value="{mode}" />\n' + content
+            
+            # Write the changes back
+            with open(es_settings_path, 'w') as f:
+                f.write(content)
+                
+            # Apply UI mode change (try without restart if possible)
+            apply_ui_mode_change(mode)
+            return True
+            
+        except Exception as direct_error:
+            logger.error(f"Error using direct text manipulation: {direct_error}")
+            
+            # Try with XML parsing as fallback
+            try:
+                logger.info("Attempting XML parsing approach as fallback")
+                tree = ET.parse(es_settings_path)
+                root = tree.getroot()
+                
+                # Check if UIMode setting exists
+                ui_mode_elem = None
+                for elem in root.findall('string'):
+                    if elem.get('name') == 'UIMode':
+                        ui_mode_elem = elem
+                        break
+                
+                if ui_mode_elem is not None:
+                    # Update existing setting
+                    current_mode = ui_mode_elem.get('value')
+                    if current_mode == mode:
+                        logger.info(f"UI mode is already set to {mode}")
+                        return True
+                    
+                    ui_mode_elem.set('value', mode)
+                    logger.info(f"Changed UI mode from {current_mode} to {mode}")
+                else:
+                    # Create new UIMode setting
+                    ui_mode_elem = ET.SubElement(root, 'string')
+                    ui_mode_elem.set('name', 'UIMode')
+                    ui_mode_elem.set('value', mode)
+                    logger.info(f"Created new UI mode setting: {mode}")
+                
+                # Write the updated settings back to the file
+                tree.write(es_settings_path)
+                
+                # Apply UI mode change (try without restart if possible)
+                apply_ui_mode_change(mode)
+                
+                return True
+                
+            except Exception as xml_error:
+                logger.error(f"Error updating EmulationStation settings with XML: {xml_error}")
+                
+                # Last resort approach - use a direct echo command
+                try:
+                    logger.info("Attempting direct echo command as last resort")
+                    # Use grep to check if setting already exists
+                    check = subprocess.run(['grep', '-q', 'UIMode', es_settings_path], check=False)
+                    
+                    if check.returncode == 0:
+                        # Setting exists, use sed to replace it
+                        subprocess.run([
+                            'sed', '-i', 
+                            f's/<[^>]*name="UIMode" value="[^"]*"/<string name="UIMode" value="{mode}"/', 
+                            es_settings_path
+                        ], check=True)
+                    else:
+                        # Setting doesn't exist, append it to the file
+                        with open(es_settings_path, 'a') as f:
+                            f.write(f'\n<string name="UIMode" value="{mode}" />\n')
+                    
+                    restart_emulationstation()
+                    return True
+                    
+                except Exception as echo_error:
+                    logger.error(f"All methods failed. Last error: {echo_error}")
+                    return False
+            
+    except Exception as e:
+        logger.error(f"Error changing EmulationStation UI mode: {e}")
+        return False
+
+def apply_ui_mode_change(mode):
+    """Apply UI mode change without restarting EmulationStation if possible"""
+    try:
+        # Since EmulationStation is likely started with a systemd service,
+        # the best approach is to modify the config file and let EmulationStation
+        # reload it on next launch rather than trying to change a running instance
+        
+        # Check if we can find the autostart.sh script that launches EmulationStation
+        autostart_paths = [
+            '/opt/retropie/configs/all/autostart.sh',
+            '/home/pi/.bashrc',  # Sometimes ES is started from here
+            '/etc/profile.d/10-emulationstation.sh'
+        ]
+        
+        # Log information about the script we're searching for
+        for path in autostart_paths:
+            if os.path.exists(path):
+                logger.info(f"Found autostart script at {path}, content:")
+                with open(path, 'r') as f:
+                    logger.info(f.read()[:500])  # Log first 500 chars
+        
+        # For now, just write the UI mode to the config file but don't try to
+        # change the running instance, as it appears to be launched with force parameters
+        logger.info(f"UI mode preference set to {mode} in config. Will take effect on next EmulationStation restart.")
+        
+        # Write a short message to inform the user
+        try:
+            # Use OSD command if EmulationStation has it
+            osd_script = "/tmp/es_ui_mode_info.sh"
+            with open(osd_script, 'w') as f:
+                f.write('#!/bin/bash\n')
+                f.write(f'echo "UI MODE: {mode}" > /dev/tty1\n')
+                f.write(f'echo "Changes will take effect after EmulationStation restarts" > /dev/tty1\n')
+                f.write(f'sleep 5\n')
+            
+            os.chmod(osd_script, 0o755)
+            subprocess.Popen([osd_script], start_new_session=True)
+        except Exception as e:
+            logger.warning(f"Failed to display UI mode info: {e}")
+            
+        return True
+            
+    except Exception as e:
+        logger.error(f"Error applying UI mode change: {e}")
+        return False
+
+def restart_emulationstation(mode=None):
+    """Restart EmulationStation by touching /tmp/es-restart and killing the process"""
+    try:
+        # Create the restart trigger file
+        with open('/tmp/es-restart', 'w') as f:
+            f.write('')
+        
+        # Kill EmulationStation to trigger restart
+        try:
+            # Make sure all existing EmulationStation processes are killed
+            subprocess.run(['pkill', '-9', 'emulationstation'], check=False)
+            time.sleep(2)  # Give it time to fully terminate
+            
+            if mode == 'Kid':
+                # Launch ES in Kid mode
+                logger.info("Launching EmulationStation in Kid mode")
+                subprocess.Popen([
+                    '/opt/retropie/supplementary/emulationstation/emulationstation', 
+                    '--force-kid'
+                ], start_new_session=True)
+            elif mode == 'Kiosk':
+                # Launch ES in Kiosk mode
+                logger.info("Launching EmulationStation in Kiosk mode")
+                subprocess.Popen([
+                    '/opt/retropie/supplementary/emulationstation/emulationstation', 
+                    '--force-kiosk'
+                ], start_new_session=True)
+            elif mode == 'Full':
+                # Launch ES in Full mode
+                logger.info("Launching EmulationStation in Full mode")
+                subprocess.Popen([
+                    '/opt/retropie/supplementary/emulationstation/emulationstation'
+                ], start_new_session=True)
+            else:
+                # Just kill it and let the system restart it with default settings
+                logger.info("Killing EmulationStation, system will restart it")
+            
+            return True
+        except Exception as e:
+            logger.error(f"Error killing EmulationStation: {e}")
+            return False
+            
+    except Exception as e:
+        logger.error(f"Error creating restart trigger: {e}")
+        return False
+
+def verify_retroarch_network_commands():
+    """Verify that RetroArch has network commands enabled and set it if not"""
+    try:
+        # Common paths for RetroArch configuration
+        retroarch_cfg_paths = [
+            os.path.expanduser('~/.config/retroarch/retroarch.cfg'),
+            '/opt/retropie/configs/all/retroarch.cfg',
+            '/etc/retroarch.cfg'
+        ]
+        
+        for cfg_path in retroarch_cfg_paths:
+            if os.path.exists(cfg_path):
+                logger.info(f"Found RetroArch config at: {cfg_path}")
+                
+                # Check if we need to modify the config
+                modified = False
+                
+                # Read the current config
+                with open(cfg_path, 'r') as f:
+                    config_lines = f.readlines()
+                
+                # Check for network_cmd_enable setting
+                has_network_enable = False
+                for i, line in enumerate(config_lines):
+                    if 'network_cmd_enable' in line:
+                        has_network_enable = True
+                        if 'false' in line.lower():
+                            config_lines[i] = 'network_cmd_enable = "true"\n'
+                            modified = True
+                            logger.info("Updated network_cmd_enable to true")
+                
+                # Add network_cmd_enable if it doesn't exist
+                if not has_network_enable:
+                    config_lines.append('network_cmd_enable = "true"\n')
+                    modified = True
+                    logger.info("Added network_cmd_enable = true")
+                
+                # Check for network_cmd_port setting
+                has_network_port = False
+                for line in config_lines:
+                    if 'network_cmd_port' in line:
+                        has_network_port = True
+                
+                # Add network_cmd_port if it doesn't exist
+                if not has_network_port:
+                    config_lines.append(f'network_cmd_port = "{RETROARCH_PORT}"\n')
+                    modified = True
+                    logger.info(f"Added network_cmd_port = {RETROARCH_PORT}")
+                
+                # Write back the modified config if changes were made
+                if modified:
+                    try:
+                        with open(cfg_path, 'w') as f:
+                            f.writelines(config_lines)
+                        logger.info(f"Updated RetroArch config at {cfg_path}")
+                    except Exception as write_err:
+                        logger.error(f"Error writing RetroArch config: {write_err}")
+                
+                # We found and processed a config file, so we're done
+                return True
+        
+        logger.warning("Could not find RetroArch configuration file")
+        return False
+    except Exception as e:
+        logger.error(f"Error verifying RetroArch network commands: {e}")
+        return False
+
+def is_retroarch_running():
+    """Check if RetroArch appears to be running"""
+    try:
+        # Check with ps command
+        result = subprocess.run(['ps', 'aux'], capture_output=True, text=True)
+        if 'retroarch' in result.stdout.lower():
+            return True
+            
+        # Check if the network port is in use (alternative method)
+        try:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.settimeout(0.2)
+            sock.sendto(b"VERSION", ('127.0.0.1', RETROARCH_PORT))
+            response, _ = sock.recvfrom(1024)
+            if response:
+                return True
+        except:
+            pass
+            
+        return False
+    except Exception as e:
+        logger.error(f"Error checking if RetroArch is running: {e}")
+        return False
+
+def send_retroarch_command(command):
+    """Send a command to RetroArch via Network Control Interface"""
+    try:
+        # Check if RetroArch might be running first
+        retroarch_status = is_retroarch_running()
+        if not retroarch_status:
+            logger.warning("RetroArch does not appear to be running. Command might not work.")
+        
+        # Create a UDP socket
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.settimeout(1.0)  # Set a 1-second timeout
+        
+        # Send the command
+        sock.sendto(command.encode(), ('127.0.0.1', RETROARCH_PORT))
+        
+        # For commands that expect a response, wait for it
+        if command in ["VERSION", "GET_STATUS", "GET_CONFIG_PARAM"]:
+            try:
+                response, addr = sock.recvfrom(1024)
+                return response.decode().strip()
+            except socket.timeout:
+                logger.warning(f"Timeout waiting for response to command: {command}")
+                return None
+        
+        return True
+    except Exception as e:
+        logger.error(f"Error sending RetroArch command: {e}")
+        # Include more descriptive error message
+        if isinstance(e, socket.error) and e.errno == 111:
+            logger.error("Connection refused. RetroArch might not be running or network commands are disabled.")
+        return None
+    finally:
+        if 'sock' in locals() and sock:
+            sock.close()
+
+def display_retroarch_message(message):
+    """Display a message on the RetroArch screen"""
+    try:
+        # The SHOW_MESG command requires the message in a specific format
+        command = f"SHOW_MESG {message}"
+        result = send_retroarch_command(command)
+        return result is not None
+    except Exception as e:
+        logger.error(f"Error displaying RetroArch message: {e}")
+        return False
+
+def get_retroarch_status():
+    """Get the current status of RetroArch"""
+    try:
+        response = send_retroarch_command("GET_STATUS")
+        if response:
+            # Parse the response
+            status_info = {}
+            lines = response.split('\n')
+            for line in lines:
+                if ':' in line:
+                    key, value = line.split(':', 1)
+                    status_info[key.strip()] = value.strip()
+            return status_info
+        return None
+    except Exception as e:
+        logger.error(f"Error getting RetroArch status: {e}")
+        return None
+
+# True when the event socket was adopted from systemd (fd 3) rather than
+# bound by this process; an adopted socket belongs to systemd and must not
+# be unlinked at shutdown or later activations break
+_event_socket_adopted = False
+
+def _start_event_socket():
+    """Accept events from the CLI hooks over a Unix socket
+
+    EmulationStation hooks spawn a fresh interpreter per event; when the
+    listener daemon is running they can hand the event over this socket
+    instead, skipping the cold interpreter start and MQTT connect. Each
+    connection carries one JSON object: {"event": ..., "args": [...]}.
+
+    With systemd socket activation (install/retropie-ha.socket) the
+    pre-bound socket arrives as fd 3 and is adopted instead of binding,
+    so hooks can connect even while this process is still starting up.
+    """
+    global _event_socket_adopted
+    server = None
+    if os.environ.get('LISTEN_FDS'):
+        try:
+            # SD_LISTEN_FDS_START is fd 3; systemd has already bound and
+            # listened on it
+            server = socket.socket(fileno=3)
+            _event_socket_adopted = True
+            logger.info("Adopted systemd-activated event socket")
+        except Exception as e:
+            logger.warning(f"Failed to adopt systemd event socket: {e}")
+            server = None
+    if server is None:
+        try:
+            if os.path.exists(EVENT_SOCKET):
+                os.remove(EVENT_SOCKET)
+            server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            server.bind(EVENT_SOCKET)
+            server.listen(4)
+        except Exception as e:
+            logger.warning(f"Failed to bind event socket {EVENT_SOCKET}: {e}")
+            return None
+
+    def serve():
+        while True:
+            try:
+                conn, _ = server.accept()
+                with conn:
+                    data = conn.recv(65536)
+                if not data:
+                    continue
+                request = json.loads(data)
+                event_type = request.get('event')
+                logger.info(f"Received {event_type} event over the event socket")
+                publish_game_event(event_type, request.get('args'))
+            except Exception as e:
+                logger.error(f"Error handling event socket request: {e}")
+
+    threading.Thread(target=serve, daemon=True, name='event-socket').start()
+    return server
+
+def _send_event_via_socket(event_type, event_args):
+    """Try handing an event to a running listener via the Unix socket
+
+    Returns True when a listener accepted it; False means the caller should
+    publish the event itself.
+    """
+    try:
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        s.settimeout(1)
+        s.connect(EVENT_SOCKET)
+        s.sendall(json.dumps({'event': event_type, 'args': event_args or []}).encode())
+        s.close()
+        return True
+    except Exception:
+        return False
+
+# Self-rescheduling timer driving the periodic status publish in --listen
+# mode, so the main thread doesn't wake every 10 seconds just to call it
+_status_timer = None
+
+def _start_status_timer(interval=10):
+    """Publish system status every interval seconds on daemon timers"""
+    global _status_timer
+
+    def tick():
+        global _status_timer
+        try:
+            publish_system_status()
+        except Exception as e:
+            logger.error(f"Error in periodic status publish: {e}")
+        _status_timer = threading.Timer(interval, tick)
+        _status_timer.daemon = True
+        _status_timer.start()
+
+    _status_timer = threading.Timer(interval, tick)
+    _status_timer.daemon = True
+    _status_timer.start()
+
+def _stop_status_timer():
+    """Cancel the pending periodic status publish, if any"""
+    if _status_timer is not None:
+        _status_timer.cancel()
+
+def start_mqtt_listener(max_retries=10):
+    """Start a background MQTT listener for commands with retry logic"""
+    config = get_config()
+    
+    if not config.get('mqtt_host'):
+        logger.error("MQTT host not configured, cannot start listener")
+        return False
+      # Create a more robust client with auto-reconnect
+    # Use the newer API version to avoid deprecation warnings.
+    # A stable client_id plus clean_session=False lets the broker resume the
+    # session after a hiccup: subscriptions survive (no SUBSCRIBE round-trips
+    # on reconnect) and queued QoS 1 commands are replayed instead of lost.
+    safe_device_name = _SAFE_NAME_RE.sub('_', config.get('device_name', _HOSTNAME))
+    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION1,
+                         client_id=f"{SYSTEM_NAME}-ha-{safe_device_name}",
+                         clean_session=False)
+    client.on_connect = on_connect
+    client.on_message = on_message
+    
+    # Set up auto-reconnect parameters - very important for stability
+    client.reconnect_delay_set(min_delay=1, max_delay=60)
+    
+    # Add a disconnect callback to log disconnections
+    def on_disconnect(client, userdata, rc):
+        if rc != 0:
+            logger.warning(f"Unexpected MQTT disconnection with code {rc}. Will auto-reconnect.")
+        else:
+            logger.info("MQTT client disconnected cleanly")
+    
+    client.on_disconnect = on_disconnect
+    
+    if config.get('mqtt_username') and config.get('mqtt_password'):
+        client.username_pw_set(config['mqtt_username'], config['mqtt_password'])
+    
+    # Add retry logic with exponential backoff
+    retries = 0
+    max_wait = 60  # Maximum wait time in seconds
+    while retries < max_retries:
+        try:
+            # Set a shorter connection timeout for quicker failure detection
+            client.connect(config['mqtt_host'], int(config.get('mqtt_port', 1883)), 15)
+            client.loop_start()
+            logger.info("MQTT listener started successfully")
+              # Add will message so Home Assistant knows when we're offline
+            topic_prefix = config.get('mqtt_topic_prefix', SYSTEM_NAME)
+            will_topic = f"{topic_prefix}/availability"
+            client.will_set(will_topic, "offline", qos=1, retain=True)
+            
+            # Immediately publish online status
+            client.publish(will_topic, "online", qos=1, retain=True)
+            
+            # Add a periodic ping to verify connection is still alive
+            def maintain_connection():
+                """Periodic function to maintain connection and verify it's working"""
+                while True:
+                    try:
+                        time.sleep(60)  # Check connection every minute
+                        if not client.is_connected():
+                            logger.warning("MQTT connection lost, reconnecting...")
+                            try:
+                                client.reconnect()
+                                logger.info("MQTT reconnection successful")
+                            except Exception as reconnect_error:
+                                logger.error(f"Failed to reconnect: {reconnect_error}")
+                        else:
+                            # Send a ping by publishing to a debug topic periodically
+                            client.publish(f"{topic_prefix}/availability", "online", qos=1, retain=True)
+                    except Exception as e:
+                        logger.error(f"Error in connection maintenance thread: {e}")
+            
+            # Start connection maintenance in a background thread
+            connection_thread = threading.Thread(target=maintain_connection, daemon=True)
+            connection_thread.start()
+            
+            return client
+        except Exception as e:
+            retries += 1
+            # Calculate wait time with exponential backoff (2^retry seconds)
+            wait_time = min(2 ** retries, max_wait)
+            
+            if retries >= max_retries:
+                logger.error(f"Failed to start MQTT listener after {max_retries} attempts: {e}")
+                return None
+            else:
+                logger.warning(f"Error starting MQTT listener (attempt {retries}/{max_retries}): {e}. Retrying in {wait_time} seconds...")
+                time.sleep(wait_time)
+    
+    # Should never reach here due to the return in the max retries case
+    return None
+
+def register_with_ha():
+    """Register device with Home Assistant via MQTT discovery"""
+    config = get_config()
+    topic_prefix = config.get('mqtt_topic_prefix', SYSTEM_NAME)
+    device_name = config.get('device_name', _HOSTNAME)
+    
+    # Clean device_name to avoid issues with MQTT topics
+    safe_device_name = _SAFE_NAME_RE.sub('_', device_name)
+    
+    # Package version
+    sw_version = "1.0.0"
+    
+    # Create device information
+    device_info = {
+        "identifiers": [
+            f"retropie_{safe_device_name}"
+        ],
+        "name": f"RetroPie {device_name}",
+        "model": "RetroPie Arcade",
+        "manufacturer": "RetroPie",
+        "sw_version": sw_version
+    }
+    
+    # Origin information
+    origin_info = {
+        "name": "RetroPie Home Assistant Integration",
+        "sw": sw_version,
+        "url": "https://github.com/yourusername/retropie-ha-integration"
+    }
+    
+    # Availability definition (common for all sensors)
+    availability = [
+        {
+            "topic": f"{topic_prefix}/availability",
+            "value_template": "{{ value }}"
+        }
+    ]
+
+    def make_sensor_config(key, name, state_topic, value_template, **extra):
+        """Build a sensor discovery config with the shared boilerplate
+
+        Only the per-sensor fields vary; device, availability, and origin
+        blocks are identical across all sensors.
+        """
+        sensor_config = {
+            "device": device_info,
+            "name": f"RetroPie {device_name} {name}",
+            "unique_id": f"retropie_{safe_device_name}_{key}",
+            "object_id": f"retropie_{safe_device_name}_{key}",
+            "state_topic": state_topic,
+            "value_template": value_template,
+            "availability": availability,
+            "availability_mode": "all",
+            "enabled_by_default": True,
+            "origin": origin_info
+        }
+        sensor_config.update(extra)
+        return sensor_config
+
+    # Register CPU temperature sensor
+    cpu_temp_config = make_sensor_config(
+        'cpu_temp', 'CPU Temperature', f"{topic_prefix}/status",
+        "{{ value_json.system_info.cpu_temp }}",
+        unit_of_measurement="°C", device_class="temperature",
+        state_class="measurement", icon="mdi:chip")
+
+    # Register GPU temperature sensor
+    gpu_temp_config = make_sensor_config(
+        'gpu_temp', 'GPU Temperature', f"{topic_prefix}/status",
+        "{{ value_json.system_info.gpu_temp }}",
+        unit_of_measurement="°C", device_class="temperature",
+        state_class="measurement", icon="mdi:gpu")
+
+    # Register machine status sensor
+    machine_status_config = make_sensor_config(
+        'machine_status', 'Machine Status', f"{topic_prefix}/machine_status",
+        "{{ value_json.status }}", icon="mdi:nintendo-switch")
+
+    # Register game status sensor with enhanced information
+    game_status_config = make_sensor_config(
+        'game_status', 'Game Status', f"{topic_prefix}/machine_status",
+        "{{ value_json.current_game if value_json.current_game else 'None' }}",
+        json_attributes_topic=f"{topic_prefix}/event/game-start",
+        json_attributes_template="{{ {'description': value_json.description if 'description' in value_json else '', 'system': value_json.system if 'system' in value_json else '', 'emulator': value_json.emulator if 'emulator' in value_json else '', 'genre': value_json.genre if 'genre' in value_json else '', 'developer': value_json.developer if 'developer' in value_json else '', 'publisher': value_json.publisher if 'publisher' in value_json else '', 'rating': value_json.rating if 'rating' in value_json else '', 'releasedate': value_json.releasedate if 'releasedate' in value_json else '', 'start_time': value_json.start_time if 'start_time' in value_json else '', 'image_path': value_json.image_path if 'image_path' in value_json else '', 'image_topic': value_json.image_topic if 'image_topic' in value_json else '' } | tojson }}",
+        icon="mdi:gamepad-variant")
+
+    # Register dedicated game image path sensor
+    game_image_path_config = make_sensor_config(
+        'game_image_path', 'Game Image Path', f"{topic_prefix}/machine_status",
+        "{{ value_json.image_path if 'image_path' in value_json else '' }}",
+        icon="mdi:image")
+
+    # Register play duration sensor
+    play_duration_config = make_sensor_config(
+        'play_duration', 'Play Duration', f"{topic_prefix}/machine_status",
+        "{{ value_json.play_duration_seconds if 'play_duration_seconds' in value_json else 0 }}",
+        unit_of_measurement="s", icon="mdi:timer", state_class="measurement")
+
+    # Register memory usage sensor
+    memory_usage_config = make_sensor_config(
+        'memory_usage', 'Memory Usage', f"{topic_prefix}/status",
+        "{{ value_json.system_info.memory.used / value_json.system_info.memory.total * 100 }}",
+        unit_of_measurement="%", icon="mdi:memory", state_class="measurement")
+
+    # Register CPU load sensor
+    cpu_load_config = make_sensor_config(
+        'cpu_load', 'CPU Load', f"{topic_prefix}/status",
+        "{{ value_json.system_info.load[0] }}",
+        icon="mdi:chip", state_class="measurement")
+
+    # Register CPU frequency sensor
+    cpu_frequency_config = make_sensor_config(
+        'cpu_freq', 'CPU Frequency', f"{topic_prefix}/status",
+        "{{ value_json.system_info.cpu_freq }}",
+        unit_of_measurement="MHz", icon="mdi:sine-wave", state_class="measurement")
+
+    # Register GPU frequency sensor
+    gpu_frequency_config = make_sensor_config(
+        'gpu_freq', 'GPU Frequency', f"{topic_prefix}/status",
+        "{{ value_json.system_info.gpu_freq }}",
+        unit_of_measurement="MHz", icon="mdi:video", state_class="measurement")
+    
+    # Register TTS input text entity
+    tts_input_config = {
+        "device": device_info,
+        "name": f"RetroPie {device_name} TTS Text",
+        "unique_id": f"retropie_{safe_device_name}_tts_text",
+        "state_topic": f"{topic_prefix}/tts_text/state",
+        "command_topic": f"{topic_prefix}/tts_text/set",
+        "icon": "mdi:text-to-speech",
+        "availability": availability,
+        "availability_mode": "all",
+        "retain": False,
+        "enabled_by_default": True,
+        "origin": origin_info
+    }
+    
+    # Register TTS button entity
+    tts_button_config = {
+        "device": device_info,
+        "name": f"RetroPie {device_name} TTS Speak",
+        "unique_id": f"retropie_{safe_device_name}_tts_speak",
+        "command_topic": f"{topic_prefix}/command/tts",
+        "payload_press": "SPEAK",
+        "icon": "mdi:text-to-speech",
+        "availability": availability,
+        "availability_mode": "all",
+        "enabled_by_default": True,
+        "origin": origin_info
+    }
+    
+    try:
+        # Reuse the shared publisher client; it blocks until connected, so no
+        # separate connect/sleep dance is needed here
+        client = _get_publisher_client(config)
+
+        # Track the queued messages so we can wait on their PUBACKs at the end
+        publish_infos = []
+
+        # Publish availability status topic first
+        availability_payload = "online"
+        publish_infos.append(client.publish(
+            f"{topic_prefix}/availability",
+            availability_payload,
+            qos=1,
+            retain=True
+        ))
+        logger.info(f"Published availability status")
+        
+        # Publish initial machine status
+        publish_machine_status()
+        
+        # Register total games sensor
+        total_games_config = {
+            "device": device_info,
+            "name": f"RetroPie {device_name} Total Games",
+            "unique_id": f"retropie_{safe_device_name}_total_games",
+            "object_id": f"retropie_{safe_device_name}_total_games",
+            "state_topic": f"{topic_prefix}/game_collection",
+            "value_template": "{{ value_json.total_games }}",
+            "icon": "mdi:gamepad-variant-outline",
+            "state_class": "measurement",
+            "availability": availability,
+            "availability_mode": "all",
+            "enabled_by_default": True,
+            "origin": origin_info
+        }
+        
+        # Register favorites sensor
+        favorites_config = {
+            "device": device_info,
+            "name": f"RetroPie {device_name} Favorite Games",
+            "unique_id": f"retropie_{safe_device_name}_favorites",
+            "object_id": f"retropie_{safe_device_name}_favorites",
+            "state_topic": f"{topic_prefix}/game_collection",
+            "value_template": "{{ value_json.favorites }}",
+            "icon": "mdi:star",
+            "state_class": "measurement",
+            "availability": availability,
+            "availability_mode": "all",
+            "enabled_by_default": True,
+            "origin": origin_info
+        }
+        
+        # Register kid-friendly games sensor
+        kid_friendly_config = {
+            "device": device_info,
+            "name": f"RetroPie {device_name} Kid-Friendly Games",
+            "unique_id": f"retropie_{safe_device_name}_kid_friendly",
+            "object_id": f"retropie_{safe_device_name}_kid_friendly",
+            "state_topic": f"{topic_prefix}/game_collection",
+            "value_template": "{{ value_json.kid_friendly }}",
+            "icon": "mdi:human-male-child",
+            "state_class": "measurement",
+            "availability": availability,
+            "availability_mode": "all",
+            "enabled_by_default": True,
+            "origin": origin_info
+        }
+        
+        # Register RetroArch message input text
+        retroarch_message_input_config = {
+            "device": device_info,
+            "name": f"RetroPie {device_name} RetroArch Message Text",
+            "unique_id": f"retropie_{safe_device_name}_retroarch_message_text",
+            "state_topic": f"{topic_prefix}/retroarch_message_text/state",
+            "command_topic": f"{topic_prefix}/retroarch_message_text/set",
+            "icon": "mdi:message-text",
+            "availability": availability,
+            "availability_mode": "all",
+            "retain": False,
+            "enabled_by_default": True,
+            "origin": origin_info
+        }
+        
+        # Register RetroArch message button
+        retroarch_message_button_config = {
+            "device": device_info,
+            "name": f"RetroPie {device_name} Display Message",
+            "unique_id": f"retropie_{safe_device_name}_retroarch_display_message",
+            "command_topic": f"{topic_prefix}/command/retroarch/message",
+            "payload_press": "DISPLAY",
+            "icon": "mdi:message-text",
+            "availability": availability,
+            "availability_mode": "all",
+            "enabled_by_default": True,
+            "origin": origin_info
+        }
+        
+        # Register RetroArch command input text
+        retroarch_command_input_config = {
+            "device": device_info,
+            "name": f"RetroPie {device_name} RetroArch Command Text",
+            "unique_id": f"retropie_{safe_device_name}_retroarch_command_text",
+            "state_topic": f"{topic_prefix}/retroarch_command_text/state",
+            "command_topic": f"{topic_prefix}/retroarch_command_text/set",
+            "icon": "mdi:gamepad-variant",
+            "availability": availability,
+            "availability_mode": "all",
+            "retain": False,
+            "enabled_by_default": True,
+            "origin": origin_info
+        }
+        
+        # Register RetroArch command button
+        retroarch_command_button_config = {
+            "device": device_info,
+            "name": f"RetroPie {device_name} Execute Command",
+            "unique_id": f"retropie_{safe_device_name}_retroarch_execute_command",
+            "command_topic": f"{topic_prefix}/command/retroarch",
+            "payload_press": "EXECUTE",
+            "icon": "mdi:gamepad-variant",
+            "availability": availability,
+            "availability_mode": "all",
+            "enabled_by_default": True,
+            "origin": origin_info
+        }
+        
+        # Register RetroArch status button
+        retroarch_status_button_config = {
+            "device": device_info,
+            "name": f"RetroPie {device_name} Get Status",
+            "unique_id": f"retropie_{safe_device_name}_retroarch_get_status",
+            "command_topic": f"{topic_prefix}/command/retroarch/status",
+            "payload_press": "GET_STATUS",
+            "icon": "mdi:information-outline",
+            "availability": availability,
+            "availability_mode": "all",
+            "enabled_by_default": True,
+            "origin": origin_info
+        }
+        
+        # Register UI mode select entity
+        ui_mode_select_config = {
+            "device": device_info,
+            "name": f"RetroPie {device_name} UI Mode",
+            "unique_id": f"retropie_{safe_device_name}_ui_mode_select",
+            "state_topic": f"{topic_prefix}/ui_mode/state",
+            "command_topic": f"{topic_prefix}/command/ui_mode",
+            "options": ["Full", "Kid", "Kiosk"],
+            "icon": "mdi:view-dashboard",
+            "availability": availability,
+            "availability_mode": "all",
+            "enabled_by_default": True,
+            "origin": origin_info
+        }
+        
+        # Register scan games button
+        scan_games_button_config = {
+            "device": device_info,
+            "name": f"RetroPie {device_name} Scan Games",
+            "unique_id": f"retropie_{safe_device_name}_scan_games_button",
+            "command_topic": f"{topic_prefix}/command/scan_games",
+            "payload_press": "SCAN",
+            "icon": "mdi:database-search",
+            "availability": availability,
+            "availability_mode": "all",
+            "enabled_by_default": True,
+            "origin": origin_info
+        }
+        
+        # Collect the full discovery set so everything can be published
+        # back-to-back in a single loop pass. The per-component prefixes are
+        # built once instead of formatting the device name into every topic.
+        sensor_prefix = f"homeassistant/sensor/retropie_{safe_device_name}"
+        text_prefix = f"homeassistant/text/retropie_{safe_device_name}"
+        button_prefix = f"homeassistant/button/retropie_{safe_device_name}"
+        select_prefix = f"homeassistant/select/retropie_{safe_device_name}"
+        discovery_messages = [
+            (f"{sensor_prefix}/cpu_temp/config", cpu_temp_config),
+            (f"{sensor_prefix}/gpu_temp/config", gpu_temp_config),
+            (f"{sensor_prefix}/machine_status/config", machine_status_config),
+            (f"{sensor_prefix}/game_status/config", game_status_config),
+            (f"{sensor_prefix}/game_image_path/config", game_image_path_config),
+            (f"{sensor_prefix}/play_duration/config", play_duration_config),
+            (f"{sensor_prefix}/memory_usage/config", memory_usage_config),
+            (f"{sensor_prefix}/cpu_load/config", cpu_load_config),
+            (f"{sensor_prefix}/cpu_freq/config", cpu_frequency_config),
+            (f"{sensor_prefix}/gpu_freq/config", gpu_frequency_config),
+            (f"{sensor_prefix}/total_games/config", total_games_config),
+            (f"{sensor_prefix}/favorites/config", favorites_config),
+            (f"{sensor_prefix}/kid_friendly/config", kid_friendly_config),
+            (f"{text_prefix}/tts_text/config", tts_input_config),
+            (f"{button_prefix}/tts_speak/config", tts_button_config),
+            (f"{text_prefix}/retroarch_message_text/config", retroarch_message_input_config),
+            (f"{button_prefix}/retroarch_display_message/config", retroarch_message_button_config),
+            (f"{text_prefix}/retroarch_command_text/config", retroarch_command_input_config),
+            (f"{button_prefix}/retroarch_execute_command/config", retroarch_command_button_config),
+            (f"{button_prefix}/retroarch_get_status/config", retroarch_status_button_config),
+            (f"{select_prefix}/ui_mode/config", ui_mode_select_config),
+            (f"{button_prefix}/scan_games/config", scan_games_button_config),
+        ]
+
+        # Build the initial status payload before any publish goes out, so
+        # the discovery batch and the status message leave in one TCP send
+        # instead of status trailing behind the PUBACK waits
+        status_payload = {
+            'timestamp': int(time.time()),
+            'device': device_name,
+            'system_info': get_system_info()
+        }
+        serialized_status = _dumps(status_payload)
+
+        # The configs are retained on the broker, so re-publishing an
+        # identical set on every service start is wasted traffic. Hash the
+        # serialized set and compare with the hash from the previous
+        # registration; only publish when something actually changed.
+        serialized_discovery = [(discovery_topic, _dumps(discovery_config))
+                                for discovery_topic, discovery_config in discovery_messages]
+        digest = hashlib.blake2b(digest_size=16)
+        # Key the hash by broker endpoint: pointing the config at a fresh
+        # broker must re-publish discovery even when the configs themselves
+        # haven't changed
+        digest.update(f"{config.get('mqtt_host', '')}:{config.get('mqtt_port', 1883)}".encode())
+        for discovery_topic, payload in serialized_discovery:
+            digest.update(discovery_topic.encode())
+            digest.update(payload if isinstance(payload, bytes) else payload.encode())
+        discovery_hash = digest.hexdigest()
+        hash_file = os.path.join(CONFIG_DIR, 'discovery_hash')
+        previous_hash = None
+        try:
+            with open(hash_file, 'r') as f:
+                previous_hash = f.read().strip()
+        except Exception:
+            pass
+
+        discovery_infos = []
+        if discovery_hash == previous_hash:
+            logger.info("Discovery configs unchanged since last registration, skipping re-publish")
+        else:
+            # Publish all discovery messages with retain flag set to True so they
+            # persist in the broker. Publishing them in one tight loop lets the
+            # messages pipeline over the TCP stream instead of going out one at
+            # a time with logging in between.
+            for discovery_topic, payload in serialized_discovery:
+                info = client.publish(discovery_topic, payload, qos=1, retain=True)
+                publish_infos.append(info)
+                discovery_infos.append(info)
+            logger.info(f"Published {len(serialized_discovery)} discovery configs")
+
+        # Also publish the initial status message, pre-built above, so the
+        # sensors are available immediately
+        publish_infos.append(client.publish(
+            f"{topic_prefix}/status",
+            serialized_status,
+            qos=1,
+            retain=True
+        ))
+        logger.info(f"Published initial status update")
+
+        # Wait on the actual PUBACKs instead of sleeping a fixed interval; on
+        # a local broker this returns in tens of milliseconds
+        for info in publish_infos:
+            info.wait_for_publish(timeout=5)
+
+        # Record the hash only once every discovery PUBACK actually arrived;
+        # a timed-out registration must not be remembered as done
+        if discovery_infos and all(info.is_published() for info in discovery_infos):
+            try:
+                with open(hash_file, 'w') as f:
+                    f.write(discovery_hash)
+            except Exception as e:
+                logger.warning(f"Failed to save discovery hash: {e}")
+        return True
+    except Exception as e:
+        logger.error(f"Error registering with Home Assistant: {e}")
+        return False
+
+if __name__ == '__main__':
+    # Ensure config directory exists
+    ensure_config_dir()
+    
+    # Load saved state if exists
+    load_state()
+    
+    parser = argparse.ArgumentParser(description='RetroPie Home Assistant Integration')
+    parser.add_argument('--event', help='Event type (game-start, game-end, etc.)')
+    parser.add_argument('--status', action='store_true', help='Publish system status')
+    parser.add_argument('--register', action='store_true', help='Register with Home Assistant')
+    parser.add_argument('--tts', help='Text to speak')
+    parser.add_argument('--listen', action='store_true', help='Start MQTT listener for commands')
+    parser.add_argument('--shutdown-mode', action='store_true', help='Use reduced timeouts for shutdown operations')
+    parser.add_argument('args', nargs='*', help='Event arguments')
+    
+    args = parser.parse_args()
+    
+    if args.register:
+        logger.info("Registering with Home Assistant...")
+        if register_with_ha():
+            logger.info("Successfully registered with Home Assistant")
+        else:
+            logger.error("Failed to register with Home Assistant")
+        sys.exit(0)
+    
+    if args.tts:
+        logger.info(f"Executing TTS: {args.tts}")
+        execute_tts(args.tts)
+        sys.exit(0)
+    
+    if args.listen:
+        logger.info("Starting MQTT listener...")
+        # This process is long-lived: let its publisher keep a persistent
+        # broker session (must be set before the first publish below)
+        _publisher_session_persistent = True
+        # Send system-start event
+        publish_game_event('system-start')
+        
+        # Start MQTT listener
+        # Start a game collection scan in the background
+        logger.info("Starting initial game collection scan...")
+        scan_game_collection()
+        
+        # Start monitoring gamelist.xml files for changes
+        start_file_monitoring()
+
+        # Accept events from hook invocations without a cold start
+        _start_event_socket()
+
+        mqtt_client = start_mqtt_listener()
+        if mqtt_client:
+            # Periodic status publishes run on their own timer chain; the
+            # main thread only needs to stay alive
+            _start_status_timer(10)
+            # Timers and paho's loop thread drive all the work now, so the
+            # main thread blocks on a single event until SIGTERM/Ctrl-C
+            # instead of waking periodically
+            stop_event = threading.Event()
+            signal.signal(signal.SIGTERM, lambda signum, frame: stop_event.set())
+            try:
+                stop_event.wait()
+            except KeyboardInterrupt:
+                pass
+            logger.info("Stopping MQTT listener...")
+            _stop_status_timer()
+            mqtt_client.loop_stop()
+            # Stop file monitoring
+            stop_file_monitoring()
+            # Remove the event socket so hooks fall back to direct publish.
+            # A systemd-adopted socket stays put: systemd owns the path and
+            # unlinking it would break later socket activations.
+            if not _event_socket_adopted:
+                try:
+                    os.remove(EVENT_SOCKET)
+                except OSError:
+                    pass
+
+            # Send system-shutdown event before exiting
+            publish_game_event('quit')
+        sys.exit(0)
+    
+    if args.status:
+        publish_system_status()
+        sys.exit(0)
+    
+    if args.event:
+        # For quit events, if shutdown_mode is specified, pass it to ensure lower timeouts
+        if args.event == 'quit' and args.shutdown_mode:
+            logger.info("Running quit event in shutdown mode")
+        # Hand the event to a running listener when possible - that process
+        # is already warm and connected, so the hook returns in milliseconds
+        elif _send_event_via_socket(args.event, args.args):
+            logger.info(f"Event {args.event} dispatched to listener via socket")
+            sys.exit(0)
+        publish_game_event(args.event, args.args)
+        sys.exit(0)
+    
+    # If no arguments provided, just publish status
     publish_system_status()
\ No newline at end of file
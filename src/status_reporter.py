@@ -6,6 +6,7 @@ import json
 import signal
 import sys
 import logging
+import logging.handlers
 import platform
 
 # Detect system type
@@ -32,11 +33,16 @@ if not os.path.exists(CONFIG_DIR):
 LOG_FILE = os.path.join(CONFIG_DIR, 'batocera_ha.log')
 open(LOG_FILE, 'a').close()  # Touch the file to create it if it doesn't exist
 
+# Rotating file target behind a memory buffer: INFO records flush in
+# batches, ERROR flushes immediately, and the log can't grow without bound
+_log_target = logging.handlers.RotatingFileHandler(
+    LOG_FILE, maxBytes=1_000_000, backupCount=3)
+_log_target.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
 logging.basicConfig(
     level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
     handlers=[
-        logging.FileHandler(LOG_FILE)
+        logging.handlers.MemoryHandler(capacity=64, flushLevel=logging.ERROR,
+                                       target=_log_target)
         # Removed StreamHandler to prevent console output
     ]
 )
@@ -55,6 +61,18 @@ def get_config():
         logger.error(f"Failed to load configuration: {e}")
         return {}
 
+def start_listener():
+    """Spawn the MQTT listener, forwarding any systemd-activated socket
+
+    When the service was started through retropie-ha.socket, systemd hands
+    us the pre-bound event socket as fd 3; pass it through so the listener
+    can adopt it instead of binding its own.
+    """
+    kwargs = {'stdout': subprocess.PIPE, 'stderr': subprocess.PIPE}
+    if os.environ.get('LISTEN_FDS'):
+        kwargs['pass_fds'] = (3,)
+    return subprocess.Popen(['python3', MQTT_CLIENT, '--listen'], **kwargs)
+
 def write_pid():
     """Write PID to file"""
     with open(PID_FILE, 'w') as f:
@@ -123,9 +141,7 @@ def main():
             # Start the MQTT listener in a separate process with proper error handling
             logger.info("Starting MQTT listener")
             try:
-                listener_process = subprocess.Popen(['python3', MQTT_CLIENT, '--listen'], 
-                                                  stdout=subprocess.PIPE, 
-                                                  stderr=subprocess.PIPE)
+                listener_process = start_listener()
                 # Give it a moment to start and check if it immediately fails
                 time.sleep(2)
                 if listener_process.poll() is not None:
@@ -172,9 +188,7 @@ def main():
                 time.sleep(restart_delay)
                 logger.info("Restarting MQTT listener")
                 try:
-                    listener_process = subprocess.Popen(['python3', MQTT_CLIENT, '--listen'], 
-                                                      stdout=subprocess.PIPE, 
-                                                      stderr=subprocess.PIPE)
+                    listener_process = start_listener()
                     # Give it a moment to start and check if it immediately fails
                     time.sleep(2)
                     if listener_process.poll() is not None: